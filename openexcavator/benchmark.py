@@ -0,0 +1,467 @@
+"""
+Benchmarks for the hot paths, run from the openexcavator folder with:
+python3 benchmark.py [--json] [name ...]
+
+Inputs are generated from fixed seeds so runs on the same machine are comparable; timings are
+reported as throughput (operations per second) and p50/p99 latency in microseconds.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from design import DesignPath
+import surface
+
+
+def random_walk(count, step=1.0, seed=1):
+    """
+    Generate a path as a random walk in projected coordinates
+    :param count: number of vertices
+    :param step: distance between vertices in meters
+    :param seed: random seed
+    :returns: eastings, northings arrays
+    """
+    rng = np.random.default_rng(seed)
+    heading = np.cumsum(rng.normal(0, 0.3, count))
+    eastings = 600000 + np.cumsum(step * np.sin(heading))
+    northings = 5700000 + np.cumsum(step * np.cos(heading))
+    return eastings, northings
+
+
+def summarize(name, durations, **extra):
+    """
+    Build a result dict from individual operation durations
+    :param name: benchmark name
+    :param durations: list of durations in seconds
+    :param extra: other values to report
+    :returns: result dict with count, ops_per_s, p50_us, p99_us
+    """
+    durations = np.asarray(durations)
+    result = {"name": name, "count": len(durations), "ops_per_s": len(durations) / durations.sum(),
+              "p50_us": float(np.percentile(durations, 50)) * 1e6,
+              "p99_us": float(np.percentile(durations, 99)) * 1e6}
+    result.update(extra)
+    return result
+
+
+def measure(func, args_list):
+    """
+    Time func(*args) for every args tuple
+    :returns: list of durations in seconds
+    """
+    durations = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_parsers(count=5000):
+    """Parse NMEA epochs (RMC, GGA, GST) with ReachGPS and IMU JSON lines with ReachIMU"""
+    from reach.gps import ReachGPS
+    from reach.imu import ReachIMU
+    from simulator import synthetic_chunks
+
+    gps = ReachGPS("127.0.0.1", 0, deque(maxlen=1))
+    epochs = [(data.decode(),) for _, data in synthetic_chunks("gps", count / 5)]
+    lines = [(data.decode(),) for _, data in synthetic_chunks("imu", count / 50)]
+    return [summarize("parse_gps_epoch", measure(gps.parse_data, epochs)),
+            summarize("parse_imu_line", measure(ReachIMU.parse_data, lines))]
+
+
+def bench_nmea(count=5000):
+    """
+    Compare the bytes-level NMEA parser with the previous strptime based one on the same epochs: the
+    sentences both parse ($GNRMC, $GNGGA, $GNGST), given as the bytes read from the socket (the previous
+    reader decoded them first); nmea_checksum is the checksum validation the previous parser skipped,
+    three of them already take more than a fifth of a reference epoch so a 5x gain is out of reach
+    """
+    from gps.nmea import checksum
+    from reach.gps import ReachGPS
+    from simulator import synthetic_chunks
+
+    gps = ReachGPS("127.0.0.1", 0, deque(maxlen=1))
+    epochs = [(b"\n".join(line for line in data.split(b"\n") if line[3:6] in (b"RMC", b"GGA", b"GST")),)
+              for _, data in synthetic_chunks("gps", count / 5)]
+    reference = measure(lambda data: gps.parse_data_reference(data.decode()), epochs)
+    parsed = measure(gps.parse_data, epochs)
+    if any(gps.parse_data(data).keys() != gps.parse_data_reference(data.decode()).keys() for data, in epochs[:10]):
+        raise AssertionError("the NMEA parsers do not return the same fields")
+    sentences = [(line,) for data, in epochs for line in data.splitlines()]
+    bodies = [(line[1:line.index(b"*")],) for line, in sentences]
+    return [summarize("nmea_epoch_reference", reference),
+            summarize("nmea_epoch", parsed, speedup=sum(reference) / sum(parsed)),
+            summarize("nmea_sentence", measure(gps.handle_sentence, sentences)),
+            summarize("nmea_checksum", measure(checksum, bodies))]
+
+
+def bench_ubx(count=5000):
+    """Frame and decode NAV-PVT + NAV-COV epochs (UBX binary mode)"""
+    from gps.ubx import UBXFramer, decode_nav_cov, decode_nav_pvt
+    from simulator import synthetic_chunks
+
+    framer = UBXFramer()
+
+    def decode_epoch(data):
+        messages = framer.feed(data)
+        epoch = decode_nav_pvt(messages[0][2])
+        epoch.update(decode_nav_cov(messages[1][2])[1])
+        return epoch
+
+    epochs = [(data,) for _, data in synthetic_chunks("ubx", count / 10)]
+    return [summarize("ubx_epoch", measure(decode_epoch, epochs))]
+
+
+def imu_samples(count, rate=100.0, seed=5):
+    """
+    Calibrated IMU samples of a slowly turning and rocking sensor
+    :returns: times (n), gyroscope, accelerometer, magnetometer (n x 3) arrays
+    """
+    rng = np.random.default_rng(seed)
+    times = np.arange(count) / rate
+    yaw = times * 0.2
+    gyr = np.column_stack((0.05 * np.sin(times), 0.05 * np.cos(times), np.full(count, 0.2)))
+    acc = np.column_stack((0.3 * np.sin(times), 0.3 * np.cos(times), np.full(count, 9.8)))
+    mag = np.column_stack((20 * np.cos(yaw), -20 * np.sin(yaw), np.full(count, 40.0)))
+    return (times, gyr + rng.normal(0, 0.01, gyr.shape), acc + rng.normal(0, 0.05, acc.shape),
+            mag + rng.normal(0, 0.5, mag.shape))
+
+
+def bench_ahrs(count=5000):
+    """Attitude update per sample (ahrs Madgwick as the previous reference) and batch reprocessing"""
+    from ahrs.filters import Madgwick
+
+    from imu.attitude import FILTERS, AttitudeFilter, reprocess
+
+    times, gyr, acc, mag = imu_samples(count)
+    reference = Madgwick()
+    q = np.array([1.0, 0.0, 0.0, 0.0])
+
+    def update_reference(gyr, acc, mag):
+        nonlocal q
+        q = reference.updateMARG(q, gyr, acc, mag, dt=0.01)
+
+    results = [summarize("ahrs_madgwick_update", measure(update_reference, zip(gyr, acc, mag)))]
+    samples = list(zip(times.tolist(), gyr.tolist(), acc.tolist(), mag.tolist()))
+    for name in FILTERS:
+        results.append(summarize("attitude_update", measure(AttitudeFilter(name).update, samples), filter=name))
+    for name in FILTERS:
+        start = time.perf_counter()
+        reprocess(times, gyr, acc, mag, name)
+        duration = time.perf_counter() - start
+        results.append({"name": "attitude_reprocess", "filter": name, "count": count,
+                        "samples_per_s": count / duration})
+    return results
+
+
+def bench_rotate(count=10000):
+    """Compute the bucket position from the antenna position and attitude"""
+    from rotate import get_new_position_rpy
+
+    rng = random.Random(3)
+    utm_zone = {"num": 31, "letter": "U"}
+    args = [(5.4155 + rng.uniform(-0.01, 0.01), 51.6995 + rng.uniform(-0.01, 0.01), 700, 2.5,
+             rng.uniform(-30, 30), rng.uniform(-30, 30), rng.uniform(-180, 180), utm_zone) for _ in range(count)]
+    return [summarize("get_new_position_rpy", measure(get_new_position_rpy, args))]
+
+
+def bench_config(count=10000):
+    """Read the config (cached, as done on every request) and after an invalidation (after a change)"""
+    import database
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.DB_PATH = os.path.join(directory, "benchmark.db")
+        database._connection = None
+        database.create_structure()
+        database.populate_config()
+        cached = measure(database.get_config, [()] * count)
+        uncached = []
+        for _ in range(count // 10):
+            database._config = None
+            uncached.extend(measure(database.get_config, [()]))
+        database._connection.close()
+        database._connection = None
+        database._config = None
+    return [summarize("get_config_cached", cached), summarize("get_config_uncached", uncached)]
+
+
+def sample_frame(index=0):
+    """Fused frame as published by the DataManager"""
+    from frame import Frame
+
+    return Frame(utm_num=31, utm_letter="U", ts=time.time(), lat=51.6995 + index * 1e-7, lng=5.4155, alt=697.5,
+                 _lat=51.69951, _lng=5.41551, _alt=700.0, speed=3.6, acc=0.012, fix=4, roll=1.2, pitch=-3.4,
+                 yaw=45.6, imu_time=time.time(), gps_seq=index, imu_seq=index, delta=0.0, distance=1.23,
+                 slope=0.01, alt_diff=-0.2)
+
+
+def bench_serialization(count=10000):
+    """
+    Serialize frames for the WebSocket clients: JSON (all fields and a subscription subset) and
+    binary (keyframes and the frames in between, without the unchanged slow fields)
+    """
+    from broadcast import BinaryStream, binary_fields, encode_binary, encode_frame
+
+    frames = [(sample_frame(index),) for index in range(count)]
+    fields = ("alt_diff", "distance", "lat", "lng", "slope")
+    indexes = binary_fields(None)
+    stream = BinaryStream()
+    previous = dict(zip(stream.slow, frames[0][0].slow_values()))
+    return [summarize("encode_frame", measure(encode_frame, frames), bytes=len(encode_frame(*frames[0]))),
+            summarize("encode_frame_fields", measure(encode_frame, [frame + (fields,) for frame in frames]),
+                      bytes=len(encode_frame(frames[0][0], fields))),
+            summarize("encode_binary_keyframe", measure(encode_binary, [frame + (indexes,) for frame in frames]),
+                      bytes=len(encode_binary(frames[0][0], indexes))),
+            summarize("encode_binary_delta",
+                      measure(encode_binary, [frame + (indexes, False, previous) for frame in frames]),
+                      bytes=len(encode_binary(frames[0][0], indexes, False, previous))),
+            summarize("binary_stream", measure(lambda frame: stream.encode(frame, {}), frames))]
+
+
+def bench_end_to_end(rates=(20, 0), seconds=5):
+    """
+    Feed NMEA epochs from a local TCP stand-in for the Reach and timestamp the matching frame at a
+    local WebSocket client; latency is measured from sending the sentence that completes an epoch
+    (the next RMC) to receiving its frame. With rate 0 epochs are sent as fast as the pipeline reads
+    them to find the sustainable rate (fused frames per second), latency is not measured then.
+    :param rates: epochs per second sent by the stand-in, 0 for as fast as possible
+    :param seconds: duration of every run
+    :returns: list of result dicts
+    """
+    logging.disable(logging.ERROR)  # sources complain about the stand-in closing the connection
+    try:
+        return [asyncio.run(end_to_end(rate, seconds)) for rate in rates]
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+async def end_to_end(rate, seconds):
+    """Run one end-to-end benchmark on a new event loop"""
+    import tornado.httpserver
+    import tornado.ioloop
+    import tornado.netutil
+    import tornado.web
+    import tornado.websocket
+
+    import broadcast
+    import database
+    import handlers
+    from reach.data import DataManager
+    from simulator import synthetic_chunks
+
+    chunks = synthetic_chunks("gps", seconds + 1 if rate else 60, rate or 20)
+    sent = {}
+    epochs = [0]
+    server = socket.create_server(("127.0.0.1", 0))
+    done = threading.Event()
+
+    def serve():
+        connection, _ = server.accept()
+        with connection:
+            start = time.perf_counter()
+            if not rate:
+                while not done.is_set():
+                    for _, data in chunks:
+                        connection.sendall(data)
+                    epochs[0] += len(chunks)
+                return
+            for index, (_, data) in enumerate(chunks):
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if index:
+                    sent[round(chunks[index - 1][0] * 100)] = time.perf_counter()
+                connection.sendall(data)
+                epochs[0] += 1
+            done.wait()
+
+    threading.Thread(target=serve, daemon=True).start()
+    config = database.Config({"gps_type": "Reach", "gps_host": "127.0.0.1", "gps_port": server.getsockname()[1],
+                              "imu_type": "none", "antenna_height": 2, "path": ""})
+    application = tornado.web.Application([(r"/data", handlers.DataHandler)])
+    application.data_queue = deque(maxlen=1)
+    application.broadcaster = broadcast.Broadcaster(tornado.ioloop.IOLoop.current())
+    fused = []
+    data_manager = DataManager(config, application.data_queue,
+                               listeners=[application.broadcaster.publish, fused.append])
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    http_server = tornado.httpserver.HTTPServer(application)
+    http_server.add_sockets(sockets)
+    client = await tornado.websocket.websocket_connect("ws://127.0.0.1:%d/data" % sockets[0].getsockname()[1])
+    await client.write_message(json.dumps({"rate": broadcast.MAX_RATE, "fields": ["ts"]}))
+    await asyncio.sleep(0.1)
+    data_manager.start()
+    latencies = []
+    frames = 0
+    start = time.perf_counter()
+    deadline = start + seconds + (1 if rate else 0)
+    try:
+        while time.perf_counter() < deadline:
+            try:
+                message = await asyncio.wait_for(client.read_message(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                break
+            received = time.perf_counter()
+            frames += 1
+            key = round(json.loads(message).get("ts", 0) * 100)
+            if rate and key in sent:
+                latencies.append(received - sent[key])
+    finally:
+        elapsed = time.perf_counter() - start
+        done.set()
+        client.close()
+        data_manager.stop()
+        http_server.stop()
+        server.close()
+    result = {"name": "end_to_end", "rate": rate, "epochs_per_s": epochs[0] / elapsed,
+              "fused_per_s": len(fused) / elapsed, "ws_frames_per_s": frames / elapsed}
+    if latencies:
+        result.update(summarize("end_to_end", latencies))
+        result.pop("ops_per_s")
+    return result
+
+
+def bench_segment_index(sizes=(10000, 100000, 1000000), queries=1000):
+    """
+    Compare grid index lookups with the linear scan done by getPolylineDistance
+    :param sizes: number of segments to benchmark
+    :param queries: number of index lookups per size
+    :returns: list of result dicts
+    """
+    results = []
+    for size in sizes:
+        eastings, northings = random_walk(size + 1)
+        altitudes = np.full(size + 1, 700.0)
+        start = time.perf_counter()
+        path = DesignPath(eastings, northings, altitudes, altitudes, {"num": 31, "letter": "U"})
+        build = time.perf_counter() - start
+        rng = np.random.default_rng(2)
+        indexes = rng.integers(0, size, queries)
+        points = list(zip((eastings[indexes] + rng.uniform(-20, 20, queries)).tolist(),
+                          (northings[indexes] + rng.uniform(-20, 20, queries)).tolist()))
+        start = time.perf_counter()
+        found = [path.evaluate_projected(x, y, 700)["distance"] for x, y in points]
+        indexed = (time.perf_counter() - start) / queries
+        linear_queries = max(3, 100000 // size)
+        start = time.perf_counter()
+        expected = [path.evaluate_projected(x, y, 700, linear=True)["distance"] for x, y in points[:linear_queries]]
+        linear = (time.perf_counter() - start) / linear_queries
+        if any(not math.isclose(a, b, abs_tol=1e-9) for a, b in zip(found, expected)):
+            raise AssertionError("index and linear scan results differ for %d segments" % size)
+        results.append({"name": "segment_index", "segments": size, "build_s": build,
+                        "index_us": indexed * 1e6, "linear_us": linear * 1e6, "speedup": linear / indexed})
+    return results
+
+
+def synthetic_tin(triangles, spacing=1.0, seed=3):
+    """
+    Generate a TIN surface: jittered square grid of points split in two triangles per square
+    :param triangles: approximate number of triangles
+    :param spacing: distance between grid points in meters
+    :param seed: random seed
+    :returns: vertices (easting, northing, elevation), triangles arrays
+    """
+    side = int(math.sqrt(triangles / 2)) + 1
+    rng = np.random.default_rng(seed)
+    cols, rows = np.meshgrid(np.arange(side), np.arange(side))
+    eastings = 600000 + spacing * (cols.ravel() + rng.uniform(-0.3, 0.3, side * side))
+    northings = 5700000 + spacing * (rows.ravel() + rng.uniform(-0.3, 0.3, side * side))
+    elevations = 700 + np.sin(eastings / 50) + np.cos(northings / 70)
+    corners = (rows[:-1, :-1] * side + cols[:-1, :-1]).ravel()
+    faces = np.concatenate((np.column_stack((corners, corners + 1, corners + side + 1)),
+                            np.column_stack((corners, corners + side + 1, corners + side))))
+    return np.column_stack((eastings, northings, elevations)), faces
+
+
+def bench_surface(sizes=(100000, 1000000), queries=10000):
+    """
+    Build, open and query TIN surfaces (memory-mapped arrays and triangle grid index) and a DEM
+    :param sizes: number of triangles to benchmark
+    :param queries: number of elevation lookups per surface
+    :returns: list of result dicts
+    """
+    results = []
+    rng = np.random.default_rng(4)
+    with tempfile.TemporaryDirectory() as root:
+        for size in sizes:
+            vertices, triangles = synthetic_tin(size)
+            directory = os.path.join(root, "tin%d" % size)
+            os.mkdir(directory)
+            start = time.perf_counter()
+            meta = surface.build_tin(vertices, triangles, directory)
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            tin = surface.Surface.from_id("tin%d" % size, root)
+            opened = time.perf_counter() - start
+            low, high = vertices[:, :2].min(axis=0) + 1, vertices[:, :2].max(axis=0) - 1
+            points = rng.uniform(low, high, (queries, 2)).tolist()
+            durations = measure(tin.elevation, points)
+            if any(value is None for value in map(tin.elevation, *zip(*points[:100]))):
+                raise AssertionError("point inside the TIN without elevation")
+            results.append(summarize("surface_tin", durations, triangles=meta["triangles"], build_s=build,
+                                     open_ms=opened * 1000))
+        side = int(math.sqrt(sizes[-1]))
+        directory = os.path.join(root, "grid")
+        os.mkdir(directory)
+        surface.build_grid(np.full((side, side), 700, dtype=np.float32), 600000, 5700000, 1.0, directory)
+        grid = surface.Surface.from_id("grid", root)
+        points = rng.uniform((600000, 5700000), (600000 + side - 1, 5700000 + side - 1), (queries, 2)).tolist()
+        results.append(summarize("surface_grid", measure(grid.elevation, points), cells=side * side))
+    return results
+
+
+BENCHMARKS = {
+    "parsers": bench_parsers,
+    "nmea": bench_nmea,
+    "ubx": bench_ubx,
+    "ahrs": bench_ahrs,
+    "rotate": bench_rotate,
+    "config": bench_config,
+    "serialization": bench_serialization,
+    "segment_index": bench_segment_index,
+    "surface": bench_surface,
+    "end_to_end": bench_end_to_end,
+}
+
+
+def main(names, as_json=False):
+    """
+    Run the selected benchmarks (all of them if no name is given) and print the results
+    :param names: benchmark names
+    :param as_json: print a single JSON document (with machine details) instead of one line per result
+    """
+    results = []
+    for name in names or BENCHMARKS:
+        for result in BENCHMARKS[name]():
+            results.append(result)
+            if not as_json:
+                print(", ".join("%s: %s" % (key, round(value, 3) if isinstance(value, float) else value)
+                                for key, value in result.items()))
+    if as_json:
+        print(json.dumps({"machine": platform.machine(), "python": platform.python_version(),
+                          "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                          "results": results}, indent=1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run openexcavator benchmarks")
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    parser.add_argument("names", nargs="*", choices=[[]] + list(BENCHMARKS), metavar="name",
+                        help="benchmarks to run: %s (all by default)" % ", ".join(BENCHMARKS))
+    args = parser.parse_args()
+    main(args.names, args.json)
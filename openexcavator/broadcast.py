@@ -0,0 +1,182 @@
+"""
+Fan out fused frames from the DataManager thread to the WebSocket clients.
+"""
+
+import json
+import logging
+import struct
+import threading
+import time
+
+from frame import FIELDS, SLOW_NAMES
+import metrics
+
+DEFAULT_RATE = 10  # frames per second sent to a client that did not ask for a rate
+MIN_RATE = 0.1
+MAX_RATE = 50
+
+# Binary frames: header (schema version, flags, presence bit mask over FIELDS) followed by the
+# values of the fields present, little endian, in FIELDS order
+SCHEMA_VERSION = 1
+FLAG_KEYFRAME = 1  # all the slow fields present, the client drops the values it kept
+BINARY_HEADER = "<BBQ"
+KEYFRAME_INTERVAL = 50  # binary frames between two keyframes
+_structs = {}
+
+
+def encode_frame(frame, fields=None):
+    """
+    Serialize a frame (or the subset of fields a client subscribed to) to JSON
+    :param frame: frame.Frame
+    :param fields: tuple of keys to keep, None for all of them
+    :returns: JSON string
+    """
+    return json.dumps(frame.as_dict(fields))
+
+
+def binary_schema():
+    """
+    Describe the binary frames, sent as a text message before the first binary frame
+    :returns: JSON string
+    """
+    return json.dumps({"schema": SCHEMA_VERSION, "fields": [[name, code] for name, code in FIELDS],
+                       "slow": list(SLOW_NAMES)})
+
+
+def binary_fields(fields):
+    """
+    Indexes in FIELDS of the fields of a subscription (utm_zone standing for utm_num and utm_letter)
+    :param fields: tuple of keys, None for all of them
+    :returns: tuple of indexes
+    """
+    if fields is None:
+        return tuple(range(len(FIELDS)))
+    names = set(fields)
+    if "utm_zone" in names:
+        names.update(("utm_num", "utm_letter"))
+    return tuple(index for index, (name, _) in enumerate(FIELDS) if name in names)
+
+
+def encode_binary(frame, indexes, keyframe=True, previous=None):
+    """
+    Serialize a frame to a binary message, fields without value are left out
+    :param frame: frame.Frame
+    :param indexes: indexes in FIELDS of the fields to send (see binary_fields)
+    :param keyframe: send all the slow fields, otherwise only the ones that differ from previous
+    :param previous: dict of slow field name: value last sent to the client
+    :returns: bytes
+    """
+    mask = 0
+    codes = [BINARY_HEADER]
+    values = []
+    for index in indexes:
+        name, code = FIELDS[index]
+        value = getattr(frame, name)
+        if value is None or (not keyframe and name in previous and previous[name] == value):
+            continue
+        if code in "Bq":
+            value = int(value)
+        elif code == "c":
+            value = value.encode()
+        mask |= 1 << index
+        codes.append(code)
+        values.append(value)
+    fmt = "".join(codes)
+    packer = _structs.get(fmt)
+    if packer is None:
+        packer = _structs[fmt] = struct.Struct(fmt)
+    return packer.pack(SCHEMA_VERSION, FLAG_KEYFRAME if keyframe else 0, mask, *values)
+
+
+class BinaryStream:
+    """
+    Binary encoding state of a client: slow fields are only sent in keyframes (the first frame,
+    then every KEYFRAME_INTERVAL frames) and when they change
+    """
+
+    def __init__(self, fields=None):
+        """
+        :param fields: tuple of keys the client subscribed to, None for all of them
+        """
+        self.indexes = binary_fields(fields)
+        self.slow = tuple(FIELDS[index][0] for index in self.indexes if FIELDS[index][0] in SLOW_NAMES)
+        self.previous = None  # slow values sent, None until the first keyframe
+        self.count = 0
+
+    def encode(self, frame, messages):
+        """
+        Serialize a frame for this client
+        :param frame: frame.Frame
+        :param messages: serialized frames for this broadcast, shared by the clients in the same state
+        :returns: bytes
+        """
+        current = tuple(getattr(frame, name) for name in self.slow)
+        previous = self.previous
+        # a slow field losing its value needs a keyframe, the client would keep the last one
+        keyframe = (previous is None or self.count >= KEYFRAME_INTERVAL
+                    or any(value is None and previous[name] is not None for name, value in zip(self.slow, current)))
+        key = ("binary", self.indexes, None if keyframe else tuple(previous.values()))
+        message = messages.get(key)
+        if message is None:
+            message = messages[key] = encode_binary(frame, self.indexes, keyframe, previous)
+        self.previous = dict(zip(self.slow, current))
+        self.count = 1 if keyframe else self.count + 1
+        return message
+
+
+class Broadcaster:
+    """
+    Hub between the DataManager thread and the IOLoop: publish() can be called from any thread,
+    frames are coalesced so the IOLoop only ever handles the newest one, serialized once per
+    distinct field subscription and written to every subscribed client
+    """
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        self.clients = set()
+        self._lock = threading.Lock()
+        self._pending = None
+        self._coalesced = metrics.DROPPED_FRAMES.labels("coalesced")
+        self._broadcasts = metrics.LOOP_ITERATIONS.labels("broadcaster")
+
+    def add(self, client):
+        """Register a client so it receives the next broadcasts"""
+        self.clients.add(client)
+
+    def remove(self, client):
+        """Unregister a client (closed connection)"""
+        self.clients.discard(client)
+
+    def publish(self, frame):
+        """
+        Schedule a frame for broadcast, safe to call from any thread
+        :param frame: frame.Frame, must not be modified after publishing
+        """
+        with self._lock:
+            scheduled = self._pending is not None
+            self._pending = frame
+            if scheduled:
+                self._coalesced.inc()
+        if not scheduled:
+            self.ioloop.add_callback(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            frame, self._pending = self._pending, None
+        if frame is not None:
+            self.broadcast(frame)
+
+    def broadcast(self, frame):
+        """
+        Send a frame to all clients, must run on the IOLoop
+        :param frame: frame.Frame
+        """
+        self._broadcasts.inc()
+        messages = {}
+        now = time.monotonic()
+        for client in list(self.clients):
+            try:
+                client.send_frame(frame, messages, now)
+            except Exception as exc:
+                logging.warning("cannot send frame to ws client %s: %s", client, exc)
+                self.remove(client)
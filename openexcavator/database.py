@@ -5,58 +5,280 @@ Created on Oct 19, 2017
 """
 
 import sqlite3
+import threading
+import time
+
+DB_PATH = "openexcavator.db"
+
+# types of config values (as exposed by Config attributes), other values are text
+CONFIG_TYPES = {
+    "gps_port": int,
+    "imu_port": int,
+    "ntrip_port": int,
+    "gps_baud_rate": int,
+    "gps_rate": int,
+    "start_altitude": float,
+    "stop_altitude": float,
+    "antenna_height": float,
+    "boom_length": float,
+    "stick_length": float,
+    "bucket_length": float,
+    "safety_depth": float,
+    "safety_height": float,
+    "output_port": int,
+    "design": int,
+}
+
+# values of the active design shown in the config (empty without active design, start_altitude and
+# stop_altitude then come from the config table)
+DESIGN_KEYS = ("design_name", "path", "path_etag", "surface", "start_altitude", "stop_altitude")
+DESIGN_ALTITUDES = ("start_altitude", "stop_altitude")
+
+_lock = threading.RLock()
+_connection = None
+_config = None
+
+
+class Config(dict):
+    """
+    Read-only snapshot of the config table and the active design: item access returns the stored
+    value, attribute access returns the value converted using CONFIG_TYPES (None if empty or invalid)
+    """
+
+    def __init__(self, rows):
+        super().__init__(rows)
+        for key, value in self.items():
+            converter = CONFIG_TYPES.get(key)
+            if converter:
+                try:
+                    value = converter(value)
+                except (TypeError, ValueError):
+                    value = None
+            self.__dict__[key] = value
+
+    def __setitem__(self, key, value):
+        raise TypeError("config is read-only, use database.set_config")
+
+    def __delitem__(self, key):
+        raise TypeError("config is read-only, use database.set_config")
+
+    def update(self, *args, **kwargs):
+        raise TypeError("config is read-only, use database.set_config")
+
+
+def get_connection():
+    """Return the long-lived (WAL mode) database connection, shared between threads"""
+    global _connection
+    with _lock:
+        if _connection is None:
+            _connection = sqlite3.connect(DB_PATH, check_same_thread=False)
+            _connection.execute("PRAGMA journal_mode=WAL")
+            _connection.execute("PRAGMA synchronous=NORMAL")
+        return _connection
 
 
 def get_config():
-    """Return dict of key-value from config table"""
-    conn = sqlite3.connect("openexcavator.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT key,value FROM config")
-    config = {}
-    rows = cursor.fetchall()
-    for row in rows:
-        config[row[0]] = row[1]
-    conn.close()
+    """
+    Return Config of key-value from config table with the values of the active design (DESIGN_KEYS),
+    only read again after set_config (or a design change) changed it
+    """
+    global _config
+    config = _config
+    if config is None:
+        with _lock:
+            if _config is None:
+                conn = get_connection()
+                rows = dict(conn.execute("SELECT key,value FROM config").fetchall())
+                design = None
+                if rows.get("design"):
+                    design = conn.execute("SELECT name,path,path_etag,surface,start_altitude,stop_altitude "
+                                          "FROM designs WHERE id=?", (rows["design"],)).fetchone()
+                if design is None:
+                    rows.update(design="", design_name="", path="", path_etag="", surface="")
+                else:
+                    rows.update(zip(DESIGN_KEYS, design))
+                _config = Config(rows)
+            config = _config
     return config
 
 
 def set_config(data):
     """
-    Store configuration using key-value pairs in config table
+    Store configuration using key-value pairs in config table (single transaction), start_altitude
+    and stop_altitude go to the active design if there is one, the other design values are read-only
     :param data: dict of key-value pairs
+    :returns: list of changed keys
     """
-    conn = sqlite3.connect("openexcavator.db")
-    cursor = conn.cursor()
-    config = get_config()
-    for key, value in config.items():
-        if key not in data or data[key] is None:
-            continue
-        if str(value) != str(data[key]):
-            cursor.execute("UPDATE config SET value=? WHERE key=?", (data[key], key))
-            conn.commit()
-    conn.close()
+    global _config
+    with _lock:
+        config = get_config()
+        changes = []
+        design_changes = []
+        for key, value in config.items():
+            if key not in data or data[key] is None or (key in DESIGN_KEYS and key not in DESIGN_ALTITUDES):
+                continue
+            if str(value) != str(data[key]):
+                if key in DESIGN_ALTITUDES and config.design:
+                    design_changes.append((key, data[key]))
+                else:
+                    changes.append((data[key], key))
+        if changes or design_changes:
+            conn = get_connection()
+            with conn:
+                conn.executemany("UPDATE config SET value=? WHERE key=?", changes)
+                for key, value in design_changes:
+                    conn.execute("UPDATE designs SET %s=? WHERE id=?" % key, (value, config.design))
+            _config = None
+    return [key for _, key in changes] + [key for key, _ in design_changes]
+
+
+def get_designs():
+    """
+    List the stored designs (without their geometry)
+    :returns: list of dicts with id, name, start_altitude, stop_altitude, path (True if the design has
+        one), surface (surface id, empty if none) and utm_num
+    """
+    cursor = get_connection().execute("SELECT id,name,start_altitude,stop_altitude,path_etag!='',surface,utm_num "
+                                      "FROM designs ORDER BY name")
+    return [dict(zip(("id", "name", "start_altitude", "stop_altitude", "path", "surface", "utm_num"),
+                     row[:4] + (bool(row[4]),) + row[5:])) for row in cursor.fetchall()]
+
+
+def get_design_path(design_id):
+    """
+    Path artifact of a design, as stored when it was added
+    :param design_id: design id
+    :returns: (JSON bytes, gzip compressed JSON bytes) tuple, None if the design has no path
+    """
+    row = get_connection().execute("SELECT path,path_gzip FROM designs WHERE id=? AND path_etag!=''",
+                                   (design_id,)).fetchone()
+    return (row[0].encode(), row[1]) if row else None
+
+
+def add_design(name, start_altitude, stop_altitude, path="", path_gzip=None, path_etag="", surface="",
+               bounds=None, utm_num=None, activate=True):
+    """
+    Store a design with its precomputed geometry (single transaction)
+    :param name: design name, unique
+    :param start_altitude: desired altitude at the first path point
+    :param stop_altitude: desired altitude at the last path point
+    :param path: path artifact JSON (see design.preprocess_path), empty for a design without path
+    :param path_gzip: gzip compressed path artifact, as served
+    :param path_etag: ETag of the path artifact
+    :param surface: surface id (see surface.import_surface), empty for a design without surface
+    :param bounds: (min easting, min northing, max easting, max northing) of the path and surface
+    :param utm_num: UTM zone number of the design coordinates, None for any zone
+    :param activate: make it the active design
+    :returns: design id
+    """
+    global _config
+    with _lock:
+        conn = get_connection()
+        try:
+            with conn:
+                cursor = conn.execute("INSERT INTO designs(name, start_altitude, stop_altitude, path, path_gzip, "
+                                      "path_etag, surface, utm_num, created) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                      (name, start_altitude, stop_altitude, path, path_gzip, path_etag, surface,
+                                       utm_num, time.time()))
+                design_id = cursor.lastrowid
+                if bounds:
+                    conn.execute("INSERT INTO design_bounds(id, min_x, max_x, min_y, max_y) VALUES(?, ?, ?, ?, ?)",
+                                 (design_id, bounds[0], bounds[2], bounds[1], bounds[3]))
+                if activate:
+                    conn.execute("UPDATE config SET value=? WHERE key='design'", (design_id,))
+                # designs supersede the path and surface stored in config before the designs table
+                conn.execute("UPDATE config SET value='' WHERE key IN ('path', 'surface')")
+        except sqlite3.IntegrityError:
+            raise ValueError("a design named %s already exists" % name)
+        _config = None
+    return design_id
+
+
+def delete_design(design_id):
+    """
+    Delete a design (no design is active afterwards if it was the active one)
+    :param design_id: design id
+    :returns: True if the design existed
+    """
+    global _config
+    with _lock:
+        conn = get_connection()
+        with conn:
+            deleted = conn.execute("DELETE FROM designs WHERE id=?", (design_id,)).rowcount
+            conn.execute("DELETE FROM design_bounds WHERE id=?", (design_id,))
+            conn.execute("UPDATE config SET value='' WHERE key='design' AND value=?", (str(design_id),))
+        _config = None
+    return deleted > 0
+
+
+def nearest_design(easting, northing, utm_num, radius):
+    """
+    Find the design nearest to a point from the bounding boxes index
+    :param easting: point easting
+    :param northing: point northing
+    :param utm_num: UTM zone number of the point, designs of other zones are left out
+    :param radius: search distance in meters
+    :returns: (design id, distance to its bounding box) tuple, None if no design is within radius
+    """
+    row = get_connection().execute(
+        "SELECT bounds.id, max(min_x - :x, :x - max_x, 0) * max(min_x - :x, :x - max_x, 0) + "
+        "max(min_y - :y, :y - max_y, 0) * max(min_y - :y, :y - max_y, 0) AS dist_sq "
+        "FROM design_bounds AS bounds JOIN designs ON designs.id = bounds.id "
+        "WHERE max_x >= :x - :radius AND min_x <= :x + :radius AND max_y >= :y - :radius AND min_y <= :y + :radius "
+        "AND (utm_num IS NULL OR utm_num = :zone) ORDER BY dist_sq, bounds.id LIMIT 1",
+        {"x": easting, "y": northing, "radius": radius, "zone": utm_num}).fetchone()
+    if row is None or row[1] > radius * radius:
+        return None
+    return row[0], row[1] ** 0.5
 
 
 def create_structure():
     """Create database and config table if it does not exist"""
-    conn = sqlite3.connect("openexcavator.db")
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("""CREATE TABLE IF NOT EXISTS config(id INTEGER PRIMARY KEY AUTOINCREMENT,
                     key TEXT, value TEXT,CONSTRAINT config_unique_key UNIQUE(key))""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS designs(id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT, start_altitude REAL, stop_altitude REAL, path TEXT, path_gzip BLOB,
+                    path_etag TEXT, surface TEXT, utm_num INTEGER, created REAL,
+                    CONSTRAINT designs_unique_name UNIQUE(name))""")
+    # R*Tree over the design bounding boxes (UTM) for the nearest design lookup
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS design_bounds USING rtree(id, min_x, max_x, min_y, max_y)")
+    cursor.execute("INSERT OR IGNORE INTO config(key, value) VALUES('design', '')")
     conn.commit()
-    conn.close()
+
+
+def legacy_design():
+    """
+    Design path and surface stored in the config table by versions without designs
+    :returns: dict with path, surface, start_altitude and stop_altitude, None if there is no such design
+    """
+    rows = dict(get_connection().execute("SELECT key,value FROM config WHERE key IN "
+                                         "('path', 'surface', 'start_altitude', 'stop_altitude')").fetchall())
+    if not rows.get("path") and not rows.get("surface"):
+        return None
+    return rows
 
 
 def populate_config():
-    """Populate configuration table with default values"""
-    conn = sqlite3.connect("openexcavator.db")
-    query = "INSERT INTO config(key, value) VALUES(?, ?)"
+    """
+    Populate configuration table with default values, only the missing keys are inserted (also run at
+    startup so databases created by older versions get the keys added since)
+    :returns: list of inserted keys
+    """
+    global _config
+    conn = get_connection()
+    query = "INSERT OR IGNORE INTO config(key, value) VALUES(?, ?)"
     data = [
         ("wifi_ssid", ""),
         ("wifi_psk", ""),
         ("gps_host", "127.0.0.1"),
         ("gps_port", "9000"),
         ("gps_type", "UBX"),
+        ("gps_serial_port", "/dev/ttyACM0"),
+        ("gps_baud_rate", "115200"),
+        ("gps_protocol", "NMEA"),
+        ("gps_rate", "10"),
         ("ntrip_host", ""),
         ("ntrip_port", ""),
         ("ntrip_mountpoint", ""),
@@ -65,22 +287,24 @@ def populate_config():
         ("imu_host", "127.0.0.1"),
         ("imu_port", "7000"),
         ("imu_type", "FXOS8700+FXAS21001"),
+        ("imu_filter", "Madgwick"),
         ("start_altitude", "700"),
         ("stop_altitude", "800"),
         ("antenna_height", "10"),
+        ("boom_length", "5.7"),
+        ("stick_length", "2.9"),
+        ("bucket_length", "1.5"),
         ("safety_depth", "690"),
         ("safety_height", "810"),
         ("output_port", "3000"),
+        ("surface", ""),
         ("path", """{"type":"FeatureCollection","crs":{"type":"name","properties":{"name":"urn:ogc:def:crs:OGC:1.3:CRS84"}},"features":[{"type":"Feature","properties":{"name":"start","solution status":1},"geometry":{"type":"Point","coordinates":[5.415527224859864,51.6995130221744,0.2053654933964033]}},{"type":"Feature","properties":{"name":"stop","solution status":1},"geometry":{"type":"Point","coordinates":[5.415535259001904,51.69950088928952,1.4064961066623827]}}]}""")
     ]
-    cursor = conn.cursor()
-    for item in data:
-        try:
-            cursor.execute(query, item)
-            conn.commit()
-        except sqlite3.IntegrityError as exc:
-            print("cannot insert items %s: %s" % (item[0], exc))
-    conn.close()
+    with _lock, conn:
+        existing = {row[0] for row in conn.execute("SELECT key FROM config")}
+        conn.executemany(query, data)
+        _config = None
+    return [key for key, _ in data if key not in existing]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,396 @@
+"""
+Design path projected to UTM once, with a grid index over its segments so the bucket
+distance / slope / altitude difference can be computed for every frame on the server.
+Uploaded GeoJSON paths are preprocessed once into a path artifact (projected, simplified
+points) that is stored with its design, loaded by DesignPath and served to the pages from /path.
+"""
+
+from collections import OrderedDict
+import gzip
+import hashlib
+import json
+import logging
+import math
+
+import numpy as np
+import utm
+
+import settings
+
+ARTIFACT_VERSION = 1
+PATH_CACHE_SIZE = 8  # DesignPath instances kept for switching back to a design without building its index
+
+
+class SegmentIndex:
+    """
+    Uniform grid over the segments of a polyline; every segment is registered in the cells its
+    points (sampled every half cell) fall in, cells are stored as sorted CSR arrays
+    """
+
+    def __init__(self, xs, ys, cell_size=None):
+        """
+        :param xs: vertex eastings (segment i goes from vertex i to vertex i + 1)
+        :param ys: vertex northings
+        :param cell_size: grid cell size in meters, the mean segment length if not supplied
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        self.x = xs.tolist()
+        self.y = ys.tolist()
+        self.count = max(len(xs) - 1, 0)
+        if self.count == 0:
+            raise ValueError("at least 2 points are needed for a path")
+        dx = np.diff(xs)
+        dy = np.diff(ys)
+        lengths = np.hypot(dx, dy)
+        if cell_size is None:
+            cell_size = float(lengths.mean())
+        self.cell_size = max(cell_size, 0.1)
+        self.min_x = float(xs.min())
+        self.min_y = float(ys.min())
+        self.nx = int((xs.max() - self.min_x) // self.cell_size) + 1
+        self.ny = int((ys.max() - self.min_y) // self.cell_size) + 1
+        # sample every segment at least every half cell (both ends included, so repeated vertices
+        # giving zero-length segments get 2 samples at their point instead of a 0 / 0 ratio)
+        samples = np.maximum(np.ceil(lengths / (self.cell_size / 2)).astype(np.int64), 1) + 1
+        segment_ids = np.repeat(np.arange(self.count, dtype=np.int64), samples)
+        offsets = np.cumsum(samples) - samples
+        steps = np.arange(len(segment_ids), dtype=np.int64) - offsets[segment_ids]
+        ratio = steps / (samples[segment_ids] - 1)
+        cell_x = ((xs[:-1][segment_ids] + ratio * dx[segment_ids] - self.min_x) // self.cell_size)
+        cell_y = ((ys[:-1][segment_ids] + ratio * dy[segment_ids] - self.min_y) // self.cell_size)
+        cell_x = np.clip(cell_x.astype(np.int64), 0, self.nx - 1)
+        cell_y = np.clip(cell_y.astype(np.int64), 0, self.ny - 1)
+        pairs = np.unique((cell_x * self.ny + cell_y) * self.count + segment_ids)
+        keys = pairs // self.count
+        self.segments = (pairs % self.count).tolist()
+        cell_keys, starts = np.unique(keys, return_index=True)
+        ends = np.append(starts[1:], len(keys))
+        self.cells = dict(zip(cell_keys.tolist(), zip(starts.tolist(), ends.tolist())))
+
+    def segment_distance(self, index, x, y):
+        """
+        Horizontal distance from a point to a segment
+        :param index: segment index
+        :param x: point easting
+        :param y: point northing
+        :returns: distance in meters
+        """
+        x1 = self.x[index]
+        y1 = self.y[index]
+        dx = self.x[index + 1] - x1
+        dy = self.y[index + 1] - y1
+        len_sq = dx * dx + dy * dy
+        param = ((x - x1) * dx + (y - y1) * dy) / len_sq if len_sq else -1
+        if param < 0:
+            param = 0
+        elif param > 1:
+            param = 1
+        return math.hypot(x1 + param * dx - x, y1 + param * dy - y)
+
+    def _ring(self, cell_x, cell_y, radius):
+        """Yield the keys of the grid cells at Chebyshev distance radius from a cell"""
+        if radius == 0:
+            yield cell_x * self.ny + cell_y
+            return
+        x_from = max(cell_x - radius, 0)
+        x_to = min(cell_x + radius, self.nx - 1)
+        for row in (cell_y - radius, cell_y + radius):
+            if 0 <= row < self.ny:
+                for col in range(x_from, x_to + 1):
+                    yield col * self.ny + row
+        y_from = max(cell_y - radius + 1, 0)
+        y_to = min(cell_y + radius - 1, self.ny - 1)
+        for col in (cell_x - radius, cell_x + radius):
+            if 0 <= col < self.nx:
+                for row in range(y_from, y_to + 1):
+                    yield col * self.ny + row
+
+    def nearest(self, x, y):
+        """
+        Find the nearest segment to a point, ties go to the lowest segment index
+        :param x: point easting
+        :param y: point northing
+        :returns: segment index, horizontal distance
+        """
+        cell_x = int((x - self.min_x) // self.cell_size)
+        cell_y = int((y - self.min_y) // self.cell_size)
+        # cells closer than the grid itself are empty, start from the first ring touching it
+        radius = max(0, cell_x - self.nx + 1, -cell_x, cell_y - self.ny + 1, -cell_y)
+        last = max(cell_x, self.nx - 1 - cell_x, cell_y, self.ny - 1 - cell_y)
+        best_index = -1
+        best_dist = math.inf
+        while radius <= last:
+            for key in self._ring(cell_x, cell_y, radius):
+                span = self.cells.get(key)
+                if span is None:
+                    continue
+                for index in self.segments[span[0]:span[1]]:
+                    dist = self.segment_distance(index, x, y)
+                    if dist < best_dist or (dist == best_dist and index < best_index):
+                        best_dist = dist
+                        best_index = index
+            # a segment that was not found crosses no cell within radius - 1 (sampling is half a cell)
+            if best_dist <= (radius - 1) * self.cell_size:
+                break
+            radius += 1
+        return best_index, best_dist
+
+    def nearest_linear(self, x, y):
+        """
+        Reference linear scan over all segments (what getPolylineDistance does in common.js)
+        :param x: point easting
+        :param y: point northing
+        :returns: segment index, horizontal distance
+        """
+        best_index = -1
+        best_dist = math.inf
+        for index in range(self.count):
+            dist = self.segment_distance(index, x, y)
+            if dist < best_dist:
+                best_dist = dist
+                best_index = index
+        return best_index, best_dist
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification of a polyline
+    :param points: array of vertices (n x dimensions)
+    :param tolerance: largest distance of a removed vertex to the simplified polyline
+    :returns: boolean array, True for the vertices kept (always the first and last ones)
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        direction = points[last] - start
+        offsets = points[first + 1:last] - start
+        len_sq = float(direction @ direction)
+        if len_sq:
+            ratio = np.clip(offsets @ direction / len_sq, 0, 1)
+            offsets = offsets - ratio[:, None] * direction
+        distances = np.einsum("ij,ij->i", offsets, offsets)
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance * tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return keep
+
+
+def preprocess_path(data, tolerance=None):
+    """
+    Parse an uploaded GeoJSON path into the path artifact: Point (also MultiPoint, LineString)
+    features in order, projected in the UTM zone of the first point and simplified. Every point
+    keeps its position along the original path (fraction of the point count) that the desired
+    altitude is interpolated on, so simplification does not change the design.
+    :param data: GeoJSON string or bytes
+    :param tolerance: simplification tolerance in meters, settings.PATH_TOLERANCE if not supplied
+    :returns: dict with version, utm_zone, source_points and points ([lng, lat, alt or None, easting,
+        northing, fraction] lists)
+    """
+    try:
+        geojson = json.loads(data)
+    except ValueError:
+        raise ValueError("JSON data is not valid")
+    if not isinstance(geojson, dict) or "features" not in geojson:
+        raise ValueError("missing features from GeoJSON")
+    coords = []
+    for feature in geojson["features"]:
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Point":
+            coords.append(geometry["coordinates"])
+        elif geometry.get("type") in ("MultiPoint", "LineString"):
+            coords.extend(geometry["coordinates"])
+    if len(coords) < 2:
+        raise ValueError("at least 2 points are needed for a path")
+    lng = np.array([coord[0] for coord in coords], dtype=float)
+    lat = np.array([coord[1] for coord in coords], dtype=float)
+    alt = np.array([coord[2] if len(coord) > 2 and coord[2] is not None else np.nan for coord in coords])
+    proj_coords = utm.from_latlon(lat, lng)
+    eastings, northings = proj_coords[0], proj_coords[1]
+    fractions = np.arange(len(coords)) / (len(coords) - 1)
+    # simplified in easting, northing, altitude and position along the path (in meters) so the surveyed
+    # and desired altitudes of the removed points stay within tolerance too
+    length = float(np.hypot(np.diff(eastings), np.diff(northings)).sum())
+    keep = simplify(np.column_stack((eastings, northings, np.nan_to_num(alt), fractions * length)),
+                    settings.PATH_TOLERANCE if tolerance is None else tolerance)
+    points = [[round(values[0], 9), round(values[1], 9), None if math.isnan(values[2]) else round(values[2], 4),
+               round(values[3], 3), round(values[4], 3), round(values[5], 9)]
+              for values in zip(*(column[keep].tolist() for column in (lng, lat, alt, eastings, northings,
+                                                                       fractions)))]
+    return {"version": ARTIFACT_VERSION, "utm_zone": {"num": proj_coords[2], "letter": proj_coords[3]},
+            "source_points": len(coords), "points": points}
+
+
+def load_artifact(path):
+    """
+    Load the path artifact stored in config, paths stored before artifacts (GeoJSON) are preprocessed
+    :param path: artifact JSON or GeoJSON string
+    :returns: artifact dict
+    """
+    artifact = json.loads(path)
+    if isinstance(artifact, dict) and "features" in artifact:
+        return preprocess_path(path)
+    if not isinstance(artifact, dict) or artifact.get("version") != ARTIFACT_VERSION:
+        raise ValueError("unsupported path artifact")
+    return artifact
+
+
+class PathArtifact:
+    """Path artifact as served on /path: JSON body, its gzip compression and ETag"""
+
+    def __init__(self, artifact):
+        """
+        :param artifact: artifact dict
+        """
+        self.body = json.dumps(artifact, separators=(",", ":")).encode()
+        self.gzipped = gzip.compress(self.body, 9, mtime=0)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+def design_record(artifact=None, surface=None):
+    """
+    Precompute what is stored with a design: path artifact as served and bounding box of the path
+    and surface for the nearest design lookup
+    :param artifact: path artifact dict (see preprocess_path), None for a design without path
+    :param surface: surface.Surface instance, None for a design without surface
+    :returns: dict of path, path_gzip, path_etag, surface, bounds and utm_num (database.add_design arguments)
+    """
+    record = {"path": "", "path_gzip": None, "path_etag": "", "surface": "", "bounds": None, "utm_num": None}
+    boxes = []
+    if artifact is not None:
+        served = PathArtifact(artifact)
+        record.update(path=served.body.decode(), path_gzip=served.gzipped, path_etag=served.etag,
+                      utm_num=artifact["utm_zone"]["num"])
+        eastings = [point[3] for point in artifact["points"]]
+        northings = [point[4] for point in artifact["points"]]
+        boxes.append((min(eastings), min(northings), max(eastings), max(northings)))
+    if surface is not None:
+        record["surface"] = surface.surface_id
+        record["utm_num"] = record["utm_num"] or surface.zone_num
+        boxes.append(surface.bounds())
+    if boxes:
+        record["bounds"] = (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                            max(box[2] for box in boxes), max(box[3] for box in boxes))
+    return record
+
+
+_paths = OrderedDict()  # (path ETag, start altitude, stop altitude): DesignPath, most recently used last
+
+
+class DesignPath:
+    """
+    Design path (sequence of points) with desired altitudes interpolated between
+    start_altitude and stop_altitude, projected in a single UTM zone
+    """
+
+    def __init__(self, eastings, northings, altitudes, desired_altitudes, utm_zone):
+        """
+        :param eastings: vertex eastings
+        :param northings: vertex northings
+        :param altitudes: vertex altitudes (as surveyed)
+        :param desired_altitudes: vertex design altitudes
+        :param utm_zone: dict with the UTM zone num and letter used for projection
+        """
+        self.index = SegmentIndex(eastings, northings)
+        self.altitudes = [float(value) for value in altitudes]
+        self.desired_altitudes = [float(value) for value in desired_altitudes]
+        self.utm_zone = utm_zone
+
+    @classmethod
+    def from_artifact(cls, artifact, start_altitude, stop_altitude):
+        """
+        Build the design from a path artifact (already projected)
+        :param artifact: artifact dict (see preprocess_path)
+        :param start_altitude: desired altitude at the first point
+        :param stop_altitude: desired altitude at the last point
+        :returns: DesignPath instance
+        """
+        points = artifact["points"]
+        desired = [start_altitude + point[5] * (stop_altitude - start_altitude) for point in points]
+        altitudes = [point[2] if point[2] is not None else desired[index] for index, point in enumerate(points)]
+        return cls([point[3] for point in points], [point[4] for point in points], altitudes, desired,
+                   artifact["utm_zone"])
+
+    @classmethod
+    def from_geojson(cls, path, start_altitude, stop_altitude, tolerance=0.0):
+        """
+        Build the design from a GeoJSON path (Point features, in order)
+        :param path: GeoJSON string or bytes
+        :param start_altitude: desired altitude at the first point
+        :param stop_altitude: desired altitude at the last point
+        :param tolerance: simplification tolerance in meters, none by default
+        :returns: DesignPath instance
+        """
+        return cls.from_artifact(preprocess_path(path, tolerance), start_altitude, stop_altitude)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the design from config values (the active design), None if the path is missing or
+        invalid; the last PATH_CACHE_SIZE designs are kept so switching back to one is immediate
+        :param config: config dict
+        :returns: DesignPath instance or None
+        """
+        if not config.get("path"):
+            return None
+        key = (config.get("path_etag"), config.get("start_altitude"), config.get("stop_altitude"))
+        path = _paths.get(key) if key[0] else None
+        if path is None:
+            try:
+                path = cls.from_artifact(load_artifact(config["path"]), float(config["start_altitude"]),
+                                         float(config["stop_altitude"]))
+            except (KeyError, TypeError, ValueError) as exc:
+                logging.warning("cannot load design path: %s", exc)
+                return None
+            if key[0]:
+                _paths[key] = path
+                while len(_paths) > PATH_CACHE_SIZE:
+                    _paths.popitem(last=False)
+        else:
+            _paths.move_to_end(key)
+        return path
+
+    def evaluate(self, lat, lng, alt, linear=False):
+        """
+        Compute horizontal distance to the path, slope of the nearest segment and
+        altitude difference to the (inverse distance weighted) design altitude
+        :param lat: bucket latitude
+        :param lng: bucket longitude
+        :param alt: bucket altitude
+        :param linear: use the linear scan instead of the index (for reference)
+        :returns: dict with distance, slope, alt_diff
+        """
+        proj_coords = utm.from_latlon(lat, lng, self.utm_zone["num"])
+        return self.evaluate_projected(proj_coords[0], proj_coords[1], alt, linear)
+
+    def evaluate_projected(self, easting, northing, alt, linear=False):
+        """Same as evaluate for a point already projected in the design UTM zone"""
+        if linear:
+            index, dist = self.index.nearest_linear(easting, northing)
+        else:
+            index, dist = self.index.nearest(easting, northing)
+        x1 = self.index.x[index]
+        y1 = self.index.y[index]
+        x2 = self.index.x[index + 1]
+        y2 = self.index.y[index + 1]
+        desired1 = self.desired_altitudes[index]
+        desired2 = self.desired_altitudes[index + 1]
+        run = math.hypot(x2 - x1, y2 - y1)
+        slope = (desired2 - desired1) / run if run else 0
+        dist1 = math.sqrt((x1 - easting) ** 2 + (y1 - northing) ** 2 + (self.altitudes[index] - alt) ** 2)
+        dist2 = math.sqrt((x2 - easting) ** 2 + (y2 - northing) ** 2 + (self.altitudes[index + 1] - alt) ** 2)
+        if dist1 == 0:
+            design_alt = desired1
+        elif dist2 == 0:
+            design_alt = desired2
+        else:
+            design_alt = (desired1 / dist1 + desired2 / dist2) / (1 / dist1 + 1 / dist2)
+        return {"distance": dist, "slope": slope, "alt_diff": alt - design_alt}
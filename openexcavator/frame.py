@@ -0,0 +1,101 @@
+"""
+Fused frame: fixed layout record (one slot per field) filled once by the DataManager per GNSS
+epoch (or IMU sample) and read by the web handlers, the broadcaster and the recorder.
+"""
+
+# Fields in binary encoding order (name, struct format), missing values are None; the slow ones
+# rarely change (UTM zone, fix quality, accuracy) and are only sent to binary clients when they do
+FAST_FIELDS = (
+    ("ts", "d"),  # GNSS epoch time (seconds since epoch)
+    ("lat", "d"),
+    ("lng", "d"),
+    ("alt", "d"),
+    ("_lat", "d"),  # antenna position when lat, lng, alt are the bucket one
+    ("_lng", "d"),
+    ("_alt", "d"),
+    ("imu_time", "d"),
+    ("roll", "f"),
+    ("pitch", "f"),
+    ("yaw", "f"),
+    ("boom_pitch", "f"),
+    ("stick_pitch", "f"),
+    ("bucket_pitch", "f"),
+    ("delta", "f"),
+    ("speed", "f"),
+    ("track", "f"),
+    ("distance", "f"),
+    ("slope", "f"),
+    ("alt_diff", "f"),
+    ("surface_alt", "d"),  # design surface elevation under the bucket
+    ("cut_fill", "f"),  # bucket altitude above the design surface
+    ("rtcm_age", "f"),
+    ("rtcm_bps", "f"),
+    ("gps_seq", "q"),
+    ("imu_seq", "q"),
+)
+SLOW_FIELDS = (
+    ("utm_num", "B"),
+    ("utm_letter", "c"),
+    ("fix", "B"),
+    ("sats", "B"),
+    ("acc", "f"),
+    ("hacc", "f"),
+    ("vacc", "f"),
+    ("pdop", "f"),
+    ("hdop", "f"),
+    ("vdop", "f"),
+)
+FIELDS = FAST_FIELDS + SLOW_FIELDS
+FIELD_NAMES = tuple(name for name, _ in FIELDS)
+SLOW_NAMES = tuple(name for name, _ in SLOW_FIELDS)
+SLOTS = frozenset(FIELD_NAMES)
+JSON_NAMES = ("utm_zone",) + tuple(name for name in FIELD_NAMES if not name.startswith("utm_"))
+
+
+class Frame:
+    """Fused data of a GNSS epoch and the IMU attitude at its time"""
+
+    __slots__ = FIELD_NAMES + ("fused",)
+
+    def __init__(self, **values):
+        for name in FIELD_NAMES:
+            setattr(self, name, None)
+        self.fused = None  # monotonic time the frame was published, not sent to the clients
+        self.update(values)
+
+    def update(self, values):
+        """
+        Copy the values of the frame fields from a source data dict (other keys are ignored)
+        :param values: dict as returned by the GPS/IMU handlers
+        """
+        for name, value in values.items():
+            if name in SLOTS:
+                setattr(self, name, value)
+
+    def get(self, name, default=None):
+        """Value of a field, default if missing (dict like access for the readers of former frame dicts)"""
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def __contains__(self, name):
+        return getattr(self, name, None) is not None
+
+    def slow_values(self):
+        """Values of the SLOW_FIELDS"""
+        return tuple(getattr(self, name) for name in SLOW_NAMES)
+
+    def as_dict(self, fields=None):
+        """
+        Convert to the JSON frame layout: missing fields left out, utm_num and utm_letter as utm_zone
+        :param fields: keys to keep, None for all of them
+        :returns: dict
+        """
+        data = {}
+        for name in JSON_NAMES if fields is None else fields:
+            if name == "utm_zone":
+                data[name] = {"num": self.utm_num, "letter": self.utm_letter}
+            elif name in SLOTS:
+                value = getattr(self, name)
+                if value is not None:
+                    data[name] = value
+        return data
@@ -1,23 +1,108 @@
 from collections import deque
-import datetime
 import logging
-from queue import Queue
+import time
 from typing import Callable
 
+import settings
 from gps.ntrip_client import NTRIPClient
+from gps.rtcm import CorrectionQueue
+from utils import handover, start_source
+
+# Config keys used by each GPS type, the source is rebuilt when one of them changes (the UBX
+# protocol and rate are applied to the running reader).
+SOURCE_KEYS = {
+    "Reach": ("gps_host", "gps_port"),
+    "Simulator": ("gps_host", "gps_port", "gps_protocol"),
+    "FIXED": (),
+    "UBX": ("gps_serial_port", "gps_baud_rate"),
+}
 
 
 class GPSHandler:
-    def __init__(self, config):
+    def __init__(self, config, notify=None):
+        """
+        :param config: config dict.
+        :param notify: called (without arguments) by the sources after publishing new data.
+        """
         self.threads = []
+        self.old_threads = []  # threads of the replaced source, serving data until the new one does
+        self.notify = notify
+        self.ntrip_client = None
+        self.__old_func = None
+        self.__data_func = dict  # the NTRIP client can ask for the position before the source is built
+        self.source_key = self.get_source_key(config)
         self.__data_func = self.__parse_data_func(config)
 
+    @staticmethod
+    def get_source_key(config):
+        """
+        Get the values identifying the GPS source.
+        :returns: tuple with gps_type and the config values used by that type.
+        """
+        gps_type = config["gps_type"]
+        return (gps_type,) + tuple(config[key] for key in SOURCE_KEYS.get(gps_type, ()))
+
+    def update_config(self, config):
+        """
+        Apply a new config in place: NTRIP settings go to the running client, the UBX protocol and
+        rate to the running reader and the GPS source is only rebuilt if its parameters changed, the
+        old one serves data until the new one does (a UBX reader replaced by another one is stopped
+        first, both would read the receiver, and its NTRIP client is kept).
+        :returns: True if the GPS source was rebuilt.
+        """
+        if self.ntrip_client:
+            self.ntrip_client.update_config(config)
+        source_key = self.get_source_key(config)
+        if source_key == self.source_key:
+            for thread in self.threads:
+                if hasattr(thread, "set_output"):
+                    thread.set_output(config["gps_protocol"], config.gps_rate or 10)
+            return False
+        logging.info("GPS source changed to %s", source_key)
+        ntrip_client = self.ntrip_client if source_key[0] == self.source_key[0] == "UBX" else None
+        if self.__old_func is not None:  # the previous replacement never returned data, drop it and keep the old source
+            for thread in self.threads:
+                if thread is not ntrip_client:
+                    thread.stop()
+            old_func = self.__old_func
+        else:
+            self.old_threads = [thread for thread in self.threads if thread is not ntrip_client]
+            old_func = self.__data_func
+        if ntrip_client:
+            from gps.ubx import UBX
+
+            for thread in self.old_threads:
+                if isinstance(thread, UBX):
+                    thread.stop()
+        self.threads = [ntrip_client] if ntrip_client else []
+        self.ntrip_client = ntrip_client
+        self.source_key = source_key
+        new_func = self.__parse_data_func(config)
+
+        def switch():
+            if self.__data_func is not data_func:  # replaced by a newer config meanwhile
+                return
+            self.__data_func = new_func
+            self.__old_func = None
+            old_threads, self.old_threads = self.old_threads, []
+            for thread in old_threads:
+                thread.stop()
+            logging.info("GPS source switched, old threads stopped")
+
+        data_func = handover(old_func, new_func, switch)
+        self.__old_func = old_func
+        self.__data_func = data_func
+        return True
+
     def get_data(self):
         """
         Get the current GPS data.
-        :returns: dict with: ts, lat, lng, speed, acc, alt, fix
+        :returns: dict with: ts, lat, lng, speed, acc, alt, fix, seq (empty if no data yet)
         """
-        return self.__data_func()
+        try:
+            return self.__data_func()
+        except IndexError:
+            return {}
 
     def __parse_data_func(self, config) -> Callable:
         """
@@ -28,21 +113,40 @@ class GPSHandler:
             from reach.gps import ReachGPS
 
             gps_queue = deque(maxlen=1)
-            reach_gps = ReachGPS(config["gps_host"], int(config["gps_port"]), gps_queue)
-            reach_gps.start()
+            reach_gps = ReachGPS(config["gps_host"], int(config["gps_port"]), gps_queue, self.notify)
+            start_source(reach_gps)
             self.threads.append(reach_gps)
             return lambda: gps_queue[-1]
 
         if config["gps_type"] == "Simulator":
-            # from gps.simulator import SimulatorGPS
-            #
-            # simulator_gps = SimulatorGPS(config["gps_host"], int(config["gps_port"]))
-            # return lambda: simulator_gps.get_data()
-            return NotImplementedError
+            from simulator import PtyReplay, ReplayServer, load_log
+
+            gps_queue = deque(maxlen=1)
+            options = {"speed": settings.SIMULATOR_SPEED, "jitter": settings.SIMULATOR_JITTER,
+                       "loss": settings.SIMULATOR_LOSS}
+            if settings.SIMULATOR_GPS_SERIAL:  # through the UBX serial reader
+                from gps.ubx import PROTOCOL_UBX, UBX
+
+                protocol = config["gps_protocol"]
+                chunks = load_log(settings.SIMULATOR_GPS_LOG, "ubx" if protocol == PROTOCOL_UBX else "gps")
+                replay = PtyReplay(chunks, **options)
+                source = UBX(gps_queue, replay.port, notify=self.notify, protocol=protocol,
+                             rate=config.gps_rate or 10, covariance=settings.UBX_NAV_COV)
+            else:  # through the Reach TCP client
+                from reach.gps import ReachGPS
+
+                replay = ReplayServer(load_log(settings.SIMULATOR_GPS_LOG, "gps"), config["gps_host"] or "127.0.0.1",
+                                      int(config["gps_port"] or 0), **options)
+                source = ReachGPS(replay.host, replay.port, gps_queue, self.notify)
+            replay.start()
+            self.threads.append(replay)
+            start_source(source)
+            self.threads.append(source)
+            return lambda: gps_queue[-1]
 
         if config["gps_type"] == "FIXED":
             return lambda: {
-                "ts": datetime.datetime.utcnow(),
+                "ts": time.time(),
                 "lat": 0,
                 "lng": 0,
                 "speed": 0,
@@ -55,15 +159,19 @@ class GPSHandler:
             from gps.ubx import UBX
 
             gps_queue = deque(maxlen=1)
-            ntrip_queue = Queue()
-            ntrip_client = NTRIPClient(config, ntrip_queue)
-            ntrip_client.start()
-            ubx_gps = UBX(gps_queue, ntrip_queue=ntrip_queue)
+            if self.ntrip_client is None:
+                self.ntrip_client = NTRIPClient(config, CorrectionQueue(), self.get_data, settings.NTRIP_GGA_INTERVAL)
+                start_source(self.ntrip_client)
+                self.threads.append(self.ntrip_client)
+            ntrip_queue = self.ntrip_client.queue
+            ubx_gps = UBX(gps_queue, config["gps_serial_port"], config.gps_baud_rate, ntrip_queue, self.notify,
+                          config["gps_protocol"], config.gps_rate or 10, settings.UBX_NAV_COV)
             ubx_gps.start()
             self.threads.append(ubx_gps)
             return lambda: gps_queue[-1]
 
-        return NotImplementedError
+        logging.error("unknown GPS type %s", config["gps_type"])
+        return dict
 
     def disconnect_source(self):
         for thread in self.threads:
@@ -72,11 +180,12 @@ class GPSHandler:
 
     def stop(self):
         """Stop GPS threads if they are running."""
-        if len(self.threads) == 0:
+        if len(self.threads) == 0 and len(self.old_threads) == 0:
             return
 
-        for thread in self.threads:
+        for thread in self.threads + self.old_threads:
             thread.stop()
         self.threads = []
+        self.old_threads = []
         logging.info("GPS threads stopped")
         return True
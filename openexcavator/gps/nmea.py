@@ -0,0 +1,193 @@
+"""
+Bytes-level NMEA 0183 parser for the GGA, RMC, GST, VTG and GSA sentences of any talker (GP, GN, GL, GA...).
+"""
+
+import calendar
+import logging
+import time
+
+KNOTS_TO_KMH = 1.852
+
+# Mask keeping the lowest 128 bytes of an int, used to fold long bodies before the checksum shifts
+_MASK_128 = (1 << 1024) - 1
+# Value of the hexadecimal digit bytes (256 for anything else, never matching a checksum)
+_HEX_DIGITS = [256] * 256
+for _digit in b"0123456789ABCDEF":
+    _HEX_DIGITS[_digit] = _HEX_DIGITS[_digit | 0x20] = int(chr(_digit), 16)
+
+
+def checksum(body):
+    """
+    XOR of all bytes, computed by folding the bytes as a single int (much faster than a byte loop):
+    after xoring with itself shifted by 64, 32, 16, 8, 4, 2 and 1 bytes the lowest byte holds
+    every one of the first 128 bytes exactly once (the higher bytes are never shifted into it)
+    :param body: bytes (or memoryview) between $ and *
+    :returns: checksum value (0 to 255)
+    """
+    value = int.from_bytes(body, "little")
+    size = len(body)
+    while size > 128:  # longer than NMEA sentences can be
+        value = (value & _MASK_128) ^ (value >> 1024)
+        size -= 128
+    value ^= value >> 512
+    value ^= value >> 256
+    value ^= value >> 128
+    value ^= value >> 64
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xFF
+
+
+def parse_coordinate(coord, hemisphere):
+    """
+    Parse a (d)ddmm.mmmm coordinate
+    :param coord: coordinate bytes
+    :param hemisphere: N, S, E or W
+    :returns: decimal degrees
+    """
+    value = float(coord)
+    degrees = value // 100
+    degrees += (value - degrees * 100) / 60.0
+    return -degrees if hemisphere in (b"S", b"W") else degrees
+
+
+def format_coordinate(value, positive, negative, degree_digits):
+    """
+    Format decimal degrees as NMEA
+    :param value: decimal degrees
+    :param positive: hemisphere of positive values (N or E)
+    :param negative: hemisphere of negative values (S or W)
+    :param degree_digits: 2 for latitudes, 3 for longitudes
+    :returns: (d)ddmm.mmmmm,hemisphere string
+    """
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    return "%0*d%08.5f,%s" % (degree_digits, degrees, (value - degrees) * 60, hemisphere)
+
+
+def sentence(body):
+    """
+    Add the $ prefix, checksum and line terminator to a sentence body
+    :param body: sentence without $ and checksum, e.g. GNGGA,...
+    :returns: sentence bytes
+    """
+    body = body.encode("ascii")
+    return b"$%s*%02X\r\n" % (body, checksum(body))
+
+
+def gga_sentence(data):
+    """
+    Build a GGA sentence from GPS data, as sent to NTRIP casters serving VRS mountpoints
+    :param data: dict with lat, lng and optionally alt, fix, sats and ts (seconds since epoch)
+    :returns: sentence bytes
+    """
+    hundredths = round((data.get("ts") or time.time()) * 100)
+    return sentence("GPGGA,%s.%02d,%s,%s,%d,%02d,1.0,%.3f,M,0.000,M,," % (
+        time.strftime("%H%M%S", time.gmtime(hundredths // 100)), hundredths % 100,
+        format_coordinate(data["lat"], "N", "S", 2), format_coordinate(data["lng"], "E", "W", 3),
+        int(data.get("fix") or 1), data.get("sats") or 12, data.get("alt") or 0))
+
+
+class NMEAParser:
+    """
+    Parse sentences into the fields of a GPS epoch, the date of RMC sentences is cached so their
+    timestamp is a float (seconds since epoch) computed from the cached midnight
+    """
+
+    def __init__(self):
+        self._date = None
+        self._midnight = 0
+        self.errors = 0  # sentences with invalid checksum or fields
+
+    def timestamp(self, date, time):
+        """
+        Build the UTC timestamp of a RMC date (ddmmyy) and time (hhmmss.ss), without strptime
+        :returns: seconds since epoch
+        """
+        if date != self._date:
+            year = int(date[4:6])
+            year += 2000 if year < 69 else 1900  # same pivot as strptime %y
+            self._midnight = calendar.timegm((year, int(date[2:4]), int(date[0:2]), 0, 0, 0))
+            self._date = date
+        hours, seconds = divmod(float(time), 10000)
+        minutes, seconds = divmod(seconds, 100)
+        return self._midnight + hours * 3600 + minutes * 60 + seconds
+
+    def parse(self, sentence, epoch):
+        """
+        Parse a supported sentence into an epoch, checking its checksum; other sentences are skipped
+        before any checksum or copy, supported ones are only copied once (the fields)
+        :param sentence: sentence bytes or memoryview (of the receive buffer), with or without CR
+        :param epoch: dict the fields are written to, a RMC without valid fix writes none
+        :returns: sentence type or None if the sentence is invalid or not supported
+        """
+        end = len(sentence)
+        if end < 10 or sentence[0] != 36:  # 36 is $
+            return None
+        parser = _PARSERS.get(sentence[3] << 16 | sentence[4] << 8 | sentence[5])  # type without a copy
+        if parser is None:
+            return None
+        kind, parse, fields = parser
+        if sentence[end - 1] == 13:  # \r
+            end -= 1
+        star = end - 3
+        try:
+            if sentence[star] != 42 or checksum(sentence[1:star]) != (  # 42 is *
+                    _HEX_DIGITS[sentence[star + 1]] << 4 | _HEX_DIGITS[sentence[star + 2]]):
+                raise ValueError("checksum mismatch")
+            # only split up to the last field used, the rest of the sentence is left in one piece
+            parse(self, bytes(sentence[7:star]).split(b",", fields), epoch)
+        except (ValueError, IndexError) as exc:
+            self.errors += 1
+            logging.debug("invalid NMEA sentence %s: %s", bytes(sentence), exc)
+            return None
+        return kind
+
+    def parse_rmc(self, fields, epoch):
+        """time, status, lat, N/S, lng, E/W, speed (knots), track, date, ..."""
+        if fields[1] != b"A":
+            return
+        lat = parse_coordinate(fields[2], fields[3])  # fields checked before the epoch is modified
+        lng = parse_coordinate(fields[4], fields[5])
+        speed = float(fields[6]) * KNOTS_TO_KMH
+        epoch["ts"] = self.timestamp(fields[8], fields[0])
+        epoch["lat"] = lat
+        epoch["lng"] = lng
+        epoch["speed"] = speed
+
+    def parse_gga(self, fields, epoch):
+        """time, lat, N/S, lng, E/W, quality, satellites, hdop, altitude, M, geoid separation, M, ..."""
+        alt = float(fields[8]) + float(fields[10])
+        epoch["fix"] = float(fields[5])
+        epoch["alt"] = alt
+
+    def parse_gst(self, fields, epoch):
+        """time, rms, major, minor, orientation, lat error, lng error, altitude error"""
+        epoch["acc"] = max(float(fields[5]), float(fields[6]))
+
+    def parse_vtg(self, fields, epoch):
+        """track (true), T, track (magnetic), M, speed (knots), N, speed (km/h), K, mode"""
+        speed = float(fields[6])
+        epoch["track"] = float(fields[0]) if fields[0] else None
+        epoch["speed"] = speed
+
+    def parse_gsa(self, fields, epoch):
+        """mode, fix type, 12 satellite ids, pdop, hdop, vdop[, system id]"""
+        pdop, hdop, vdop = float(fields[14]), float(fields[15]), float(fields[16])
+        epoch["pdop"] = pdop
+        epoch["hdop"] = hdop
+        epoch["vdop"] = vdop
+
+
+# sentence type, parse function and number of fields it uses (after the type)
+_KINDS = (
+    (b"RMC", NMEAParser.parse_rmc, 9),
+    (b"GGA", NMEAParser.parse_gga, 11),
+    (b"GST", NMEAParser.parse_gst, 7),
+    (b"VTG", NMEAParser.parse_vtg, 7),
+    (b"GSA", NMEAParser.parse_gsa, 17),
+)
+# (type, parse function, fields) by sentence type as an int (the 3 bytes big endian)
+_PARSERS = {int.from_bytes(kind, "big"): (kind, parse, fields) for kind, parse, fields in _KINDS}
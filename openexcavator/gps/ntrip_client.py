@@ -1,86 +1,344 @@
+import asyncio
 from base64 import b64encode
 import logging
-from queue import Queue
+import random
 import socket
 import threading
-from pyubx2 import UBXReader, RTCM3_PROTOCOL
+import time
+
+import metrics
+import recorder
+from gps.nmea import gga_sentence
+from gps.rtcm import CorrectionQueue, RTCM3Framer
 
 # Timeout in seconds before stopping ntrip connection
 TIMEOUT = 10
+# Reconnection delay in seconds, doubled after every failed attempt up to the maximum and jittered
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
 USERAGENT = "openexcavator NTRIP client"
 NTRIP_VERSION = 2.0
+# Size of the socket reads
+READ_SIZE = 4096
+
+
+def reconnect_delay(attempt):
+    """
+    Exponential backoff with jitter, so clients restarted together do not hit the caster together
+    :param attempt: number of consecutive failed attempts (from 1)
+    :returns: seconds to wait
+    """
+    return min(RECONNECT_DELAY * 2 ** (attempt - 1), MAX_RECONNECT_DELAY) * random.uniform(0.5, 1)
+
+
+class ChunkedDecoder:
+    """Incremental decoder of HTTP chunked transfer encoding (Ntrip 2 responses)"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.remaining = 0  # data bytes left in the current chunk
+        self.skip = 0  # bytes of the CRLF ending the current chunk left to skip
+        self.finished = False  # last (empty) chunk received
+
+    def feed(self, data):
+        """
+        Decode received bytes
+        :param data: bytes received after the response headers
+        :returns: decoded bytes (possibly empty until a chunk size line is complete)
+        """
+        buffer = self.buffer
+        buffer += data
+        output = bytearray()
+        position = 0
+        while position < len(buffer) and not self.finished:
+            if self.remaining:
+                taken = buffer[position:position + self.remaining]
+                output += taken
+                position += len(taken)
+                self.remaining -= len(taken)
+                if not self.remaining:
+                    self.skip = 2
+            elif self.skip:
+                skipped = min(self.skip, len(buffer) - position)
+                position += skipped
+                self.skip -= skipped
+            else:
+                end = buffer.find(b"\r\n", position)
+                if end < 0:
+                    if len(buffer) - position > 64:
+                        raise ValueError("invalid chunk size line")
+                    break
+                self.remaining = int(buffer[position:end].split(b";")[0], 16)
+                self.finished = self.remaining == 0
+                position = end + 2
+        del buffer[:position]
+        return bytes(output)
+
+
+def check_response(status, headers):
+    """
+    Check the caster response to the stream request
+    :param status: status line, e.g. ICY 200 OK (Ntrip 1) or HTTP/1.1 200 OK (Ntrip 2)
+    :param headers: header lines (empty for Ntrip 1)
+    :returns: True if the stream uses chunked transfer encoding
+    """
+    status = status.decode(errors="replace").strip()
+    if status.startswith("SOURCETABLE"):
+        raise ConnectionRefusedError("NTRIP mountpoint not found, the caster sent its source table")
+    if " 200 " not in status + " ":
+        raise ConnectionRefusedError("NTRIP server response: %s" % status)
+    for line in headers:
+        name, _, value = line.decode(errors="replace").partition(":")
+        if name.strip().lower() == "transfer-encoding" and "chunked" in value.lower():
+            return True
+    return False
 
 
 class NTRIPClient(threading.Thread):
-    def __init__(self, config, queue: Queue):
+    def __init__(self, config, queue: CorrectionQueue, gga_source=None, gga_interval=0):
         """
         Initialize the ntrip client.
+        :param config: config dict.
+        :param queue: RTCM corrections are put there for the receiver.
+        :param gga_source: function returning the current GPS data (dict with lat, lng...), its
+            position is sent upstream as GGA (needed by VRS mountpoints).
+        :param gga_interval: seconds between GGA sentences, 0 to never send them.
         """
         super().__init__(daemon=True)
         self.queue = queue
+        self.gga_source = gga_source
+        self.gga_interval = gga_interval
+        self.running = False
+        self.failures = 0  # consecutive failed connection attempts
+        self._framer = None
+        self._decoder = None
+        self._last_gga = 0
+        self._sock = None
+        self._writer = None
+        self._reconfigured = False
+        self._wakeup = threading.Event()  # interrupts the reconnection delay
+        self._reads = metrics.LOOP_ITERATIONS.labels("ntrip")
+        self._reconnects = metrics.RECONNECTS.labels("ntrip")
+        self.settings = None
         self.update_config(config)
 
     def update_config(self, config):
-        self.server = config["ntrip_host"]
-        self.port = int(config["ntrip_port"])
-        self.mountpoint = config["ntrip_mountpoint"]
-        self.user = config["ntrip_user"]
-        self.password = config["ntrip_password"]
+        """
+        Apply new NTRIP settings, the running connection is closed and reopened if they changed.
+        :param config: config dict.
+        """
+        settings = (
+            config["ntrip_host"],
+            int(config["ntrip_port"] or 0),
+            config["ntrip_mountpoint"],
+            config["ntrip_user"],
+            config["ntrip_password"],
+        )
+        if settings == self.settings:
+            return
+        self.settings = settings
+        self.server, self.port, self.mountpoint, self.user, self.password = settings
+        self._reconfigured = True
+        self.failures = 0
+        self._wakeup.set()
+        sock = self._sock
+        if sock is not None:
+            logging.info("NTRIP settings changed, reconnecting")
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._writer is not None:
+            logging.info("NTRIP settings changed, reconnecting")
+            self._writer.close()
+
+    def is_configured(self):
+        """Return True if server, port and mountpoint are set."""
+        return self.server != "" and self.port != 0 and self.mountpoint != ""
+
+    def build_request(self):
+        """
+        Build the HTTP request for the configured mountpoint.
+        :returns: request bytes.
+        """
+        b64encoded_user = b64encode(f"{self.user}:{self.password}".encode("utf-8")).decode("utf-8")
+        return (
+            f"GET /{self.mountpoint} HTTP/1.1\r\n"
+            + f"Host: {self.server}:{self.port}\r\n"
+            + f"User-Agent: {USERAGENT}\r\n"
+            + f"Authorization: Basic {b64encoded_user}\r\n"
+            + f"Ntrip-Version: Ntrip/{NTRIP_VERSION}\r\n"
+            + "\r\n"
+        ).encode("utf-8")
+
+    def start_stream(self, status, headers):
+        """
+        Check the response and reset the stream decoders for a new connection.
+        :param status: response status line.
+        :param headers: response header lines.
+        """
+        chunked = check_response(status, headers)
+        self._framer = RTCM3Framer()
+        self._decoder = ChunkedDecoder() if chunked else None
+        self._last_gga = 0
+        logging.info(
+            "NTRIP client connected to %s:%d/%s%s",
+            self.server,
+            self.port,
+            self.mountpoint,
+            " (chunked)" if chunked else "",
+        )
+
+    def handle_data(self, raw_data):
+        """
+        Pass complete RTCM3 frames through to the receiver, without decoding them.
+        :param raw_data: bytes received after the response headers.
+        """
+        self._reads.inc()
+        recorder.record_raw(recorder.SOURCE_RTCM, raw_data)
+        if self._decoder is not None:
+            raw_data = self._decoder.feed(raw_data)
+            if self._decoder.finished:
+                raise ConnectionResetError("NTRIP server ended the stream")
+        frames = self._framer.feed(raw_data)
+        if frames:
+            self.failures = 0
+            self.queue.put(b"".join(frames))
+
+    def gga_due(self):
+        """
+        Build the GGA sentence to send upstream if the interval elapsed.
+        :returns: sentence bytes or None.
+        """
+        if not self.gga_interval or self.gga_source is None:
+            return None
+        now = time.monotonic()
+        if now - self._last_gga < self.gga_interval:
+            return None
+        try:
+            data = self.gga_source()
+        except IndexError:
+            return None
+        if not data or "lat" not in data or "lng" not in data:
+            return None
+        self._last_gga = now
+        return gga_sentence(data)
+
+    def connection_failed(self, err):
+        """
+        Log a connection error.
+        :returns: seconds to wait before reconnecting.
+        """
+        self.failures += 1
+        self._reconnects.inc()
+        delay = reconnect_delay(self.failures)
+        logging.warning("NTRIP connection error: %s, reconnecting in %.1f seconds", err, delay)
+        return delay
 
     def run(self):
         """
-        Opens socket to NTRIP server and reads incoming data.
+        Keep a connection to the NTRIP server open while the client is configured.
         """
-        if self.server == "" or self.port == 0 or self.mountpoint == "":
-            logging.warning("NTRIP client not configured...")
-            return
+        self.running = True
+        warned = False
+        while self.running:
+            self._reconfigured = False
+            if not self.is_configured():
+                if not warned:
+                    logging.warning("NTRIP client not configured...")
+                    warned = True
+                time.sleep(1)
+                continue
+            warned = False
+            try:
+                self.stream()
+            except (OSError, ValueError) as err:
+                if self.running and not self._reconfigured:
+                    self._wakeup.clear()
+                    self._wakeup.wait(self.connection_failed(err))
+
+    def stream(self):
+        """
+        Opens socket to NTRIP server and reads incoming data until stopped or reconfigured.
+        """
+        with socket.create_connection((self.server, self.port), TIMEOUT) as sock:
+            self._sock = sock
+            try:
+                sock.sendall(self.build_request())
+                reader = sock.makefile("rb")
+                status = reader.readline()
+                headers = []
+                if not status.startswith(b"ICY"):  # Ntrip 1 streams start right after the status line
+                    while True:
+                        line = reader.readline().strip()
+                        if not line:
+                            break
+                        headers.append(line)
+                self.start_stream(status, headers)
+                while self.running and not self._reconfigured:
+                    gga = self.gga_due()
+                    if gga:
+                        sock.sendall(gga)
+                    raw_data = reader.read1(READ_SIZE)
+                    if not raw_data:
+                        raise ConnectionResetError("NTRIP server closed the connection")
+                    self.handle_data(raw_data)
+            finally:
+                self._sock = None
 
-        # Configuration is valid, now start ntrip connection
+    async def run_async(self):
+        """
+        Same as run using asyncio streams on the running loop.
+        """
         self.running = True
+        warned = False
+        while self.running:
+            self._reconfigured = False
+            if not self.is_configured():
+                if not warned:
+                    logging.warning("NTRIP client not configured...")
+                    warned = True
+                await asyncio.sleep(1)
+                continue
+            warned = False
+            try:
+                await self.stream_async()
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+                if self.running and not self._reconfigured:
+                    deadline = time.monotonic() + self.connection_failed(err)
+                    while self.running and not self._reconfigured and time.monotonic() < deadline:
+                        await asyncio.sleep(0.1)
+
+    async def stream_async(self):
+        """
+        Opens a stream to the NTRIP server and forwards incoming data until stopped or reconfigured.
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.server, self.port), TIMEOUT)
+        self._writer = writer
         try:
-            with socket.socket() as sock:
-                sock.connect((self.server, self.port))
-                b64encoded_user = b64encode(f"{self.user}:{self.password}".encode("utf-8")).decode("utf-8")
-                sock.sendall(
-                    (f"GET /{self.mountpoint} HTTP/1.1\r\n" + f"User-Agent: {USERAGENT}\r\n" + f"Authorization: Basic {b64encoded_user}\r\n" + f"Ntrip-Version: Ntrip/{NTRIP_VERSION}\r\n").encode(
-                        "utf-8"
-                    )
-                )
-                sock.settimeout(TIMEOUT)
-
-                # UBXreader will wrap socket as SocketStream
-                ubr = UBXReader(
-                    sock,
-                    protfilter=RTCM3_PROTOCOL,
-                    # quitonerror=ERR_IGNORE,
-                    bufsize=4096,
-                )
-
-                logging.info(
-                    "NTRIP client connected to %s:%d/%s",
-                    self.server,
-                    self.port,
-                    self.mountpoint,
-                )
-
-                while self.running:
-                    raw_data, parsed_data = ubr.read()
-                    if raw_data is not None:
-                        self.queue.put((raw_data, parsed_data))
-                    # TODO: sending gga to ntrip server
-                    # if self._gga_interval:
-                    #     self._send_GGA()
-        except (
-            socket.gaierror,
-            ConnectionRefusedError,
-            ConnectionAbortedError,
-            ConnectionResetError,
-            BrokenPipeError,
-            TimeoutError,
-        ) as err:
-            self.running = False
-            print(err)
+            writer.write(self.build_request())
+            status = await asyncio.wait_for(reader.readline(), TIMEOUT)
+            headers = []
+            if not status.startswith(b"ICY"):
+                while True:
+                    line = (await asyncio.wait_for(reader.readline(), TIMEOUT)).strip()
+                    if not line:
+                        break
+                    headers.append(line)
+            self.start_stream(status, headers)
+            while self.running and not self._reconfigured:
+                gga = self.gga_due()
+                if gga:
+                    writer.write(gga)
+                raw_data = await asyncio.wait_for(reader.read(READ_SIZE), TIMEOUT)
+                if not raw_data:
+                    raise ConnectionResetError("NTRIP server closed the connection")
+                self.handle_data(raw_data)
+        finally:
+            self._writer = None
+            writer.close()
 
     def stop(self):
         """Set property to stop thread"""
         self.running = False
+        self._wakeup.set()
@@ -0,0 +1,209 @@
+"""
+RTCM correction path from the NTRIP client to the receiver serial port: RTCM3 framing
+(length delimited, CRC-24Q checked, no message decoding), the correction queue and its writer.
+"""
+
+from collections import deque
+import logging
+import threading
+import time
+
+import metrics
+
+# Corrections waiting to be written, the oldest ones are dropped when the writer lags behind
+QUEUE_SIZE = 64
+# Seconds of history used for the bytes per second rate
+RATE_WINDOW = 10
+
+RTCM3_PREAMBLE = 0xD3
+# Header (preamble, 6 reserved bits, 10 bit length) and CRC-24Q sizes
+RTCM3_HEADER = 3
+RTCM3_CRC = 3
+
+
+def _crc24q_table():
+    """CRC-24Q lookup table (polynomial 0x1864CFB)"""
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+        table.append(crc)
+    return table
+
+
+CRC24Q_TABLE = _crc24q_table()
+
+
+def crc24q(data):
+    """
+    CRC-24Q of a RTCM3 frame (header and payload)
+    :param data: bytes
+    :returns: 24 bit CRC
+    """
+    crc = 0
+    table = CRC24Q_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ byte]
+    return crc
+
+
+def rtcm3_frame(payload):
+    """
+    Frame a RTCM3 message
+    :param payload: message bytes (starting with the 12 bit message type), up to 1023 bytes
+    :returns: frame bytes
+    """
+    frame = bytes((RTCM3_PREAMBLE, len(payload) >> 8, len(payload) & 0xFF)) + payload
+    return frame + crc24q(frame).to_bytes(3, "big")
+
+
+def rtcm3_type(frame):
+    """Message type of a RTCM3 frame"""
+    return frame[3] << 4 | frame[4] >> 4
+
+
+class RTCM3Framer:
+    """Split a byte stream in complete RTCM3 frames, skipping anything that does not check out"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+        self.errors = 0  # frames with invalid CRC
+
+    def feed(self, data):
+        """
+        Add received bytes and return the complete frames
+        :param data: bytes received from the caster
+        :returns: list of frame bytes
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        while True:
+            start = buffer.find(RTCM3_PREAMBLE, start)
+            if start < 0:
+                start = len(buffer)
+                break
+            if len(buffer) < start + RTCM3_HEADER:
+                break
+            if buffer[start + 1] & 0xFC:  # reserved bits are zero
+                start += 1
+                continue
+            end = start + RTCM3_HEADER + ((buffer[start + 1] & 0x03) << 8 | buffer[start + 2]) + RTCM3_CRC
+            if len(buffer) < end:
+                break
+            if crc24q(buffer[start:end - RTCM3_CRC]) != int.from_bytes(buffer[end - RTCM3_CRC:end], "big"):
+                self.errors += 1
+                start += 1
+                continue
+            frames.append(bytes(buffer[start:end]))
+            start = end
+        del buffer[:start]
+        self.frames += len(frames)
+        return frames
+
+
+class CorrectionQueue:
+    """Bounded drop-oldest queue of RTCM chunks, put never blocks the NTRIP client"""
+
+    def __init__(self, maxlen=QUEUE_SIZE):
+        """
+        :param maxlen: number of chunks kept
+        """
+        self.chunks = deque(maxlen=maxlen)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.received = None  # monotonic time the last chunk was received
+
+    def put(self, data):
+        """
+        Queue a chunk of RTCM bytes, dropping the oldest one if full
+        :param data: bytes received from the caster
+        """
+        with self.condition:
+            if len(self.chunks) == self.chunks.maxlen:
+                self.dropped += 1
+            self.chunks.append(data)
+            self.received = time.monotonic()
+            self.condition.notify()
+
+    def get_all(self, timeout=None):
+        """
+        Wait for chunks and take all of them
+        :param timeout: seconds to wait
+        :returns: list of chunks (empty on timeout)
+        """
+        with self.condition:
+            if not self.chunks:
+                self.condition.wait(timeout)
+            chunks = list(self.chunks)
+            self.chunks.clear()
+            return chunks
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+class RTCMWriter(threading.Thread):
+    """Write all pending corrections to the receiver in one write as soon as they arrive"""
+
+    def __init__(self, serial_port, corrections: CorrectionQueue, write_lock=None):
+        """
+        :param serial_port: open serial.Serial instance of the receiver
+        :param corrections: queue filled by the NTRIP client
+        :param write_lock: lock held while writing, shared with the other writers of the serial port
+        """
+        super().__init__(daemon=True)
+        self._serial = serial_port
+        self._write_lock = write_lock or threading.Lock()
+        self.corrections = corrections
+        self.running = False
+        self.written = 0  # total bytes written
+        self.last_write = None  # monotonic time of the last write
+        self._history = deque()  # (monotonic time, bytes) of the recent writes, pruned by the writer thread only
+        self._writes = metrics.LOOP_ITERATIONS.labels("rtcm_writer")
+
+    def run(self):
+        self.running = True
+        while self.running:
+            chunks = self.corrections.get_all(timeout=1)
+            if not chunks or not self.running:
+                continue
+            self._writes.inc()
+            data = b"".join(chunks)
+            try:
+                with self._write_lock:
+                    self._serial.write(data)
+            except OSError as exc:
+                logging.warning("cannot write %d RTCM bytes: %s", len(data), exc)
+                continue
+            now = time.monotonic()
+            self.written += len(data)
+            self.last_write = now
+            history = self._history
+            history.append((now, len(data)))
+            while history[0][0] < now - RATE_WINDOW:
+                history.popleft()
+
+    def stats(self):
+        """
+        Age and rate of the corrections, published with every GNSS epoch and read by /metrics; computed
+        from a snapshot of the history so any thread can call it
+        :returns: dict with rtcm_age (seconds since the last correction reached the receiver, None if
+            none did yet) and rtcm_bps (bytes per second written over the last RATE_WINDOW seconds)
+        """
+        now = time.monotonic()
+        since = now - RATE_WINDOW
+        last_write = self.last_write
+        return {
+            "rtcm_age": now - last_write if last_write is not None else None,
+            "rtcm_bps": sum(size for write_time, size in list(self._history) if write_time >= since) / RATE_WINDOW,
+        }
+
+    def stop(self):
+        """Set property to stop thread"""
+        self.running = False
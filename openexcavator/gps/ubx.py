@@ -1,10 +1,147 @@
+import calendar
 from collections import deque
 import datetime
-from queue import Queue
+import logging
+import math
+from itertools import accumulate
+import struct
 import threading
 import time
 import serial
-from pyubx2 import UBXReader
+from pyubx2 import UBXMessage, UBXReader
+
+import metrics
+import recorder
+from gps.rtcm import CorrectionQueue, RTCMWriter
+from utils import next_sequence
+
+PROTOCOL_NMEA = "NMEA"
+PROTOCOL_UBX = "UBX"
+
+UBX_SYNC = b"\xb5\x62"
+MAX_PAYLOAD = 1024
+# (class, id) of the binary messages read in UBX mode
+NAV_PVT = (0x01, 0x07)
+NAV_COV = (0x01, 0x36)
+NAV_PVT_PAYLOAD = struct.Struct("<IHBBBBBBIiBBBBiiiiIIiiiiiIIHH4xihH")
+NAV_COV_PAYLOAD = struct.Struct("<IBBB9x6f24x")
+
+# NMEA messages disabled in UBX mode (on USB and UART1 outputs)
+NMEA_MESSAGES = ("GGA", "GLL", "GSA", "GSV", "GST", "RMC", "VTG", "ZDA")
+# NMEA messages read in NMEA mode, enabled again when switching back from UBX mode (with PUBX,00)
+NMEA_READ = ("GGA", "GST", "ZDA")
+
+
+def ubx_checksum(data):
+    """
+    8-bit Fletcher checksum of a UBX message (class to end of payload)
+    :returns: CK_A, CK_B
+    """
+    running = list(accumulate(data))  # CK_A after every byte, CK_B is their sum
+    return running[-1] & 0xFF, sum(running) & 0xFF
+
+
+def ubx_message(msg_class, msg_id, payload):
+    """Frame a UBX message (sync, class, id, length, payload, checksum)"""
+    body = struct.pack("<BBH", msg_class, msg_id, len(payload)) + payload
+    return UBX_SYNC + body + bytes(ubx_checksum(body))
+
+
+class UBXFramer:
+    """Split a UBX byte stream in messages, skipping anything else (NMEA, RTCM echoes, noise)"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.errors = 0  # messages with invalid length or checksum
+
+    def feed(self, data):
+        """
+        Add received bytes and return the complete messages
+        :param data: bytes read from the receiver
+        :returns: list of (class, id, payload bytes)
+        """
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        start = 0
+        while True:
+            start = buffer.find(UBX_SYNC, start)
+            if start < 0:
+                start = len(buffer) - 1 if buffer.endswith(UBX_SYNC[:1]) else len(buffer)
+                break
+            if len(buffer) < start + 6:
+                break
+            length = buffer[start + 4] | buffer[start + 5] << 8
+            if length > MAX_PAYLOAD:
+                self.errors += 1
+                start += 2
+                continue
+            end = start + 8 + length
+            if len(buffer) < end:
+                break
+            body = buffer[start + 2:end - 2]
+            if ubx_checksum(body) != (buffer[end - 2], buffer[end - 1]):
+                self.errors += 1
+                start += 2
+                continue
+            messages.append((body[0], body[1], bytes(body[4:])))
+            start = end
+        del buffer[:start]
+        return messages
+
+
+def fix_quality(fix_type, flags):
+    """
+    Map the NAV-PVT fix type and flags to the GGA fix quality used by the other sources
+    :returns: 4 RTK fixed, 5 RTK float, 2 differential, 1 GNSS fix, 0 no fix
+    """
+    if not flags & 0x01 or fix_type not in (2, 3, 4):  # gnssFixOK, 2D / 3D / GNSS + dead reckoning
+        return 0
+    carrier = flags >> 6
+    if carrier == 2:
+        return 4
+    if carrier == 1:
+        return 5
+    return 2 if flags & 0x02 else 1
+
+
+def decode_nav_pvt(payload):
+    """
+    Decode a NAV-PVT payload with a single unpack
+    :returns: epoch dict (with iTOW to match NAV-COV)
+    """
+    (itow, year, month, day, hour, minute, second, valid, _, nano, fix_type, flags, _, satellites,
+     lon, lat, _, height_msl, h_acc, v_acc, _, _, _, ground_speed, heading, _, _, pdop, _, _, _, _) = \
+        NAV_PVT_PAYLOAD.unpack(payload)
+    data = {
+        "itow": itow,
+        "lat": lat * 1e-7,
+        "lng": lon * 1e-7,
+        "alt": height_msl / 1000,  # mean sea level, as the GGA altitude read in NMEA mode
+        "fix": fix_quality(fix_type, flags),
+        "sats": satellites,
+        "acc": h_acc / 1000,
+        "hacc": h_acc / 1000,
+        "vacc": v_acc / 1000,
+        "speed": ground_speed * 0.0036,  # mm/s to km/h
+        "track": heading * 1e-5,
+        "pdop": pdop * 0.01,
+    }
+    if valid & 0x03 == 0x03:  # validDate and validTime
+        # seconds since epoch, second can be 60 (leap second) and nano negative
+        data["ts"] = calendar.timegm((year, month, day, hour, minute, 0)) + second + nano * 1e-9
+    return data
+
+
+def decode_nav_cov(payload):
+    """
+    Decode a NAV-COV payload
+    :returns: (iTOW, dict with horizontal and vertical accuracy in meters) or None if not valid
+    """
+    itow, _, pos_valid, _, cov_nn, _, _, cov_ee, _, cov_dd = NAV_COV_PAYLOAD.unpack(payload)
+    if not pos_valid:
+        return None
+    return itow, {"acc": math.sqrt(max(cov_nn, cov_ee)), "vacc": math.sqrt(cov_dd)}
 
 
 class UBX(threading.Thread):
@@ -13,77 +150,218 @@ class UBX(threading.Thread):
         gps_queue: deque,
         serial_port="/dev/ttyACM0",
         baud_rate=115200,
-        ntrip_queue: Queue = None,
+        ntrip_queue: CorrectionQueue = None,
+        notify=None,
+        protocol=PROTOCOL_NMEA,
+        rate=10,
+        covariance=False,
     ):
         """
         Initialize the UBX receiver module.
         :param serial_port: the serial port the UBX receiver is connected to.
         :param baud_rate: the baud rate to use.
+        :param ntrip_queue: RTCM corrections to write to the receiver.
+        :param notify: called (without arguments) after new data was published.
+        :param protocol: PROTOCOL_NMEA to read GGA/GST/ZDA/PUBX as configured on the receiver,
+            PROTOCOL_UBX to configure the receiver for binary NAV-PVT epochs.
+        :param rate: navigation rate (Hz) set in UBX mode.
+        :param covariance: also enable NAV-COV in UBX mode, its accuracy replaces the NAV-PVT one.
         """
         super().__init__(daemon=True)
         self._gps_queue = gps_queue
         self._serial = serial.Serial(port=serial_port, baudrate=baud_rate, timeout=0.1)
-        self._ubr = UBXReader(self._serial, protfilter=1)
+        self._write_lock = threading.Lock()  # shared with the RTCM writer, messages are never interleaved
+        self.protocol = protocol
+        self.rate = rate
+        self.covariance = covariance
+        self._output = None  # (protocol, rate) to apply from the read loop
+        self._framer = UBXFramer()
+        self._ubr = UBXReader(self._serial, protfilter=3)  # NMEA and UBX
+        self._nmea_data = {}  # NMEA mode epoch, updated by every sentence
+        self._pending = None  # UBX mode NAV-PVT epoch waiting for the NAV-COV of the same iTOW
         self.ntrip_queue = ntrip_queue
+        self.rtcm_writer = RTCMWriter(self._serial, ntrip_queue, self._write_lock) if ntrip_queue is not None else None
+        self.notify = notify
+        self.running = False
+        self._received = None  # monotonic time of the last serial read
+        self._parse_latency = metrics.PARSE_LATENCY.labels("gps")
+        self._reads = metrics.LOOP_ITERATIONS.labels("gps")
+
+    def configure(self):
+        """
+        Switch the receiver (RAM layer only, a power cycle restores the saved config) to
+        NAV-PVT output at the configured rate with the NMEA output disabled.
+        """
+        enabled = 1 if self.covariance else 0
+        cfg_data = [("CFG_RATE_MEAS", int(1000 / self.rate))]
+        for port in ("USB", "UART1"):
+            cfg_data += [("CFG_%sOUTPROT_UBX" % port, 1),
+                         ("CFG_MSGOUT_UBX_NAV_PVT_%s" % port, 1),
+                         ("CFG_MSGOUT_UBX_NAV_COV_%s" % port, enabled)]
+            cfg_data += [("CFG_MSGOUT_NMEA_ID_%s_%s" % (name, port), 0) for name in NMEA_MESSAGES]
+        self.write(UBXMessage.config_set(1, 0, cfg_data).serialize())
+        logging.info("UBX receiver configured for NAV-PVT at %s Hz", self.rate)
+
+    def configure_nmea(self):
+        """
+        Switch the receiver (RAM layer only) back from NAV-PVT to the NMEA messages read in NMEA mode.
+        """
+        cfg_data = []
+        for port in ("USB", "UART1"):
+            cfg_data += [("CFG_%sOUTPROT_NMEA" % port, 1),
+                         ("CFG_MSGOUT_UBX_NAV_PVT_%s" % port, 0),
+                         ("CFG_MSGOUT_UBX_NAV_COV_%s" % port, 0),
+                         ("CFG_MSGOUT_PUBX_ID_POLYP_%s" % port, 1)]
+            cfg_data += [("CFG_MSGOUT_NMEA_ID_%s_%s" % (name, port), 1) for name in NMEA_READ]
+        self.write(UBXMessage.config_set(1, 0, cfg_data).serialize())
+        logging.info("UBX receiver configured for NMEA output")
+
+    def set_output(self, protocol, rate):
+        """
+        Change the protocol and navigation rate of the running reader, sent to the receiver (CFG-VALSET)
+        by the read loop without reopening the serial port.
+        :param protocol: PROTOCOL_NMEA or PROTOCOL_UBX.
+        :param rate: navigation rate (Hz) set in UBX mode.
+        """
+        self._output = (protocol, rate)
+
+    def apply_output(self, protocol, rate):
+        """Reconfigure the receiver for a new protocol and rate, called from the read loop"""
+        previous = self.protocol
+        if (protocol, rate) == (previous, self.rate):
+            return
+        self.protocol = protocol
+        self.rate = rate
+        self._nmea_data = {}
+        self._pending = None
+        if protocol == PROTOCOL_UBX:
+            self.configure()
+        elif previous == PROTOCOL_UBX:
+            self.configure_nmea()
+
+    def write(self, data):
+        """Write a message to the receiver, never interleaved with the RTCM corrections"""
+        with self._write_lock:
+            self._serial.write(data)
 
     def run(self):
         """
-        Start the read nmea messages from serial loop.
+        Start the read messages from serial loop.
         """
         self.running = True
-        data = {}
-        while self.running:
-            # Writes data to ntrip server if available in queue.
-            self.write_ntrip()
-
-            # Parse data from UBX receiver.
-            (raw_data, parsed_data) = self._ubr.read()
-            if parsed_data is None:
-                continue
+        if self.rtcm_writer:
+            self.rtcm_writer.start()
+        try:
+            if self.protocol == PROTOCOL_UBX:
+                self.configure()
+            while self.running:
+                output = self._output
+                if output is not None:
+                    self._output = None
+                    self.apply_output(*output)
+                if self.protocol == PROTOCOL_UBX:
+                    self.read_ubx()
+                else:
+                    self.read_nmea()
+        except serial.SerialException:
+            if self.running:
+                raise  # the port is closed by stop otherwise
+
+    def read_nmea(self):
+        """
+        Read one NMEA (or PUBX) message, the epoch is published after every message used.
+        """
+        (raw_data, parsed_data) = self._ubr.read()
+        self._received = time.monotonic()  # pyubx2 reads and parses at once
+        self._reads.inc()
+        if raw_data:
+            recorder.record_raw(recorder.SOURCE_GPS, raw_data)
+        if parsed_data is None or raw_data[:1] != b"$":  # UBX messages only let the loop check for changes
+            return
+        data = self._nmea_data
+        if parsed_data.msgID == "GGA":  # GPS Fix Data
+            data["lat"] = parsed_data.lat
+            data["lng"] = parsed_data.lon
+            data["alt"] = parsed_data.alt
+            data["fix"] = parsed_data.quality
+        elif parsed_data.msgID == "GST":  # Estimated error in position solution
+            data["acc"] = max(parsed_data.stdLat, parsed_data.stdLong)
+        elif parsed_data.msgID == "ZDA":  # ZDA Time
+            data["ts"] = datetime.datetime.combine(
+                datetime.date(parsed_data.year, parsed_data.month, parsed_data.day),
+                parsed_data.time,
+                datetime.timezone.utc,
+            ).timestamp()
+        elif parsed_data.msgID == "UBX" and parsed_data.msgId == "00":  # GPS Acc Data
+            data["speed"] = parsed_data.SOG
+            data["track"] = parsed_data.COG
+            data["pdop"] = parsed_data.PDOP
+            data["hdop"] = parsed_data.HDOP
+            data["vdop"] = parsed_data.VDOP
+            data["hacc"] = parsed_data.hAcc
+            data["vacc"] = parsed_data.vAcc
+        else:
+            return
+        self.publish(dict(data))
 
-            if parsed_data.msgID == "GGA":  # GPS Fix Data
-                data["lat"] = parsed_data.lat
-                data["lng"] = parsed_data.lon
-                data["alt"] = parsed_data.alt
-                data["fix"] = parsed_data.quality
-            elif parsed_data.msgID == "GST":  # Estimated error in position solution
-                data["acc"] = max(parsed_data.stdLat, parsed_data.stdLong)
-            elif parsed_data.msgID == "ZDA":  # ZDA Time
-                data["ts"] = datetime.datetime.combine(
-                    datetime.date(parsed_data.year, parsed_data.month, parsed_data.day),
-                    parsed_data.time,
-                )
-            elif parsed_data.msgID == "UBX" and parsed_data.msgId == "00":  # GPS Acc Data
-                data["speed"] = parsed_data.SOG
-                data["track"] = parsed_data.COG
-                data["pdop"] = parsed_data.PDOP
-                data["hdop"] = parsed_data.HDOP
-                data["vdop"] = parsed_data.VDOP
-                data["hacc"] = parsed_data.hAcc
-                data["vacc"] = parsed_data.vAcc
-            self._gps_queue.append(data)
-
-    def write_ntrip(self):
-        """
-        Write data to ntrip server if available in queue.
-        """
-        if self.ntrip_queue and not self.ntrip_queue.empty():
-            (raw_data, parsed_data) = self.ntrip_queue.get()
-            self._serial.write(raw_data)
-            self.ntrip_queue.task_done()
+    def read_ubx(self):
+        """
+        Read the available NAV-PVT (and NAV-COV) messages, every NAV-PVT is a complete epoch.
+        """
+        raw_data = self._serial.read(self._serial.in_waiting or 1)
+        self._reads.inc()
+        if not raw_data:
+            return
+        self._received = time.monotonic()
+        recorder.record_raw(recorder.SOURCE_GPS, raw_data)
+        for msg_class, msg_id, payload in self._framer.feed(raw_data):
+            if (msg_class, msg_id) == NAV_PVT and len(payload) == NAV_PVT_PAYLOAD.size:
+                if self._pending is not None:
+                    self.publish(self._pending)
+                self._pending = decode_nav_pvt(payload)
+                if not self.covariance:
+                    self.publish(self._pending)
+                    self._pending = None
+            elif (msg_class, msg_id) == NAV_COV and len(payload) == NAV_COV_PAYLOAD.size and self._pending:
+                covariance = decode_nav_cov(payload)
+                if covariance and covariance[0] == self._pending["itow"]:
+                    self._pending.update(covariance[1])
+                self.publish(self._pending)
+                self._pending = None
+
+    def publish(self, data):
+        """Stamp an epoch with a sequence number and the correction stats and make it available"""
+        data["seq"] = next_sequence()
+        if self._received is not None:
+            now = time.monotonic()
+            self._parse_latency.observe(now - self._received)
+            data["parsed"] = now
+        if self.rtcm_writer:
+            data.update(self.rtcm_writer.stats())
+        self._gps_queue.append(data)
+        if self.notify:
+            self.notify()
 
     def stop(self):
-        """Set property to stop thread"""
+        """Stop the thread (and the RTCM writer) and close the serial port"""
         self.running = False
+        if self.rtcm_writer:
+            self.rtcm_writer.stop()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout=1)  # the reads time out every 0.1 s
+        with self._write_lock:
+            self._serial.close()
+
 
+if __name__ == "__main__":  # read a receiver: python3 -m gps.ubx [serial port] [NMEA|UBX]
+    import sys
 
-def test_loop():
     queue = deque(maxlen=1)
-    imu = UBX(queue)
-    imu.start()
-    time.sleep(1)
+    reader = UBX(queue, *sys.argv[1:2], protocol=sys.argv[2] if len(sys.argv) > 2 else PROTOCOL_NMEA)
+    reader.start()
     while True:
-        data: dict = queue[-1]
-        if len(data) == 5:
-            print(f'lat: {data["lat"]}, long: {data["lng"]}, alt: {data["alt"]}, acc: {data["acc"]}, fix: {data["fix"]}')
         time.sleep(0.5)
+        if queue:
+            data = queue[-1]
+            logging.info("lat: %s, lng: %s, alt: %s, acc: %s, fix: %s", data.get("lat"), data.get("lng"),
+                         data.get("alt"), data.get("acc"), data.get("fix"))
@@ -4,15 +4,27 @@ Created on Aug 28, 2017
 @author: ionut
 """
 
+import asyncio
 import json
 import logging
+import math
+import os
 import subprocess
+import time
 
 from tornado.web import RequestHandler
 from tornado.websocket import WebSocketHandler
 
 from tornado.escape import url_escape
+import utm
 
+import broadcast
+import design
+from imu.attitude import FILTERS
+import metrics
+import profiler
+import settings
+import surface
 import utils
 
 
@@ -31,6 +43,11 @@ class BaseHandler(RequestHandler):
         self.finish("POST not allowed")
 
 
+def path_url(config):
+    """URL of the path artifact of the active design (versioned by its ETag), empty if it has no path"""
+    return "/path?v=%s" % config["path_etag"] if config["path_etag"] else ""
+
+
 class HomeHandler(BaseHandler):
     """
     Handler for / request, renders home.html
@@ -39,7 +56,85 @@ class HomeHandler(BaseHandler):
     def get(self):
         config = self.application.database.get_config()
         error_msg = self.get_argument("error_msg", "")
-        self.render("home.html", config=config, error_msg=error_msg)
+        self.render("home.html", config=config, error_msg=error_msg, path_url=path_url(config),
+                    designs=self.application.database.get_designs())
+
+
+class PathHandler(BaseHandler):
+    """
+    Handler for /path request, the path artifact of the active design (see design.preprocess_path)
+    served gzipped to the clients accepting it; cached for good when requested with the current
+    version (/path?v=<ETag> as linked by the pages), revalidated with the ETag otherwise
+    """
+
+    def get(self):
+        config = self.application.database.get_config()
+        stored = self.application.database.get_design_path(config.design) if config["path_etag"] else None
+        if stored is None:
+            self.set_status(404)
+            return self.finish("no design path")
+        body, gzipped = stored
+        self._etag = '"%s"' % config["path_etag"]
+        if self.get_argument("v", None) == config["path_etag"]:
+            self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+        else:
+            self.set_header("Cache-Control", "no-cache")
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Vary", "Accept-Encoding")
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            return self.finish(gzipped)
+        return self.finish(body)
+
+    def compute_etag(self):
+        return self._etag
+
+
+class DesignsHandler(BaseHandler):
+    """
+    Handler for /designs request: GET lists the designs with the active one and the one nearest to
+    the bucket, POST activates (action=activate, no design if id is empty) or deletes (action=delete)
+    the design with the id argument and returns the active design
+    """
+
+    def get(self):
+        database = self.application.database
+        nearest = None
+        try:
+            frame = self.application.data_queue[-1]
+        except IndexError:
+            frame = None
+        if frame is not None and frame.lat is not None and frame.lng is not None and frame.utm_num:
+            proj_coords = utm.from_latlon(frame.lat, frame.lng, frame.utm_num)
+            found = database.nearest_design(proj_coords[0], proj_coords[1], frame.utm_num,
+                                            settings.DESIGN_SEARCH_RADIUS)
+            if found:
+                nearest = {"id": found[0], "distance": found[1]}
+        self.write({"active": database.get_config().design, "nearest": nearest, "designs": database.get_designs()})
+
+    def post(self):
+        database = self.application.database
+        action = self.get_argument("action", "")
+        design_id = self.get_argument("id", "")
+        if design_id and not design_id.isdigit():
+            self.set_status(400)
+            return self.finish("invalid design id")
+        if action == "activate":
+            if design_id and int(design_id) not in [item["id"] for item in database.get_designs()]:
+                self.set_status(404)
+                return self.finish("no such design")
+            changed = database.set_config({"design": design_id})
+        elif action == "delete" and design_id:
+            changed = database.delete_design(int(design_id))
+        else:
+            self.set_status(400)
+            return self.finish("invalid action")
+        config = database.get_config()
+        if changed:
+            # the guidance follows right away, designs are not parsed again (see DesignPath.from_config)
+            self.application.data_manager.update_config(config)
+        self.write({"active": config.design, "name": config["design_name"], "path_url": path_url(config),
+                    "start_altitude": config.start_altitude, "stop_altitude": config.stop_altitude})
 
 
 class DebugHandler(BaseHandler):
@@ -52,26 +147,118 @@ class DebugHandler(BaseHandler):
         self.render("debug.html", config=config)
 
 
+class ProfileHandler(BaseHandler):
+    """
+    Handler for /debug/profile request: sample the call stacks of all the threads for some seconds
+    (seconds argument, 10 by default) every interval milliseconds (10 by default), rendered as a
+    flame graph (profile.html) or returned as collapsed stacks with format=collapsed
+    """
+
+    async def get(self):
+        try:
+            seconds = min(float(self.get_argument("seconds", 10)), profiler.MAX_SECONDS)
+            interval = float(self.get_argument("interval", profiler.DEFAULT_INTERVAL * 1000)) / 1000
+        except ValueError:
+            self.set_status(400)
+            return self.finish("invalid seconds or interval")
+        if not profiler.acquire():
+            self.set_status(409)
+            return self.finish("a profile is already running")
+        try:
+            logging.info("profiling for %.1f seconds every %.1f ms", seconds, interval * 1000)
+            sampler = profiler.SamplingProfiler(interval)
+            sampler.start()
+            await asyncio.sleep(seconds)
+            sampler.stop()
+            sampler.join()
+        finally:
+            profiler.release()
+        stacks = profiler.format_collapsed(sampler.collapsed())
+        if self.get_argument("format", "html") == "collapsed":
+            self.set_header("Content-Type", "text/plain; charset=utf-8")
+            return self.finish(stacks)
+        config = self.application.database.get_config()
+        self.render("profile.html", config=config, stacks=stacks, samples=sampler.samples,
+                    elapsed=sampler.elapsed, interval=sampler.interval)
+
+
 class DataHandler(WebSocketHandler):
     """
     Handler for async /data request.
-    Get the data from the data (GPS, IMU)threads and write it to the WS clients
+    Clients subscribe with a JSON message {"rate": <frames per second>, "fields": [<keys>]},
+    afterwards the frames published by the DataManager are pushed by the broadcaster, as JSON text
+    or, with "binary": true, as binary messages described by a schema text message sent first.
+    Legacy clients can still poll the latest frame by sending "!".
     """
 
     def open(self):
+        self.min_interval = 1.0 / broadcast.DEFAULT_RATE
+        self.fields = None
+        self.binary = None
+        self.last_sent = 0
+        self.write_future = None
+        self.dropped = 0
         logging.info("new ws client: %s", self)
 
     def on_close(self):
-        logging.info("closing ws client: %s", self)
+        self.application.broadcaster.remove(self)
+        logging.info("closing ws client: %s, dropped frames: %d", self, self.dropped)
 
     def on_message(self, message):
-        if message != "!":
-            return logging.warning("unexpected message %s from %s", message, self)
-        data = {}
-        if self.application.data_queue:
-            data.update(self.application.data_queue[-1])
-        message = json.dumps(data, default=utils.json_encoder)
-        self.write_message(message, binary=False)
+        if message == "!":
+            if not self.application.data_queue:
+                return self.write_message("{}", binary=False)
+            return self.write_message(broadcast.encode_frame(self.application.data_queue[-1]), binary=False)
+        try:
+            options = json.loads(message)
+            rate = float(options.get("rate", broadcast.DEFAULT_RATE))
+            if not math.isfinite(rate) or rate <= 0:
+                raise ValueError("invalid rate %s" % rate)
+            rate = min(max(rate, broadcast.MIN_RATE), broadcast.MAX_RATE)
+            fields = options.get("fields")
+            self.fields = tuple(sorted(str(field) for field in fields)) if fields else None
+            binary = bool(options.get("binary"))
+        except (ValueError, TypeError, AttributeError) as exc:
+            return logging.warning("unexpected message %s from %s: %s", message, self, exc)
+        self.min_interval = 1.0 / rate
+        self.binary = broadcast.BinaryStream(self.fields) if binary else None
+        if binary:
+            self.write_message(broadcast.binary_schema(), binary=False)
+        self.application.broadcaster.add(self)
+
+    def send_frame(self, frame, messages, now):
+        """
+        Write a frame unless the rate cap is hit or the previous write is still pending
+        :param frame: frame.Frame
+        :param messages: serialized frames for this broadcast keyed by field subscription
+        :param now: monotonic broadcast time
+        """
+        if now - self.last_sent < self.min_interval:
+            return
+        if self.write_future is not None and not self.write_future.done():
+            self.dropped += 1  # slow client, do not queue frames
+            metrics.DROPPED_FRAMES.labels("slow_client").inc()
+            return
+        if self.binary is not None:
+            message = self.binary.encode(frame, messages)
+        else:
+            message = messages.get(self.fields)
+            if message is None:
+                message = messages[self.fields] = broadcast.encode_frame(frame, self.fields)
+        self.last_sent = now
+        self.write_future = self.write_message(message, binary=self.binary is not None)
+        if frame.fused is not None:
+            metrics.SEND_LATENCY.observe(time.monotonic() - frame.fused)
+
+
+class MetricsHandler(BaseHandler):
+    """
+    Handler for /metrics request, pipeline metrics in the Prometheus text format
+    """
+
+    def get(self):
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.finish(metrics.render())
 
 
 class ToolsHandler(BaseHandler):
@@ -89,7 +276,7 @@ class UpdateHandler(BaseHandler):
     Handler for updating config data.
     """
 
-    def post(self):
+    async def post(self):
         action = self.get_argument("action", "").lower()
         if action == "restart":
             try:
@@ -104,44 +291,91 @@ class UpdateHandler(BaseHandler):
             "wifi_psk": self.get_argument("wifi_psk", None),
             "gps_host": self.get_argument("gps_host", None),
             "gps_port": self.get_argument("gps_port", None),
+            "gps_serial_port": self.get_argument("gps_serial_port", None),
+            "gps_baud_rate": self.get_argument("gps_baud_rate", None),
+            "gps_protocol": self.get_argument("gps_protocol", None),
+            "gps_rate": self.get_argument("gps_rate", None),
             "imu_host": self.get_argument("imu_host", None),
             "imu_port": self.get_argument("imu_port", None),
+            "imu_filter": self.get_argument("imu_filter", None),
             "start_altitude": self.get_argument("start_altitude", None),
             "stop_altitude": self.get_argument("stop_altitude", None),
             "antenna_height": self.get_argument("antenna_height", None),
+            "boom_length": self.get_argument("boom_length", None),
+            "stick_length": self.get_argument("stick_length", None),
+            "bucket_length": self.get_argument("bucket_length", None),
             "safety_depth": self.get_argument("safety_depth", None),
             "safety_height": self.get_argument("safety_height", None),
             "output_port": self.get_argument("output_port", None),
-            "path": None
+            "ntrip_host": self.get_argument("ntrip_host", None),
+            "ntrip_port": self.get_argument("ntrip_port", None),
+            "ntrip_mountpoint": self.get_argument("ntrip_mountpoint", None),
+            "ntrip_user": self.get_argument("ntrip_user", None),
+            "ntrip_password": self.get_argument("ntrip_password", None)
         }
-        if self.request.files:
-            file_info = self.request.files["path"][0]
-            data["path"] = file_info["body"]
+        path_files = [item for item in self.request.files.get("path", []) if item["body"]]
+        surface_files = [item for item in self.request.files.get("surface", []) if item["body"]]
+        artifact = None
+        design_surface = None
+        loop = asyncio.get_running_loop()
         error_msg = None
         try:
             data["gps_port"] = int(data["gps_port"])
             data["imu_port"] = int(data["imu_port"])
+            if data["imu_filter"] is not None and data["imu_filter"] not in FILTERS:  # unchanged if not sent
+                error_msg = "invalid IMU filter (%s)" % ", ".join(FILTERS)
+            if data["gps_baud_rate"]:
+                data["gps_baud_rate"] = int(data["gps_baud_rate"])
+            if data["gps_rate"]:
+                data["gps_rate"] = int(data["gps_rate"])
+                if data["gps_rate"] < 1 or data["gps_rate"] > 25:
+                    error_msg = "invalid GPS rate (1<rate>25 Hz)"
             data["start_altitude"] = float(data["start_altitude"])
             data["stop_altitude"] = float(data["stop_altitude"])
             data["antenna_height"] = float(data["antenna_height"])
+            data["boom_length"] = float(data["boom_length"])
+            data["stick_length"] = float(data["stick_length"])
+            data["bucket_length"] = float(data["bucket_length"])
             data["safety_depth"] = float(data["safety_depth"])
             data["safety_height"] = float(data["safety_height"])
+            if data["ntrip_port"]:
+                data["ntrip_port"] = int(data["ntrip_port"])
             if data["output_port"]:
                 data["output_port"] = int(data["output_port"])
                 if data["output_port"] < 1024 or data["output_port"] > 65535:
                     error_msg = "invalid output port (1024<port>65535"
-            if data["path"]:
+            # large paths and surfaces take seconds to convert, keep serving the data meanwhile
+            if path_files:
                 try:
-                    if file_info["filename"].endswith(".zip"):
-                        data["path"] = utils.extract_zip(data["path"])
-                    path_value = json.loads(data["path"].decode())
-                    if "features" not in path_value:
-                        error_msg = "missing features from GeoJSON"
-                except ValueError:
-                    error_msg = "JSON data is not valid"
+                    path_data = path_files[0]["body"]
+                    if path_files[0]["filename"].endswith(".zip"):
+                        path_data = utils.extract_zip(path_data)
+                    artifact = await loop.run_in_executor(None, design.preprocess_path, path_data)
+                except ValueError as exc:
+                    error_msg = "%s" % exc
+            if surface_files and not error_msg:
+                try:
+                    surface_id = await loop.run_in_executor(None, surface.import_surface, surface_files[0]["body"])
+                    design_surface = surface.Surface.from_id(surface_id)
+                except ValueError as exc:
+                    error_msg = "invalid surface: %s" % exc
         except Exception as exc:
             error_msg = "invalid input data: %s" % exc
         if error_msg:
             return self.redirect("/?error_msg=" + url_escape(error_msg))
-        self.application.database.set_config(data)
+        database = self.application.database
+        changed = False
+        if artifact is not None or design_surface is not None:
+            # uploads are stored as a new design, made active (before the altitudes are applied to it)
+            filename = (path_files or surface_files)[0]["filename"]
+            name = self.get_argument("design_name", "").strip() or os.path.splitext(os.path.basename(filename))[0]
+            record = await loop.run_in_executor(None, design.design_record, artifact, design_surface)
+            try:
+                database.add_design(name, data["start_altitude"], data["stop_altitude"], **record)
+            except ValueError as exc:
+                return self.redirect("/?error_msg=" + url_escape("%s" % exc))
+            changed = True
+        if database.set_config(data) or changed:
+            # sensor sources are reconfigured in place, no restart needed
+            self.application.data_manager.update_config(database.get_config())
         return self.redirect("/")
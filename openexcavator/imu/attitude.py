@@ -0,0 +1,215 @@
+"""
+Attitude filters for the IMU sensors, updated per sample (live) or run over recorded arrays at
+once (offline reprocessing). Madgwick is a scalar port of the ahrs MARG update working on floats
+(no temporary arrays, same results), Mahony and EKF are the ahrs implementations.
+All the filters estimate the sensor to east, north, up (ENU) rotation; the attitude published to
+the rest of the application is turned to north, west, up (enu_to_nwu) so yaw is a heading measured
+from north, as from the Reach IMU.
+"""
+
+import math
+
+import numpy as np
+from ahrs.common.orientation import ecompass
+from ahrs.filters import EKF, Mahony
+
+FILTERS = ("Madgwick", "Mahony", "EKF")
+DEFAULT_FILTER = "Madgwick"
+# Gain of an ahrs Madgwick instance created without data (as used so far), for both updates
+MADGWICK_GAIN = 0.033
+# cos(45), the Madgwick reference frame (north, west, up) is the ENU one turned by 90 degrees around z
+HALF_SQRT2 = math.sqrt(0.5)
+
+
+def nwu_to_enu(q):
+    """Convert a sensor to north, west, up quaternion to a sensor to ENU one"""
+    qw, qx, qy, qz = q
+    return (HALF_SQRT2 * (qw - qz), HALF_SQRT2 * (qx - qy), HALF_SQRT2 * (qx + qy), HALF_SQRT2 * (qz + qw))
+
+
+def enu_to_nwu(q):
+    """Convert a sensor to ENU quaternion to a sensor to north, west, up one"""
+    qw, qx, qy, qz = q
+    return (HALF_SQRT2 * (qw + qz), HALF_SQRT2 * (qx + qy), HALF_SQRT2 * (qy - qx), HALF_SQRT2 * (qz - qw))
+
+
+def madgwick_imu(q, gyr, acc, dt, gain=MADGWICK_GAIN):
+    """
+    Madgwick update with gyroscope and accelerometer only (ahrs Madgwick.updateIMU on floats)
+    :param q: a-priori quaternion (w, x, y, z), sensor to north, west, up
+    :param gyr: gyroscope x, y, z (radians/s)
+    :param acc: accelerometer x, y, z
+    :param dt: seconds since the previous sample
+    :param gain: filter gain
+    :returns: quaternion tuple
+    """
+    qw, qx, qy, qz = q
+    norm = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+    qw, qx, qy, qz = qw / norm, qx / norm, qy / norm, qz / norm
+    gx, gy, gz = gyr
+    if not (gx or gy or gz):
+        return qw, qx, qy, qz
+    # rate of change: 0.5 * q * (0, gyr)
+    dw = 0.5 * (-qx * gx - qy * gy - qz * gz)
+    dx = 0.5 * (qw * gx + qy * gz - qz * gy)
+    dy = 0.5 * (qw * gy - qx * gz + qz * gx)
+    dz = 0.5 * (qw * gz + qx * gy - qy * gx)
+    ax, ay, az = acc
+    norm = math.sqrt(ax * ax + ay * ay + az * az)
+    if norm > 0:
+        ax, ay, az = ax / norm, ay / norm, az / norm
+        f0 = 2.0 * (qx * qz - qw * qy) - ax
+        f1 = 2.0 * (qw * qx + qy * qz) - ay
+        f2 = 2.0 * (0.5 - qx * qx - qy * qy) - az
+        if f0 or f1 or f2:
+            # gradient J.T @ f
+            sw = -2.0 * qy * f0 + 2.0 * qx * f1
+            sx = 2.0 * qz * f0 + 2.0 * qw * f1 - 4.0 * qx * f2
+            sy = -2.0 * qw * f0 + 2.0 * qz * f1 - 4.0 * qy * f2
+            sz = 2.0 * qx * f0 + 2.0 * qy * f1
+            norm = math.sqrt(sw * sw + sx * sx + sy * sy + sz * sz)
+            dw -= gain * sw / norm
+            dx -= gain * sx / norm
+            dy -= gain * sy / norm
+            dz -= gain * sz / norm
+    qw, qx, qy, qz = qw + dw * dt, qx + dx * dt, qy + dy * dt, qz + dz * dt
+    norm = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+    return qw / norm, qx / norm, qy / norm, qz / norm
+
+
+def madgwick_marg(q, gyr, acc, mag, dt, gain=MADGWICK_GAIN):
+    """
+    Madgwick update with gyroscope, accelerometer and magnetometer (ahrs Madgwick.updateMARG on floats)
+    :param q: a-priori quaternion (w, x, y, z), sensor to north, west, up
+    :param gyr: gyroscope x, y, z (radians/s)
+    :param acc: accelerometer x, y, z
+    :param mag: magnetometer x, y, z
+    :param dt: seconds since the previous sample
+    :param gain: filter gain
+    :returns: quaternion tuple
+    """
+    mx, my, mz = mag
+    norm = math.sqrt(mx * mx + my * my + mz * mz)
+    if norm == 0:
+        return madgwick_imu(q, gyr, acc, dt, gain)
+    mx, my, mz = mx / norm, my / norm, mz / norm
+    qw, qx, qy, qz = q
+    norm = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+    qw, qx, qy, qz = qw / norm, qx / norm, qy / norm, qz / norm
+    gx, gy, gz = gyr
+    if not (gx or gy or gz):
+        return qw, qx, qy, qz
+    dw = 0.5 * (-qx * gx - qy * gy - qz * gz)
+    dx = 0.5 * (qw * gx + qy * gz - qz * gy)
+    dy = 0.5 * (qw * gy - qx * gz + qz * gx)
+    dz = 0.5 * (qw * gz + qx * gy - qy * gx)
+    ax, ay, az = acc
+    norm = math.sqrt(ax * ax + ay * ay + az * az)
+    if norm > 0:
+        ax, ay, az = ax / norm, ay / norm, az / norm
+        # magnetic field in the earth frame (q * m * q'), reference direction in the x-z plane
+        hx = mx * (1 - 2 * (qy * qy + qz * qz)) + my * 2 * (qx * qy - qw * qz) + mz * 2 * (qx * qz + qw * qy)
+        hy = mx * 2 * (qx * qy + qw * qz) + my * (1 - 2 * (qx * qx + qz * qz)) + mz * 2 * (qy * qz - qw * qx)
+        bz = mx * 2 * (qx * qz - qw * qy) + my * 2 * (qy * qz + qw * qx) + mz * (1 - 2 * (qx * qx + qy * qy))
+        bx = math.sqrt(hx * hx + hy * hy)
+        f0 = 2.0 * (qx * qz - qw * qy) - ax
+        f1 = 2.0 * (qw * qx + qy * qz) - ay
+        f2 = 2.0 * (0.5 - qx * qx - qy * qy) - az
+        f3 = 2.0 * bx * (0.5 - qy * qy - qz * qz) + 2.0 * bz * (qx * qz - qw * qy) - mx
+        f4 = 2.0 * bx * (qx * qy - qw * qz) + 2.0 * bz * (qw * qx + qy * qz) - my
+        f5 = 2.0 * bx * (qw * qy + qx * qz) + 2.0 * bz * (0.5 - qx * qx - qy * qy) - mz
+        if f0 or f1 or f2 or f3 or f4 or f5:
+            # gradient J.T @ f
+            sw = (-2.0 * qy * f0 + 2.0 * qx * f1 - 2.0 * bz * qy * f3 + (-2.0 * bx * qz + 2.0 * bz * qx) * f4
+                  + 2.0 * bx * qy * f5)
+            sx = (2.0 * qz * f0 + 2.0 * qw * f1 - 4.0 * qx * f2 + 2.0 * bz * qz * f3
+                  + (2.0 * bx * qy + 2.0 * bz * qw) * f4 + (2.0 * bx * qz - 4.0 * bz * qx) * f5)
+            sy = (-2.0 * qw * f0 + 2.0 * qz * f1 - 4.0 * qy * f2 + (-4.0 * bx * qy - 2.0 * bz * qw) * f3
+                  + (2.0 * bx * qx + 2.0 * bz * qz) * f4 + (2.0 * bx * qw - 4.0 * bz * qy) * f5)
+            sz = (2.0 * qx * f0 + 2.0 * qy * f1 + (-4.0 * bx * qz + 2.0 * bz * qx) * f3
+                  + (-2.0 * bx * qw + 2.0 * bz * qy) * f4 + 2.0 * bx * qx * f5)
+            norm = math.sqrt(sw * sw + sx * sx + sy * sy + sz * sz)
+            dw -= gain * sw / norm
+            dx -= gain * sx / norm
+            dy -= gain * sy / norm
+            dz -= gain * sz / norm
+    qw, qx, qy, qz = qw + dw * dt, qx + dx * dt, qy + dy * dt, qz + dz * dt
+    norm = math.sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+    return qw / norm, qx / norm, qy / norm, qz / norm
+
+
+class AttitudeFilter:
+    """Attitude estimate (sensor to ENU) of a MARG sensor, initialized from the first sample (e-compass)"""
+
+    def __init__(self, name=DEFAULT_FILTER, frequency=100.0, q=None):
+        """
+        :param name: Madgwick, Mahony or EKF
+        :param frequency: nominal sampling rate (Hz), the actual time between samples is used for updates
+        :param q: initial quaternion (w, x, y, z) sensor to ENU, from the first sample if not supplied
+        """
+        if name not in FILTERS:
+            raise ValueError("unknown attitude filter %s" % name)
+        self.name = name
+        self.q = q
+        self.time = None
+        if name == "Mahony":
+            mahony = Mahony(frequency=frequency)
+            self._update = lambda q, gyr, acc, mag, dt: mahony.updateMARG(np.asarray(q), gyr, acc, mag, dt)
+        elif name == "EKF":
+            ekf = EKF(frequency=frequency, frame="ENU")
+            ekf.mag = True  # the measurement model includes the magnetometer only if batch data was given
+            # the model expects the gravity direction, the accelerometers measure the opposite
+            self._update = lambda q, gyr, acc, mag, dt: ekf.update(np.asarray(q), gyr, -np.asarray(acc), mag, dt)
+        else:
+            self._update = lambda q, gyr, acc, mag, dt: nwu_to_enu(madgwick_marg(enu_to_nwu(q), gyr, acc, mag, dt))
+
+    def update(self, timestamp, gyr, acc, mag):
+        """
+        Update the estimate with a sample
+        :param timestamp: sample time (seconds)
+        :param gyr: gyroscope x, y, z (radians/s), lists of floats are the fastest input
+        :param acc: accelerometer x, y, z
+        :param mag: magnetometer x, y, z
+        :returns: quaternion (w, x, y, z) sensor to ENU
+        """
+        if self.q is None:
+            q = ecompass(np.asarray(acc), np.asarray(mag), frame="ENU", representation="quaternion")
+            self.q = tuple(q.tolist())  # floats, numpy scalars would slow down every update after
+        elif self.time is not None:
+            self.q = self._update(self.q, gyr, acc, mag, timestamp - self.time)
+        self.time = timestamp
+        return self.q
+
+    def process(self, times, gyr, acc, mag, out=None):
+        """
+        Update the estimate with a batch of samples
+        :param times: sample times array (n)
+        :param gyr: gyroscope array (n x 3)
+        :param acc: accelerometer array (n x 3)
+        :param mag: magnetometer array (n x 3)
+        :param out: array receiving the quaternions (at least n x 4), allocated if not supplied
+        :returns: quaternions array (n x 4, a view on out)
+        """
+        count = len(times)
+        if out is None:
+            out = np.empty((count, 4))
+        update = self.update
+        for index, sample in enumerate(zip(times.tolist(), gyr.tolist(), acc.tolist(), mag.tolist())):
+            out[index] = update(*sample)
+        return out[:count]
+
+
+def reprocess(times, gyr, acc, mag, name=DEFAULT_FILTER, q=None):
+    """
+    Run a filter over recorded samples (offline reprocessing)
+    :param times: sample times array (n)
+    :param gyr: gyroscope array (n x 3, radians/s)
+    :param acc: accelerometer array (n x 3)
+    :param mag: magnetometer array (n x 3)
+    :param name: Madgwick, Mahony or EKF
+    :param q: initial quaternion, from the first sample if not supplied
+    :returns: quaternions array (n x 4)
+    """
+    frequency = (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else 100.0
+    return AttitudeFilter(name, frequency, q).process(np.asarray(times), np.asarray(gyr), np.asarray(acc),
+                                                      np.asarray(mag))
@@ -0,0 +1,188 @@
+"""
+IMU boards on the excavator links (one FXOS8700 + FXAS21002C per ExcavatorPart, each on its own
+TCA9548A channel) sampled together at a fixed rate, their attitudes chained into the position of
+the bucket cutting edge relative to the GNSS antenna for every sample (forward kinematics).
+"""
+
+from collections import deque
+import logging
+import threading
+
+import numpy as np
+
+from constants import ExcavatorPart
+from imu.attitude import DEFAULT_FILTER, AttitudeFilter, enu_to_nwu
+from imu.fxos8700_fxas21001 import DEFAULT_RATE, SAMPLE_HISTORY, FXOS8700_FXAS21002C
+from ringbuffer import SPSCRingBuffer
+from rotate import quaternion_to_rpy, rotate_vector_batch
+from sampler import Sampler
+from utils import next_sequence
+
+# Links from the antenna (on the cab) to the bucket cutting edge
+CHAIN = (ExcavatorPart.CAB, ExcavatorPart.BOOM, ExcavatorPart.STICK, ExcavatorPart.BUCKET)
+
+
+def link_vectors(config):
+    """
+    Vector of every link in the frame of its IMU board, mounted with x along the link (towards the
+    next joint) and z up when the link is level
+    :param config: database.Config with antenna_height, boom_length, stick_length and bucket_length
+    :returns: dict of ExcavatorPart: (x, y, z) in meters
+    """
+    return {
+        ExcavatorPart.CAB: (0.0, 0.0, -(config.antenna_height or 0.0)),  # antenna to the boom foot
+        ExcavatorPart.BOOM: (config.boom_length or 0.0, 0.0, 0.0),  # boom foot to the stick joint
+        ExcavatorPart.STICK: (config.stick_length or 0.0, 0.0, 0.0),  # stick joint to the bucket joint
+        ExcavatorPart.BUCKET: (config.bucket_length or 0.0, 0.0, 0.0),  # bucket joint to the cutting edge
+    }
+
+
+def channel_orders(parts, channels):
+    """
+    Order in which the boards are read: by channel, reversed every other sample so the last channel
+    of a sample is the first one of the next (channels - 1 multiplexer switches per sample)
+    :param parts: parts in chain order
+    :param channels: dict of part: TCA9548A channel
+    :returns: two tuples of (index in parts, part), for even and odd samples
+    """
+    forward = tuple(sorted(enumerate(parts), key=lambda item: channels[item[1]]))
+    return forward, forward[::-1]
+
+
+class IMUChain(threading.Thread):
+    def __init__(self, mux, channels, links, notify=None, attitude=None, tip=None, rate=DEFAULT_RATE,
+                 filter_name=DEFAULT_FILTER):
+        """
+        :param mux: imu.tca9548a.TCA9548A the boards are connected to
+        :param channels: dict of ExcavatorPart: multiplexer channel, CAB is required
+        :param links: dict of ExcavatorPart: link vector (see link_vectors)
+        :param notify: called (without arguments) after a new sample was published.
+        :param attitude: RingBuffer receiving the (imu_time, cab quaternion, seq) samples, yaw measured from north.
+        :param tip: RingBuffer receiving the (imu_time, cutting edge east/north/up offset from the antenna, seq) samples.
+        :param rate: sampling rate in Hz of every board.
+        :param filter_name: attitude filter (imu.attitude.FILTERS).
+        """
+        super().__init__(daemon=True)
+        if ExcavatorPart.CAB not in channels:
+            raise ValueError("the IMU chain needs a CAB board")
+        self.parts = tuple(part for part in CHAIN if part in channels)
+        self.sensors = [FXOS8700_FXAS21002C(mux[channels[part]], rate=rate) for part in self.parts]
+        self._orders = channel_orders(self.parts, channels)
+        self._tick = 0
+        self._values = [()] * len(self.parts)
+        self.links = links
+        self.notify = notify
+        self.attitude = attitude
+        self.tip = tip
+        self.rate = rate
+        self._filter_name = filter_name
+        self.filters = [AttitudeFilter(filter_name, rate) for _ in self.parts]
+        self.samples = SPSCRingBuffer(SAMPLE_HISTORY, 9 * len(self.parts))
+        self._new_samples = threading.Event()
+        self.sampler = Sampler("IMU chain", self.read_raw, self.samples, rate, self._new_samples.set)
+        self.lost = 0
+        self._data_queue = deque(maxlen=1)
+        # buffers reused by every fusion batch
+        self._times = np.zeros(SAMPLE_HISTORY)
+        self._raw = np.zeros((SAMPLE_HISTORY, 9 * len(self.parts)))
+        self._calibrated = np.zeros((SAMPLE_HISTORY, 9))
+        self._quaternions = np.zeros((len(self.parts), SAMPLE_HISTORY, 4))
+        self._offset = np.zeros((SAMPLE_HISTORY, 3))
+        self._tip = np.zeros((SAMPLE_HISTORY, 3))
+        self.running = False
+
+    def read_raw(self):
+        """
+        Read all the boards, in channel order.
+        :returns: raw counts of every part (read_raw of the boards, in chain order)
+        """
+        values = self._values
+        for index, part in self._orders[self._tick & 1]:
+            values[index] = self.sensors[index].read_raw()
+        self._tick += 1
+        return sum(values, ())
+
+    def set_filter(self, filter_name):
+        """
+        Select the attitude filter, it takes over from the current estimates at the next batch.
+        :param filter_name: imu.attitude.FILTERS item
+        """
+        if filter_name != self._filter_name:
+            logging.info("IMU chain attitude filter changed to %s", filter_name)
+            self._filter_name = filter_name
+
+    def set_links(self, links):
+        """
+        Change the link vectors (used from the next batch).
+        :param links: dict of ExcavatorPart: link vector (see link_vectors)
+        """
+        self.links = links
+
+    def run(self):
+        """
+        Start the sampler and update the attitude of every link and the cutting edge position with every sample.
+        """
+        self.running = True
+        self.sampler.start()
+        position = 0
+        times, raw, calibrated, quaternions = self._times, self._raw, self._calibrated, self._quaternions
+        offset, tip = self._offset, self._tip
+        while self.running:
+            self._new_samples.wait(1)
+            self._new_samples.clear()
+            count, position, lost = self.samples.read_into(position, times, raw)
+            self.lost += lost
+            if not count:
+                continue
+            links = self.links
+            tip[:count] = 0
+            for index, part in enumerate(self.parts):
+                current = self.filters[index]
+                if self._filter_name != current.name:
+                    self.filters[index] = AttitudeFilter(self._filter_name, self.rate, current.q)
+                    self.filters[index].time = current.time
+                gyr, acc, mag = FXOS8700_FXAS21002C.calibrate(raw[:count, 9 * index:9 * index + 9],
+                                                              calibrated[:count])
+                self.filters[index].process(times[:count], gyr, acc, mag, quaternions[index])
+                rotate_vector_batch(quaternions[index, :count], links[part], offset[:count])
+                tip[:count] += offset[:count]
+            for sample, now in enumerate(times[:count].tolist()):
+                seq = next_sequence()
+                if self.attitude is not None:
+                    self.attitude.append(now, enu_to_nwu(quaternions[0, sample].tolist()), seq)
+                if self.tip is not None:
+                    self.tip.append(now, tip[sample], seq)
+            # the tip is computed in ENU, the attitudes are published with yaw measured from north
+            self._data_queue.append((tuple(enu_to_nwu(filter.q) for filter in self.filters), now, seq))
+            if self.notify:
+                self.notify()
+        self.sampler.stop()
+
+    def get_data(self):
+        """
+        Parse the IMU data after fusion applied.
+        :returns: dict with: roll, pitch, yaw (of the cab), boom_pitch, stick_pitch, bucket_pitch (of the
+            parts with a board), imu_time.
+        """
+        try:
+            quaternions, imu_time, seq = self._data_queue[-1]
+        except IndexError:
+            logging.error("No processed data available, make sure the IMU chain thread is started.")
+            return {}
+        roll, pitch, yaw = quaternion_to_rpy(quaternions[0])
+        data = {"roll": roll, "pitch": pitch, "yaw": yaw, "imu_time": imu_time, "seq": seq}
+        for part, q in zip(self.parts[1:], quaternions[1:]):
+            data["%s_pitch" % part.name.lower()] = quaternion_to_rpy(q)[1]
+        return data
+
+    def stats(self):
+        """
+        Sampling statistics.
+        :returns: dict with rate (Hz), jitter_ms, late_p99_ms, overruns, errors and lost samples.
+        """
+        return dict(self.sampler.stats(), lost=self.lost)
+
+    def stop(self):
+        """Set property to stop thread (and the sampler)"""
+        self.running = False
+        self.sampler.stop()
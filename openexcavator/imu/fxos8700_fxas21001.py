@@ -1,16 +1,18 @@
 from collections import deque
-import datetime
 import logging
+import math
+import struct
 import threading
 import time
-import board
-from adafruit_fxos8700 import FXOS8700
-from adafruit_fxas21002c import FXAS21002C
 
-import ahrs
-from ahrs.filters import Madgwick as Filter
 import numpy as np
 
+from imu.attitude import DEFAULT_FILTER, AttitudeFilter, enu_to_nwu
+from ringbuffer import SPSCRingBuffer
+from rotate import quaternion_to_rpy
+from sampler import Sampler
+from utils import next_sequence
+
 # Accelerometer correction values
 ACC_MULTIPLIER = np.array([0.10337778, 0.10565876, 0.10290373])
 ACC_ADD = np.array([-0.02782111, 0.05567155, -0.02035833])
@@ -21,69 +23,196 @@ GYR_SUB = np.array([0.013372903624167489, 0.0024461880297483025, 0.0060943352279
 # Magnetometer correction values
 MAG_SUB = np.array([-26.7, -29.35, -88.2])
 
+# I2C addresses and registers (same configuration as the Adafruit drivers: accelerometer +/- 2 g
+# in high resolution, magnetometer in hybrid mode with 16x oversampling, gyroscope +/- 250 dps)
+FXOS8700_ADDRESS = 0x1F
+FXAS21002C_ADDRESS = 0x21
+OUT_X_MSB = 0x01  # first output register of both chips
+FXOS8700_WHO_AM_I = (0x0D, 0xC7)
+FXOS8700_XYZ_DATA_CFG = 0x0E
+FXOS8700_CTRL_REG1 = 0x2A
+FXOS8700_CTRL_REG2 = 0x2B
+FXOS8700_M_CTRL_REG1 = 0x5B
+FXOS8700_M_CTRL_REG2 = 0x5C
+FXAS21002C_WHO_AM_I = (0x0C, 0xD7)
+FXAS21002C_CTRL_REG0 = 0x0D
+FXAS21002C_CTRL_REG1 = 0x13
+# Active mode control values per output data rate (hybrid mode rates for the FXOS8700)
+FXOS8700_ACTIVE = {100: 0x15, 200: 0x0D}
+FXAS21002C_ACTIVE = {100: 0x0E, 200: 0x0A}
+
+# Output registers read in a single transaction per chip: the FXOS8700 jumps from the last
+# accelerometer register (0x06) to the first magnetometer one (0x33) in hybrid auto-increment mode
+ACCEL_MAG_FORMAT = struct.Struct(">hhhhhh")
+GYRO_FORMAT = struct.Struct(">hhh")
+
+# Raw counts to m/s^2 (14 bit left aligned values), uTesla and radians/s
+ACC_SCALE = 0.000244 * 9.80665 / 4
+MAG_SCALE = 0.1
+GYR_SCALE = 0.0078125 * math.pi / 180
+# Calibration of the gyroscope, accelerometer, magnetometer raw counts as one scale and offset
+CALIBRATION_SCALE = np.concatenate(([GYR_SCALE] * 3, ACC_SCALE * ACC_MULTIPLIER, [MAG_SCALE] * 3))
+CALIBRATION_OFFSET = np.concatenate((GYR_SUB, -ACC_ADD, MAG_SUB))
+
+# Sampling rate (Hz) and samples kept between the sampler and the fusion filter
+DEFAULT_RATE = 100
+SAMPLE_HISTORY = 256
+
 
 class FXOS8700_FXAS21002C(threading.Thread):
-    def __init__(self, i2c=None):
+    def __init__(self, i2c=None, notify=None, attitude=None, rate=DEFAULT_RATE, filter_name=DEFAULT_FILTER):
         """
-        :param i2c: I2C bus, will be created if not supplied.
+        :param i2c: I2C bus (busio.I2C like: try_lock, unlock, writeto, writeto_then_readfrom),
+            will be created if not supplied.
+        :param notify: called (without arguments) after a new sample was published.
+        :param attitude: RingBuffer receiving the (imu_time, quaternion, seq) samples, yaw measured from north.
+        :param rate: sampling rate in Hz, the sensors run at 100 Hz up to 100 Hz and at 200 Hz above.
+        :param filter_name: attitude filter (imu.attitude.FILTERS).
         """
         super().__init__(daemon=True)
         # TODO: add try/except block for notifying the user when the IMU is not/incorrectly connected
-        # start I2C driver and initialize FXOS8700 and FXAS21002C
         if not i2c:
+            import board
+
             i2c = board.I2C()
-        self._fxos = FXOS8700(i2c)
-        self._fxas = FXAS21002C(i2c)
+        self._i2c = i2c
+        self._register = bytes((OUT_X_MSB,))
+        self._accel_mag = bytearray(ACCEL_MAG_FORMAT.size)
+        self._gyro = bytearray(GYRO_FORMAT.size)
+        self.configure(100 if rate <= 100 else 200)
         self._imu_time = None
         self._data_queue = deque(maxlen=1)
+        self.notify = notify
+        self.attitude = attitude
+        self.samples = SPSCRingBuffer(SAMPLE_HISTORY, 9)
+        self._new_samples = threading.Event()
+        self.sampler = Sampler("FXOS8700+FXAS21002C", self.read_raw, self.samples, rate, self._new_samples.set)
+        self.lost = 0  # samples overwritten before the filter used them
+        self.rate = rate
+        self.filter = AttitudeFilter(filter_name, rate)
+        self._filter_name = filter_name
+        # buffers reused by every fusion batch
+        self._times = np.zeros(SAMPLE_HISTORY)
+        self._raw = np.zeros((SAMPLE_HISTORY, 9))
+        self._calibrated = np.zeros((SAMPLE_HISTORY, 9))
+        self._quaternions = np.zeros((SAMPLE_HISTORY, 4))
+        self.running = False
 
-    def read_all(self):
+    def write_register(self, address, register, value):
+        """Write a single register"""
+        while not self._i2c.try_lock():
+            pass
+        try:
+            self._i2c.writeto(address, bytes((register, value)))
+        finally:
+            self._i2c.unlock()
+
+    def read_register(self, address, register):
+        """Read a single register"""
+        value = bytearray(1)
+        while not self._i2c.try_lock():
+            pass
+        try:
+            self._i2c.writeto_then_readfrom(address, bytes((register,)), value)
+        finally:
+            self._i2c.unlock()
+        return value[0]
+
+    def configure(self, odr):
         """
-        Read all the raw sensor values at once.
-        :returns: gyroscope(x,y,z), accelerometer(x,y,z), magnetometer(x,y,z)
+        Check the chips and start them (from standby) at an output data rate.
+        :param odr: 100 or 200 Hz
         """
-        return self.read_gyroscope(), self.read_accelerometer(), self.read_magnetometer()
+        for name, address, (register, expected) in (("FXOS8700", FXOS8700_ADDRESS, FXOS8700_WHO_AM_I),
+                                                    ("FXAS21002C", FXAS21002C_ADDRESS, FXAS21002C_WHO_AM_I)):
+            if self.read_register(address, register) != expected:
+                raise RuntimeError("%s not found at I2C address 0x%02X" % (name, address))
+        self.write_register(FXOS8700_ADDRESS, FXOS8700_CTRL_REG1, 0x00)  # standby
+        self.write_register(FXOS8700_ADDRESS, FXOS8700_XYZ_DATA_CFG, 0x00)  # +/- 2 g
+        self.write_register(FXOS8700_ADDRESS, FXOS8700_CTRL_REG2, 0x02)  # high resolution
+        self.write_register(FXOS8700_ADDRESS, FXOS8700_M_CTRL_REG1, 0x1F)  # hybrid mode, 16x oversampling
+        self.write_register(FXOS8700_ADDRESS, FXOS8700_M_CTRL_REG2, 0x20)  # hybrid auto-increment
+        self.write_register(FXOS8700_ADDRESS, FXOS8700_CTRL_REG1, FXOS8700_ACTIVE[odr])
+        self.write_register(FXAS21002C_ADDRESS, FXAS21002C_CTRL_REG1, 0x00)  # standby
+        self.write_register(FXAS21002C_ADDRESS, FXAS21002C_CTRL_REG0, 0x03)  # +/- 250 dps
+        self.write_register(FXAS21002C_ADDRESS, FXAS21002C_CTRL_REG1, FXAS21002C_ACTIVE[odr])
+        time.sleep(0.1)  # standby to active transition: 60 ms + 1 / ODR
 
-    def read_accelerometer(self):
+    def read_raw(self):
         """
-        Read the raw accelerometer value (m/s^2).
-        :returns: accelerometer x,y,z
+        Read all the sensor outputs with one burst read per chip (while holding the bus once).
+        :returns: raw counts: gyroscope(x,y,z), accelerometer(x,y,z), magnetometer(x,y,z)
         """
-        return np.add(np.multiply(np.asarray(self._fxos.accelerometer), ACC_MULTIPLIER), ACC_ADD)
+        i2c = self._i2c
+        while not i2c.try_lock():
+            pass
+        try:
+            i2c.writeto_then_readfrom(FXAS21002C_ADDRESS, self._register, self._gyro)
+            i2c.writeto_then_readfrom(FXOS8700_ADDRESS, self._register, self._accel_mag)
+        finally:
+            i2c.unlock()
+        return GYRO_FORMAT.unpack(self._gyro) + ACCEL_MAG_FORMAT.unpack(self._accel_mag)
 
-    def read_magnetometer(self):
+    @staticmethod
+    def calibrate(raw, out=None):
         """
-        Read the raw magnetometer value (uTesla).
-        :returns: magnetometer x,y,z
+        Convert raw counts to calibrated values.
+        :param raw: array of raw samples (n x 9) as returned by read_raw
+        :param out: array receiving the calibrated samples (n x 9), allocated if not supplied
+        :returns: gyroscope (radians/s), accelerometer (m/s^2 corrected), magnetometer (uTesla) arrays (n x 3)
         """
-        return np.subtract(np.asarray(self._fxos.magnetometer), MAG_SUB)
+        out = np.multiply(raw, CALIBRATION_SCALE, out=out)
+        np.subtract(out, CALIBRATION_OFFSET, out=out)
+        return out[:, 0:3], out[:, 3:6], out[:, 6:9]
 
-    def read_gyroscope(self):
+    def read_all(self):
         """
-        Read the raw gyroscope value (radians/s).
-        :returns: gyroscope x,y,z
+        Read all the calibrated sensor values at once.
+        :returns: gyroscope(x,y,z), accelerometer(x,y,z), magnetometer(x,y,z)
         """
-        return np.subtract(np.asarray(self._fxas.gyroscope), GYR_SUB)
+        gyr, acc, mag = self.calibrate(np.array([self.read_raw()], dtype=float))
+        return gyr[0], acc[0], mag[0]
+
+    def set_filter(self, filter_name):
+        """
+        Select the attitude filter, it takes over from the current estimate at the next batch.
+        :param filter_name: imu.attitude.FILTERS item
+        """
+        if filter_name != self._filter_name:
+            logging.info("IMU attitude filter changed to %s", filter_name)
+            self._filter_name = filter_name
 
     def run(self):
         """
-        Start the fusion model updating loop.
+        Start the sampler and update the fusion model with every sample, in batches when the filter lags.
         """
         self.running = True
-        filter = Filter()
-        q = ahrs.common.orientation.ecompass(
-            self.read_accelerometer(),
-            self.read_magnetometer(),
-            frame="ENU",
-            representation="quaternion",
-        )
-        while True:
-            data = self.read_all()
-            now = datetime.datetime.utcnow().timestamp()
-            q = filter.updateMARG(q, *data, dt=now - self._imu_time if self._imu_time else None)
-            self._imu_time = now
-            self._data_queue.append(ahrs.common.orientation.q2rpy(q, in_deg=True))
-            time.sleep(0.05)  # Allow other threads to access i2c bus.
+        self.sampler.start()
+        position = 0
+        times, raw, calibrated, quaternions = self._times, self._raw, self._calibrated, self._quaternions
+        while self.running:
+            self._new_samples.wait(1)
+            self._new_samples.clear()
+            count, position, lost = self.samples.read_into(position, times, raw)
+            self.lost += lost
+            if not count:
+                continue
+            if self._filter_name != self.filter.name:
+                filter = AttitudeFilter(self._filter_name, self.rate, self.filter.q)
+                filter.time = self.filter.time
+                self.filter = filter
+            self.calibrate(raw[:count], calibrated[:count])
+            self.filter.process(times[:count], calibrated[:count, 0:3], calibrated[:count, 3:6],
+                                calibrated[:count, 6:9], quaternions)
+            for now, q in zip(times[:count].tolist(), quaternions[:count].tolist()):
+                seq = next_sequence()
+                if self.attitude is not None:
+                    self.attitude.append(now, enu_to_nwu(q), seq)
+            self._imu_time = float(times[count - 1])
+            self._data_queue.append((enu_to_nwu(self.filter.q), self._imu_time, seq))
+            if self.notify:
+                self.notify()
+        self.sampler.stop()
 
     def get_data(self):
         """
@@ -91,20 +220,30 @@ class FXOS8700_FXAS21002C(threading.Thread):
         :returns: dict with: roll, pitch, yaw, imu_time.
         """
         try:
-            data = self._data_queue[-1]
+            q, imu_time, seq = self._data_queue[-1]
+            roll, pitch, yaw = quaternion_to_rpy(q)
             return {
-                "roll": data[0],
-                "pitch": data[1],
-                "yaw": data[2],
-                "imu_time": self._imu_time,
+                "roll": roll,
+                "pitch": pitch,
+                "yaw": yaw,
+                "imu_time": imu_time,
+                "seq": seq,
             }
         except IndexError:
             logging.error("No processed data available, make sure the IMU thread is started.")
             return {}
 
+    def stats(self):
+        """
+        Sampling statistics.
+        :returns: dict with rate (Hz), jitter_ms, late_p99_ms, overruns, errors and lost samples.
+        """
+        return dict(self.sampler.stats(), lost=self.lost)
+
     def stop(self):
-        """Set property to stop thread"""
+        """Set property to stop thread (and the sampler)"""
         self.running = False
+        self.sampler.stop()
 
 
 def test_loop():
@@ -113,9 +252,10 @@ def test_loop():
     time.sleep(1)
     while True:
         # print("----------------------------------------------------")
-        # print('Acceleration (m/s^2): ({0:0.3f},{1:0.3f},{2:0.3f})'.format(*imu.read_accelerometer()))
-        # print('Magnetometer (uTesla): ({0:0.3f},{1:0.3f},{2:0.3f})'.format(*imu.read_magnetometer()))
-        # print('Gyroscope (radians/s): ({0:0.3f},{1:0.3f},{2:0.3f})'.format(*imu.read_gyroscope()))
+        # gyr, acc, mag = imu.read_all()
+        # print('Acceleration (m/s^2): ({0:0.3f},{1:0.3f},{2:0.3f})'.format(*acc))
+        # print('Magnetometer (uTesla): ({0:0.3f},{1:0.3f},{2:0.3f})'.format(*mag))
+        # print('Gyroscope (radians/s): ({0:0.3f},{1:0.3f},{2:0.3f})'.format(*gyr))
 
         print("Roll: {0:0.3f}, pitch: {1:0.3f}, heading: {2:0.3f}, Time: {3:0.2f}".format(*imu.get_data().values()))
         time.sleep(0.5)
@@ -1,52 +1,227 @@
 from collections import deque
 import logging
-from typing import Callable
+from typing import Callable, Optional, Tuple
+
+import settings
+from constants import ExcavatorPart
+from ringbuffer import RingBuffer
+from rotate import quaternion_to_rpy, slerp
+from utils import handover, start_source
+
+# TCA9548A multiplexer channel the FXOS8700 + FXAS21001 board is connected to
+I2C_CHANNEL = 2
+# Number of attitude samples kept for time alignment (a few seconds at the IMU rates used)
+ATTITUDE_HISTORY = 512
+
+# Config keys used by each IMU type, the source is rebuilt when one of them changes.
+SOURCE_KEYS = {
+    "Reach": ("imu_host", "imu_port"),
+    "Simulator": ("imu_host", "imu_port"),
+    "FXOS8700+FXAS21001": (),
+    "FXOS8700+FXAS21001 chain": (),
+}
 
 
 class IMUHandler:
-    def __init__(self, config, i2c=None):
+    def __init__(self, config, i2c=None, notify=None):
+        """
+        :param config: config dict.
+        :param i2c: I2C bus the TCA9548A multiplexer of the IMU boards is on, board.I2C() if not supplied.
+        :param notify: called (without arguments) by the sources after publishing new data.
+        """
         self.threads = []
-        self.__data_func = self._parse_data_func(config, i2c)
+        self.old_threads = []  # threads of the replaced source, serving data until the new one does
+        self.notify = notify
+        self.i2c = i2c
+        self.mux = None
+        self.source_key = self.get_source_key(config)
+        self.__data_func, self.attitude, self.tip = self._parse_data_func(config)
+        self.__old_func = None
+
+    @staticmethod
+    def get_source_key(config):
+        """
+        Get the values identifying the IMU source.
+        :returns: tuple with imu_type and the config values used by that type.
+        """
+        imu_type = config["imu_type"]
+        return (imu_type,) + tuple(config[key] for key in SOURCE_KEYS.get(imu_type, ()))
+
+    def update_config(self, config):
+        """
+        Apply a new config in place: the attitude filter and link lengths go to the running sensor fusion and the IMU
+        source is only rebuilt if its parameters changed, the old one serves data until the new one does.
+        :returns: True if the IMU source was rebuilt.
+        """
+        for thread in self.threads:
+            if hasattr(thread, "set_filter"):
+                thread.set_filter(config["imu_filter"])
+            if hasattr(thread, "set_links"):
+                from imu.chain import link_vectors
+
+                thread.set_links(link_vectors(config))
+        source_key = self.get_source_key(config)
+        if source_key == self.source_key:
+            return False
+        logging.info("IMU source changed to %s", source_key)
+        if self.__old_func is not None:  # the previous replacement never returned data, drop it and keep the old source
+            for thread in self.threads:
+                thread.stop()
+            old_func = self.__old_func
+        else:
+            self.old_threads = self.threads
+            old_func = self.__data_func
+        self.threads = []
+        self.source_key = source_key
+        new_func, new_attitude, new_tip = self._parse_data_func(config)
+
+        def switch():
+            if self.__data_func is not data_func:  # replaced by a newer config meanwhile
+                return
+            self.__data_func = new_func
+            self.__old_func = None
+            self.attitude = new_attitude
+            self.tip = new_tip
+            old_threads, self.old_threads = self.old_threads, []
+            for thread in old_threads:
+                thread.stop()
+            logging.info("IMU source switched, old threads stopped")
+
+        data_func = handover(old_func, new_func, switch)
+        self.__old_func = old_func
+        self.__data_func = data_func
+        return True
 
     def get_data(self):
         """
         Get the current IMU data.
-        :returns: dict with: roll, pitch, yaw, imu_time.
+        :returns: dict with: roll, pitch, yaw, imu_time, seq (empty if no data yet).
         """
-        return self.__data_func()
+        try:
+            return self.__data_func()
+        except IndexError:
+            return {}
 
-    def _parse_data_func(self, config, i2c) -> Callable:
+    def check_handover(self):
+        """
+        Switch to the new source (and its ring buffers) if it returned data since the last config change, the
+        attitude path reads the buffers directly and would otherwise keep using the old source.
+        """
+        if self.__old_func is not None:
+            self.get_data()
+
+    def get_attitude(self, timestamp):
+        """
+        Get the IMU attitude at a given time, interpolated (slerp) between the buffered samples around it;
+        the nearest sample is used when timestamp is outside the buffered range.
+        :param timestamp: time (seconds since epoch) to align to, usually the GNSS epoch time.
+        :returns: dict with: roll, pitch, yaw, imu_time (time the attitude refers to), seq (of the newer sample used).
+        """
+        self.check_handover()
+        attitude = self.attitude
+        samples = attitude.bracket(timestamp) if attitude is not None else None
+        if samples is None:
+            return self.get_data()
+        (time0, q0, seq0), (time1, q1, seq1) = samples
+        if time1 > time0:
+            q = slerp(q0, q1, (timestamp - time0) / (time1 - time0))
+            imu_time = timestamp
+        else:
+            q = q0
+            imu_time = time0
+        roll, pitch, yaw = quaternion_to_rpy(q)
+        return {"roll": roll, "pitch": pitch, "yaw": yaw, "imu_time": imu_time, "seq": seq1}
+
+    def get_tip(self, timestamp=None):
+        """
+        Get the bucket cutting edge offset from the antenna at a given time, linearly interpolated between
+        the buffered samples around it (sources computing it only: IMU chains).
+        :param timestamp: time (seconds since epoch) to align to, the newest sample if None.
+        :returns: east, north, up offset in meters or None if not available.
+        """
+        self.check_handover()
+        tip = self.tip
+        samples = tip.bracket(timestamp if timestamp is not None else float("inf")) if tip is not None else None
+        if samples is None:
+            return None
+        (time0, offset0, _), (time1, offset1, _) = samples
+        if time1 > time0:
+            return offset0 + (offset1 - offset0) * ((timestamp - time0) / (time1 - time0))
+        return offset0
+
+    def get_mux(self):
+        """
+        Get the TCA9548A multiplexer the IMU boards are connected to, shared by the sources so the
+        selected channel is always known.
+        """
+        if self.mux is None:
+            from imu.tca9548a import TCA9548A
+
+            if self.i2c is None:  # the I2C bus is only needed (and available) on the excavator
+                import board
+
+                self.i2c = board.I2C()
+            self.mux = TCA9548A(self.i2c)
+        return self.mux
+
+    def _parse_data_func(self, config) -> Tuple[Callable, Optional[RingBuffer], Optional[RingBuffer]]:
         """
         Parse a IMU data function with no parameters and and return it.
-        :returns: function that return dict with: roll, pitch, yaw, imu_time.
+        :returns: function that return dict with: roll, pitch, yaw, imu_time, the attitude ring buffer
+            the source writes to (None if the source does not keep a history) and the cutting edge
+            offset ring buffer (None if the source does not compute it).
         """
         if config["imu_type"] == "Reach":
             from reach.imu import ReachIMU
 
             imu_queue = deque(maxlen=1)
-            reach_imu = ReachIMU(config["imu_host"], int(config["imu_port"]), imu_queue)
-            reach_imu.start()
+            attitude = RingBuffer(ATTITUDE_HISTORY, 4)
+            reach_imu = ReachIMU(config["imu_host"], int(config["imu_port"]), imu_queue, self.notify, attitude)
+            start_source(reach_imu)
             self.threads.append(reach_imu)
-            return lambda: imu_queue[-1]
+            return lambda: imu_queue[-1], attitude, None
 
         if config["imu_type"] == "Simulator":
-            # from simulator.imu import SimulatorIMU
+            from reach.imu import ReachIMU
+            from simulator import ReplayServer, load_log
 
-            # sim_imu = SimulatorIMU(config["imu_host"], int(config["imu_port"]))
-            # sim_imu.start()
-            # self.threads.append(sim_imu)
-            # return lambda: sim_imu.get_data()
-            return NotImplementedError
+            replay = ReplayServer(load_log(settings.SIMULATOR_IMU_LOG, "imu"), config["imu_host"] or "127.0.0.1",
+                                  int(config["imu_port"] or 0), speed=settings.SIMULATOR_SPEED,
+                                  jitter=settings.SIMULATOR_JITTER, loss=settings.SIMULATOR_LOSS)
+            replay.start()
+            self.threads.append(replay)
+            imu_queue = deque(maxlen=1)
+            attitude = RingBuffer(ATTITUDE_HISTORY, 4)
+            reach_imu = ReachIMU(replay.host, replay.port, imu_queue, self.notify, attitude)
+            start_source(reach_imu)
+            self.threads.append(reach_imu)
+            return lambda: imu_queue[-1], attitude, None
 
         if config["imu_type"] == "FXOS8700+FXAS21001":
             from imu.fxos8700_fxas21001 import FXOS8700_FXAS21002C
 
-            fxos8700_fxas21001_imu = FXOS8700_FXAS21002C(i2c)
+            attitude = RingBuffer(ATTITUDE_HISTORY, 4)
+            fxos8700_fxas21001_imu = FXOS8700_FXAS21002C(self.get_mux()[I2C_CHANNEL], notify=self.notify,
+                                                         attitude=attitude, rate=settings.IMU_RATE,
+                                                         filter_name=config["imu_filter"])
             fxos8700_fxas21001_imu.start()
             self.threads.append(fxos8700_fxas21001_imu)
-            return lambda: fxos8700_fxas21001_imu.get_data()
+            return lambda: fxos8700_fxas21001_imu.get_data(), attitude, None
+
+        if config["imu_type"] == "FXOS8700+FXAS21001 chain":
+            from imu.chain import IMUChain, link_vectors
 
-        return NotImplementedError
+            attitude = RingBuffer(ATTITUDE_HISTORY, 4)
+            tip = RingBuffer(ATTITUDE_HISTORY, 3)
+            channels = {ExcavatorPart[name]: channel for name, channel in settings.IMU_CHAIN_CHANNELS.items()}
+            imu_chain = IMUChain(self.get_mux(), channels, link_vectors(config), notify=self.notify,
+                                 attitude=attitude, tip=tip, rate=settings.IMU_RATE, filter_name=config["imu_filter"])
+            imu_chain.start()
+            self.threads.append(imu_chain)
+            return lambda: imu_chain.get_data(), attitude, tip
+
+        logging.error("unknown IMU type %s", config["imu_type"])
+        return dict, None, None
 
     def disconnect_source(self):
         for thread in self.threads:
@@ -55,11 +230,12 @@ class IMUHandler:
 
     def stop(self):
         """Stop IMU threads if they are running."""
-        if len(self.threads) == 0:
+        if len(self.threads) == 0 and len(self.old_threads) == 0:
             return
 
-        for thread in self.threads:
+        for thread in self.threads + self.old_threads:
             thread.stop()
         self.threads = []
+        self.old_threads = []
         logging.info("IMU threads stopped")
         return True
@@ -0,0 +1,75 @@
+"""
+TCA9548A I2C multiplexer that keeps the last selected channel: unlike the Adafruit driver (which
+selects the channel on every lock and deselects it on unlock) the control register is only written
+when a transaction goes to another channel than the previous one.
+"""
+
+import threading
+
+DEFAULT_ADDRESS = 0x70
+CHANNELS = 8
+
+
+class TCA9548A:
+    def __init__(self, i2c, address=DEFAULT_ADDRESS):
+        """
+        :param i2c: I2C bus the multiplexer is on (busio.I2C like: try_lock, unlock, writeto, writeto_then_readfrom)
+        :param address: multiplexer I2C address
+        """
+        self.i2c = i2c
+        self.address = address
+        self.selected = None  # channel currently connected to the bus
+        self.switches = 0  # control register writes
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def __getitem__(self, channel):
+        """
+        :param channel: 0 to 7
+        :returns: MuxChannel, usable as an I2C bus by the sensor drivers
+        """
+        if not 0 <= channel < CHANNELS:
+            raise IndexError("TCA9548A channel %s out of range" % channel)
+        if channel not in self._channels:
+            self._channels[channel] = MuxChannel(self, channel)
+        return self._channels[channel]
+
+    def select(self, channel):
+        """Connect a channel to the bus if it is not already (bus locked by the caller)"""
+        if channel != self.selected:
+            self.i2c.writeto(self.address, bytes((1 << channel,)))
+            self.selected = channel
+            self.switches += 1
+
+
+class MuxChannel:
+    """busio.I2C like bus of a multiplexer channel, holding the lock selects the channel"""
+
+    def __init__(self, mux, channel):
+        self.mux = mux
+        self.channel = channel
+
+    def try_lock(self):
+        mux = self.mux
+        if not mux._lock.acquire(blocking=False):
+            return False
+        while not mux.i2c.try_lock():
+            pass
+        try:
+            mux.select(self.channel)
+        except OSError:
+            mux.selected = None
+            mux.i2c.unlock()
+            mux._lock.release()
+            raise
+        return True
+
+    def unlock(self):
+        self.mux.i2c.unlock()
+        self.mux._lock.release()
+
+    def writeto(self, address, buffer, **kwargs):
+        self.mux.i2c.writeto(address, buffer, **kwargs)
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, **kwargs):
+        self.mux.i2c.writeto_then_readfrom(address, buffer_out, buffer_in, **kwargs)
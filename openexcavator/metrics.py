@@ -0,0 +1,181 @@
+"""
+Pipeline metrics exported in the Prometheus text format on /metrics. Counters and histograms are
+updated in the hot paths: an update is an addition (and a bisect for histograms) on a child
+resolved once by its owner, every child is written by a single thread so there is no lock.
+Collected metrics read the running objects (queues, samplers, RTCM writer) only when scraped.
+"""
+
+import bisect
+import math
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from sub-millisecond parsing to a late WebSocket write
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+REGISTRY = []
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """Metric family: one child per label values, the unlabelled metric is its only child"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None, register=True):
+        """
+        :param name: metric name
+        :param documentation: HELP text
+        :param labelnames: tuple of label names
+        :param collect: function called when scraped instead of keeping children, returning the value
+            (unlabelled) or a dict of label values tuple: value, None values are left out
+        :param register: add to REGISTRY (exported on /metrics)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.children = {}
+        if register:
+            REGISTRY.append(self)
+
+    def labels(self, *values):
+        """
+        :param values: label values, in labelnames order
+        :returns: child to update, meant to be kept by the caller
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        return CounterChild()
+
+    def values(self):
+        """
+        :returns: list of (label values tuple, value)
+        """
+        if self.collect is None:
+            return [(labels, child.value) for labels, child in list(self.children.items())]
+        try:
+            values = self.collect()
+        except Exception:
+            return []  # source being replaced, nothing to report until the next scrape
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(labels, value) for labels, value in values.items() if value is not None]
+
+    def samples(self):
+        """
+        :returns: list of (name suffix, label pairs, value) exported for this family
+        """
+        return [("", tuple(zip(self.labelnames, labels)), value) for labels, value in self.values()]
+
+
+class Counter(Metric):
+    """Monotonic count, updated with labels(...).inc()"""
+
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """Current value, collected when scraped"""
+
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    """Distribution of observed values (seconds), updated with labels(...).observe(value)"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, register=True):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, register=register)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        samples = []
+        for labels, child in list(self.children.items()):
+            pairs = tuple(zip(self.labelnames, labels))
+            counts = list(child.counts)
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                samples.append(("_bucket", pairs + (("le", format_value(bound)),), total))
+            samples.append(("_sum", pairs, child.sum))
+            samples.append(("_count", pairs, total))
+        return samples
+
+
+def format_value(value):
+    """Number in the exposition format"""
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = ('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in pairs)
+    return "{%s}" % ",".join(escaped)
+
+
+def render(registry=None):
+    """
+    Export metrics in the Prometheus text format
+    :param registry: list of metrics, REGISTRY if not supplied
+    :returns: str
+    """
+    lines = []
+    for metric in REGISTRY if registry is None else registry:
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for suffix, pairs, value in metric.samples():
+            lines.append("%s%s%s %s" % (metric.name, suffix, format_labels(pairs), format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+# Pipeline stages: socket (or serial) read to parsed epoch, parsed epoch to fused frame, fused frame
+# to WebSocket write
+PARSE_LATENCY = Histogram("openexcavator_parse_latency_seconds",
+                          "Time from receiving the bytes completing an epoch to publishing it", ("source",))
+FUSE_LATENCY = Histogram("openexcavator_fuse_latency_seconds",
+                         "Time from publishing a GNSS epoch to publishing its fused frame")
+SEND_LATENCY = Histogram("openexcavator_send_latency_seconds",
+                         "Time from publishing a fused frame to writing it to a WebSocket client")
+LOOP_ITERATIONS = Counter("openexcavator_loop_iterations_total", "Iterations of the thread loops", ("thread",))
+RECONNECTS = Counter("openexcavator_reconnects_total", "Connections lost or failed, per source", ("source",))
+DROPPED_FRAMES = Counter("openexcavator_dropped_frames_total",
+                         "Fused frames not delivered: replaced before the broadcast or skipped for a slow "
+                         "client", ("reason",))
@@ -13,16 +13,22 @@ import tornado.web
 from collections import deque
 
 import database
+import design
 import handlers
+import metrics
+import recorder
 import settings
+import surface
+from broadcast import Broadcaster
 from reach.data import DataManager
-from utils import format_frame
+from utils import format_frame, start_source
 from wifimanager import WifiManager
 
 
 def app_exit():
     """Execute cleanup and exit"""
     logging.info("finished")
+    recorder.stop_recording()
     tornado.ioloop.IOLoop.instance().stop()
     sys.exit()
 
@@ -40,6 +46,77 @@ def configure_signals():
     signal.signal(signal.SIGTERM, stopping_handler)
 
 
+def configure_designs(database):
+    """
+    Create the designs tables if needed and move the design path and surface stored in config by
+    versions without designs to an active design
+    :param database: database module
+    """
+    database.create_structure()
+    legacy = database.legacy_design()
+    if legacy is None:
+        return
+    try:
+        artifact = design.load_artifact(legacy["path"]) if legacy.get("path") else None
+        design_surface = surface.Surface.from_id(legacy["surface"]) if legacy.get("surface") else None
+        name = "Design %d" % (len(database.get_designs()) + 1)
+        database.add_design(name, float(legacy["start_altitude"]), float(legacy["stop_altitude"]),
+                            **design.design_record(artifact, design_surface))
+        logging.info("design stored in config moved to %s", name)
+    except (KeyError, OSError, ValueError) as exc:
+        logging.warning("cannot move the design stored in config: %s", exc)
+
+
+def configure_metrics(application):
+    """Register the metrics read from the running application objects when /metrics is scraped"""
+
+    def source_threads():
+        return application.data_manager.gps.threads + application.data_manager.imu.threads
+
+    def queue_depths():
+        depths = {("recorder_%s" % rec.prefix,): rec.queue.qsize() for rec in recorder.active_recorders()}
+        ntrip_client = application.data_manager.gps.ntrip_client
+        if ntrip_client is not None:
+            depths[("ntrip",)] = len(ntrip_client.queue)
+        return depths
+
+    def dropped_items():
+        dropped = {("recorder_%s" % rec.prefix,): rec.dropped for rec in recorder.active_recorders()}
+        ntrip_client = application.data_manager.gps.ntrip_client
+        if ntrip_client is not None:
+            dropped[("ntrip",)] = ntrip_client.queue.dropped
+        return dropped
+
+    def rtcm_stats(key):
+        return {(): thread.rtcm_writer.stats()[key] for thread in application.data_manager.gps.threads
+                if getattr(thread, "rtcm_writer", None)}
+
+    def sampler_stats(key, scale=1):
+        return {(thread.sampler.sensor_name,): thread.stats()[key] * scale for thread in source_threads()
+                if hasattr(thread, "sampler")}
+
+    metrics.Gauge("openexcavator_ws_clients", "Connected WebSocket clients",
+                  collect=lambda: len(application.broadcaster.clients))
+    metrics.Gauge("openexcavator_queue_depth", "Items waiting in the queues between threads", ("queue",),
+                  collect=queue_depths)
+    metrics.Counter("openexcavator_queue_dropped_total", "Items dropped by full queues", ("queue",),
+                    collect=dropped_items)
+    metrics.Gauge("openexcavator_rtcm_age_seconds", "Time since corrections were last written to the receiver",
+                  collect=lambda: rtcm_stats("rtcm_age"))
+    metrics.Gauge("openexcavator_rtcm_bytes_per_second", "Corrections written to the receiver",
+                  collect=lambda: rtcm_stats("rtcm_bps"))
+    metrics.Gauge("openexcavator_sampling_rate_hz", "Achieved sensor sampling rate", ("sensor",),
+                  collect=lambda: sampler_stats("rate"))
+    metrics.Gauge("openexcavator_sampling_jitter_seconds", "Standard deviation of the sampling intervals",
+                  ("sensor",), collect=lambda: sampler_stats("jitter_ms", 0.001))
+    metrics.Counter("openexcavator_sampling_overruns_total", "Sampling ticks skipped", ("sensor",),
+                    collect=lambda: sampler_stats("overruns"))
+    metrics.Counter("openexcavator_sampling_errors_total", "Sensor read errors", ("sensor",),
+                    collect=lambda: sampler_stats("errors"))
+    metrics.Counter("openexcavator_sampling_lost_total", "Samples overwritten before the fusion read them",
+                    ("sensor",), collect=lambda: sampler_stats("lost"))
+
+
 def main():
     """
     Load database configuration, start GPS thread and main Tornado app
@@ -48,7 +125,11 @@ def main():
         [
             (r"/", handlers.HomeHandler),
             (r"/debug", handlers.DebugHandler),
+            (r"/debug/profile", handlers.ProfileHandler),
             (r"/data", handlers.DataHandler),
+            (r"/designs", handlers.DesignsHandler),
+            (r"/path", handlers.PathHandler),
+            (r"/metrics", handlers.MetricsHandler),
             (r"/tools", handlers.ToolsHandler),
             (r"/update", handlers.UpdateHandler)
         ],
@@ -59,11 +140,25 @@ def main():
     )
 
     application.database = database
+    application.database.create_structure()
+    added = application.database.populate_config()
+    if added:
+        logging.info("config keys added with default values: %s", ", ".join(added))
+    configure_designs(application.database)
     config = application.database.get_config()
     logging.info("creating new DataManager thread")
     application.data_queue = deque(maxlen=1)
-    application.data_manager = DataManager(config, application.data_queue)
-    application.data_manager.start()
+    application.broadcaster = Broadcaster(tornado.ioloop.IOLoop.current())
+    listeners = [application.broadcaster.publish]
+    if settings.RECORD_PATH:
+        frame_recorder = recorder.start_recording(
+            settings.RECORD_PATH, settings.RECORD_RAW, max_file_size=settings.RECORD_FILE_SIZE,
+            max_files=settings.RECORD_FILES, flush_interval=settings.RECORD_FLUSH_INTERVAL,
+            fsync_interval=settings.RECORD_FSYNC_INTERVAL)
+        listeners.append(frame_recorder.record_frame)
+    application.data_manager = DataManager(config, application.data_queue, listeners=listeners)
+    configure_metrics(application)
+    start_source(application.data_manager)
     logging.info("creating new WifiManager thread")
     application.wifi_manager = WifiManager(config["wifi_ssid"], config["wifi_psk"])
     application.wifi_manager.start()
@@ -0,0 +1,135 @@
+"""
+Sampling profiler for the running application: a thread reads the current frame of every other
+thread (sys._current_frames) at a fixed interval and counts the call stacks, the result is in the
+collapsed format of flamegraph.pl / speedscope ("thread;outer;...;inner count" lines).
+"""
+
+import os
+import sys
+import threading
+import time
+
+DEFAULT_INTERVAL = 0.01  # seconds between samples, 100 Hz keeps the overhead low on the Pi
+MIN_INTERVAL = 0.001
+MAX_SECONDS = 120
+
+_lock = threading.Lock()  # one profile at a time
+
+
+def frame_label(code, labels):
+    """
+    Name of a stack entry: file and function (qualified name when available)
+    :param code: code object of the frame
+    :param labels: dict of code: label, cache filled here
+    :returns: str
+    """
+    label = labels.get(code)
+    if label is None:
+        name = getattr(code, "co_qualname", code.co_name)
+        label = labels[code] = "%s:%s" % (os.path.basename(code.co_filename), name)
+    return label
+
+
+def thread_label(thread):
+    """Name of a thread: class name for the Thread subclasses (DataManager, UBX...), its name otherwise"""
+    if type(thread) is threading.Thread or type(thread).__module__ == "threading":
+        return thread.name
+    return type(thread).__name__
+
+
+class SamplingProfiler(threading.Thread):
+    """Count the call stacks of all the other threads until stopped"""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        """
+        :param interval: seconds between samples
+        """
+        super().__init__(daemon=True)
+        self.interval = max(interval, MIN_INTERVAL)
+        self.stacks = {}  # (thread ident, code objects from the outermost) -> count
+        self.samples = 0
+        self.elapsed = 0.0
+        self.running = False
+        self._threads = {}  # ident -> label of the threads seen
+
+    def run(self):
+        self.running = True
+        own = threading.get_ident()
+        stacks = self.stacks
+        start = time.monotonic()
+        deadline = start
+        while self.running:
+            new_thread = False
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                key = (ident, tuple(reversed(codes)))
+                stacks[key] = stacks.get(key, 0) + 1
+                new_thread = new_thread or ident not in self._threads
+            self.samples += 1
+            if new_thread:
+                for thread in threading.enumerate():
+                    self._threads.setdefault(thread.ident, thread_label(thread))
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()  # sampling slower than the interval, do not catch up
+        self.elapsed = time.monotonic() - start
+
+    def collapsed(self):
+        """
+        :returns: list of (stack string, count) sorted by stack, in the collapsed stack format
+        """
+        labels = {}
+        counts = {}
+        for (ident, codes), count in list(self.stacks.items()):
+            stack = ";".join([self._threads.get(ident) or "unknown"] + [frame_label(code, labels) for code in codes])
+            counts[stack] = counts.get(stack, 0) + count
+        return sorted(counts.items())
+
+    def stop(self):
+        """Set property to stop thread"""
+        self.running = False
+
+
+def format_collapsed(stacks):
+    """
+    :param stacks: list of (stack string, count) as returned by SamplingProfiler.collapsed
+    :returns: collapsed stacks text, one stack per line
+    """
+    return "".join("%s %d\n" % (stack, count) for stack, count in stacks)
+
+
+def acquire():
+    """
+    Reserve the profiler, profiles overlapping would sample each other
+    :returns: True if reserved, release() when done
+    """
+    return _lock.acquire(blocking=False)
+
+
+def release():
+    """Free the profiler reserved with acquire()"""
+    _lock.release()
+
+
+def profile(seconds, interval=DEFAULT_INTERVAL):
+    """
+    Profile all the threads for a while, blocking the caller (the IOLoop should await a
+    SamplingProfiler instead)
+    :param seconds: sampling duration
+    :param interval: seconds between samples
+    :returns: SamplingProfiler, stopped
+    """
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    time.sleep(min(seconds, MAX_SECONDS))
+    profiler.stop()
+    profiler.join()
+    return profiler
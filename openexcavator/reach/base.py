@@ -4,26 +4,50 @@ Created on Jul 24, 2018
 @author: ionut
 """
 
+import asyncio
 import logging
+import selectors
 import socket
 import threading
 import time
 
+import metrics
+import recorder
+from utils import next_sequence
+
 
 class Reach(threading.Thread):
     """TCP client implementation for Reach GPS & IMU data receiver"""
 
-    def __init__(self, host, port, queue, message_delimiter=""):
+    def __init__(self, host, port, queue, message_delimiter="", notify=None):
+        """
+        :param host: receiver host
+        :param port: receiver TCP port
+        :param queue: deque receiving the parsed epochs
+        :param message_delimiter: start of the sentence opening a new epoch
+        :param notify: called (without arguments) after a new epoch was published
+        """
         super().__init__(daemon=True)
         self.host = host
         self.port = port
         self.queue = queue
+        self.notify = notify
         self.message_delimiter = message_delimiter
+        self.raw_source = recorder.SOURCE_GPS  # raw bytes source id for the recorder
+        self.source_name = "gps"  # label of the source metrics
+        self.epoch_per_sentence = False  # every sentence is a complete epoch
+        self.epoch = {}
         self.connection = None
         self.daemon = True
         self.running = False
         self.conn_buf = 1024
         self.tcp_buf_len = 16000
+        self.dropped_bytes = 0
+        self._buffer = None
+        self._start = 0
+        self._end = 0
+        self._received = None  # monotonic time of the last read
+        self._parse_latency = self._reads = self._reconnects = None
 
     @staticmethod
     def parse_data(data):
@@ -34,46 +58,119 @@ class Reach(threading.Thread):
         """
         return {}
 
+    def handle_sentence(self, sentence):
+        """
+        Parse a complete sentence and publish the epoch once the next one starts
+        :param sentence: sentence bytes (or memoryview) without the line terminator
+        """
+        text = str(sentence, "ascii", "replace").strip()
+        if not text:
+            return
+        if self.epoch_per_sentence:
+            data = self.parse_data(text)
+            if data:
+                self.publish(data)
+            return
+        if text.startswith(self.message_delimiter) and self.epoch:
+            self.publish(self.epoch)
+            self.epoch = {}
+        self.epoch.update(self.parse_data(text))
+
+    def publish(self, data):
+        """
+        Stamp an epoch with a sequence number and make it available to the DataManager
+        :param data: parsed epoch dict, not modified afterwards
+        """
+        data["seq"] = next_sequence()
+        if self._received is not None:
+            now = time.monotonic()
+            self._parse_latency.observe(now - self._received)
+            data["parsed"] = now
+        self.store(data)
+        if self.notify:
+            self.notify()
+
+    def store(self, data):
+        """
+        Make a stamped epoch available to readers, extended by sources keeping a sample history
+        :param data: parsed epoch dict with seq
+        """
+        self.queue.append(data)
+
+    def connect(self, selector):
+        """Open the TCP connection and register it for read events"""
+        self.close(selector)
+        self.connection = socket.create_connection((self.host, self.port), 3)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        selector.register(self.connection, selectors.EVENT_READ)
+        if self._buffer is None:
+            self._buffer = bytearray(self.tcp_buf_len)
+
+    def close(self, selector):
+        """Close the registered connection (also the one dropped by disconnect_source)"""
+        for key in list(selector.get_map().values()):
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+        if self._end > self._start:
+            self.dropped_bytes += self._end - self._start
+            logging.warning("dropped %d bytes of partial sentence from %s:%s",
+                            self._end - self._start, self.host, self.port)
+        self._start = self._end = 0
+        self.connection = None
+        self.epoch = {}
+
+    def receive(self):
+        """
+        Read available data into the buffer and hand every complete sentence to the parser
+        """
+        buffer = self._buffer
+        view = memoryview(buffer)
+        count = self.connection.recv_into(view[self._end:], min(self.conn_buf, len(buffer) - self._end))
+        self._received = time.monotonic()
+        self._reads.inc()
+        if not count:
+            raise Exception("connection closed by %s:%s" % (self.host, self.port))
+        recorder.record_raw(self.raw_source, view[self._end:self._end + count])
+        scan = self._end
+        self._end += count
+        start = self._start
+        newline = buffer.find(b"\n", scan, self._end)
+        while newline > -1:
+            self.handle_sentence(view[start:newline])
+            start = newline + 1
+            newline = buffer.find(b"\n", start, self._end)
+        if start == self._end:
+            start = self._end = 0
+        elif self._end == len(buffer):
+            if start == 0:  # no line terminator in the whole buffer
+                self.dropped_bytes += self._end
+                logging.warning("no valid GNRMC/IMU data received from %s:%s, dropped %d bytes",
+                                self.host, self.port, self._end)
+                self.queue.append({})
+                self._end = 0
+            else:  # move the partial sentence to the start of the buffer
+                buffer[:self._end - start] = bytes(view[start:self._end])
+                self._end -= start
+                start = 0
+        self._start = start
+
+    def init_metrics(self):
+        """Resolve the metrics updated by this source: parse latency, reads, reconnections"""
+        self._parse_latency = metrics.PARSE_LATENCY.labels(self.source_name)
+        self._reads = metrics.LOOP_ITERATIONS.labels(self.source_name)
+        self._reconnects = metrics.RECONNECTS.labels(self.source_name)
+
     def run(self):
         self.running = True
-        buffer = ""
+        self.init_metrics()
+        selector = selectors.DefaultSelector()
         while self.running:
             try:
                 if not self.connection:
-                    self.connection = socket.create_connection(
-                        (self.host, self.port), 3
-                    )
-                    self.connection.setsockopt(
-                        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
-                    )
-                data = self.connection.recv(self.conn_buf)
-                if not data:
+                    self.connect(selector)
+                if not selector.select(3):
                     raise Exception("no data received on socket for 3 seconds")
-                buffer += data.decode()  # bytes to str
-                marker = buffer.rfind(self.message_delimiter)
-                if marker > -1:
-                    if len(buffer) > 4096:  # do not process large buffers
-                        message = buffer[marker:]
-                    else:
-                        message = buffer
-                    logging.debug(
-                        "parsing chunk [%d:%d] (length %d) from buffer on port %d",
-                        marker,
-                        len(buffer),
-                        len(message),
-                        self.port,
-                    )
-                    data = self.parse_data(message)
-                    self.queue.append(data)
-                    buffer = ""
-                elif len(buffer) > self.tcp_buf_len:
-                    logging.warning(
-                        "no valid GNRMC/IMU data received from %s:%s, clearing buffer",
-                        self.host,
-                        self.port,
-                    )
-                    buffer = ""
-                    self.queue.append({})
+                self.receive()
             except Exception as exc:
                 logging.error(
                     "cannot update data: %s, reconnecting to %s:%s",
@@ -81,10 +178,55 @@ class Reach(threading.Thread):
                     self.host,
                     self.port,
                 )
-                self.connection = None
+                self._reconnects.inc()
+                self.close(selector)
                 self.queue.append({})
                 time.sleep(3)
-            time.sleep(0.02)
+        self.close(selector)
+
+    async def run_async(self):
+        """Same as run using asyncio streams on the running loop"""
+        self.running = True
+        self.init_metrics()
+        while self.running:
+            writer = None
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, limit=self.tcp_buf_len), 3
+                )
+                writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.connection = writer
+                while self.running and self.connection is writer:
+                    try:
+                        sentence = await asyncio.wait_for(reader.readuntil(b"\n"), 3)
+                        self._received = time.monotonic()
+                        self._reads.inc()
+                    except asyncio.LimitOverrunError as exc:
+                        self.dropped_bytes += len(await reader.readexactly(exc.consumed))
+                        logging.warning("no valid GNRMC/IMU data received from %s:%s, dropped %d bytes",
+                                        self.host, self.port, exc.consumed)
+                        self.queue.append({})
+                        continue
+                    recorder.record_raw(self.raw_source, sentence)
+                    self.handle_sentence(sentence[:-1])
+            except Exception as exc:
+                logging.error(
+                    "cannot update data: %s, reconnecting to %s:%s",
+                    exc,
+                    self.host,
+                    self.port,
+                )
+                self._reconnects.inc()
+                self.queue.append({})
+                error = True
+            else:
+                error = False
+            self.connection = None
+            self.epoch = {}
+            if writer:
+                writer.close()
+            if error:
+                await asyncio.sleep(3)
 
     def disconnect_source(self):
         """
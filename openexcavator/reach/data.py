@@ -4,89 +4,168 @@ Created on Apr 15, 2019
 @author: ionut
 """
 
-import datetime
+import asyncio
 import logging
 import threading
 import time
 import utm
-import adafruit_tca9548a
-import board
 
+from design import DesignPath
+from frame import Frame
 from gps.gps import GPSHandler
 from imu.imu import IMUHandler
-from rotate import get_new_position_rpy
+import metrics
+from rotate import get_new_position_rpy, get_offset_position
+from surface import Surface
+
+
+# Seconds to wait for new samples before checking if the thread is still running
+WAIT_TIMEOUT = 1
+
+
+class DataSignal:
+    """Wake up the fusion step (thread or asyncio task) when a source published a new sample"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.loop = None
+        self.async_event = None
+
+    def attach(self, loop):
+        """Also wake up an asyncio task running on loop"""
+        self.async_event = asyncio.Event()
+        self.loop = loop
+
+    def set(self):
+        """Signal new data, safe to call from any thread"""
+        self.event.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.async_event.set)
 
 
 class DataManager(threading.Thread):
     """Collect GPS and IMU data and merge it with offset position calculation"""
 
-    def __init__(self, config, data_queue):
+    def __init__(self, config, data_queue, listeners=None):
         super().__init__(daemon=True)
         self.config = config
-        self.gps = GPSHandler(config)
-        self.imu = IMUHandler(config, adafruit_tca9548a.TCA9548A(board.I2C())[2])
+        self.new_data = DataSignal()
+        self.gps = GPSHandler(config, self.new_data.set)
+        self.imu = IMUHandler(config, notify=self.new_data.set)
+        self.last_seq = (None, None)
         self.data_queue = data_queue
+        self.listeners = listeners or []
         self.utm_zone = {"num": None, "letter": None}
-        self.antenna_height = float(self.config["antenna_height"])
+        self.antenna_height = config.antenna_height
+        self.design = DesignPath.from_config(config)
+        self.surface = Surface.from_config(config)
+        self._steps = metrics.LOOP_ITERATIONS.labels("data_manager")
         self.running = False
         self.daemon = True
 
     def run(self):
         self.running = True
         while self.running:
-            data = {"utm_zone": self.utm_zone}
+            self.new_data.event.wait(WAIT_TIMEOUT)
+            self.new_data.event.clear()
+            self.step()
+
+    async def run_async(self):
+        """Same as run as a task on the running loop"""
+        self.running = True
+        self.new_data.attach(asyncio.get_running_loop())
+        while self.running:
             try:
-                data.update(self.gps.get_data())
-                data.update(self.imu.get_data())
-                if "lat" in data and "lng" in data:
-                    if not self.utm_zone["num"]:
-                        aux = utm.from_latlon(data["lat"], data["lng"])
-                        self.utm_zone["num"] = aux[2]
-                        self.utm_zone["letter"] = aux[3]
-                    if "roll" in data and "pitch" in data and "yaw" in data:
-                        aux = get_new_position_rpy(
-                            data["lng"],
-                            data["lat"],
-                            data["alt"],
-                            self.antenna_height,
-                            data["roll"],
-                            data["pitch"],
-                            data["yaw"],
-                            self.utm_zone,
-                        )
-                        data.update(
-                            {
-                                "_lng": data["lng"],
-                                "_lat": data["lat"],
-                                "_alt": data["alt"],
-                            }
-                        )
-                        data.update({"lng": aux[0], "lat": aux[1], "alt": aux[2]})
-                self.data_queue.append(data)
-            except (ValueError, IndexError) as exc:
-                data["err"] = "%s" % exc
-                time.sleep(1)
-                continue
-            # check inter-thread latency
-            if "ts" in data and "imu_time" in data:
-                try:
-                    delta = data["ts"].timestamp() - data["imu_time"]
-                    data["delta"] = delta
-                    if delta > 0.5:
-                        logging.info("stopping IMU thread due to latency %s", delta)
-                        self.imu.disconnect_source()
-                        time.sleep(1)
-                    elif delta < -0.5:  # 500 ms
-                        logging.info("stopping GPS thread due to latency %s", delta)
-                        self.gps.disconnect_source()
-                        time.sleep(1)
-
-                except Exception as exc:
-                    logging.warning("cannot determine inter-thread latency: %s", exc)
-                    self.gps.disconnect_source()
-                    self.imu.disconnect_source()
-                    time.sleep(2)
-            time.sleep(0.01)
+                await asyncio.wait_for(self.new_data.async_event.wait(), WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            self.new_data.async_event.clear()
+            self.step()
+
+    def step(self):
+        """
+        Fuse a new GNSS epoch with the IMU attitude interpolated at the epoch time, compute the
+        bucket position (cutting edge when the IMU source is a chain) and publish the frame
+        (with the gps_seq and imu_seq of the samples used); sources without epochs (fixed
+        position) are fused on every new IMU sample instead
+        """
+        self._steps.inc()
+        gps_data = self.gps.get_data()
+        gps_seq = gps_data.get("seq")
+        if "ts" in gps_data:
+            imu_data = self.imu.get_attitude(gps_data["ts"])
+            tip = self.imu.get_tip(gps_data["ts"])
+        else:
+            imu_data = self.imu.get_data()
+            tip = self.imu.get_tip()
+        imu_seq = imu_data.get("seq")
+        seq = (gps_seq, imu_seq)
+        if seq == self.last_seq or (gps_seq is not None and gps_seq == self.last_seq[0]):
+            return
+        self.last_seq = seq
+        frame = Frame()
+        frame.update(gps_data)
+        frame.update(imu_data)
+        frame.gps_seq, frame.imu_seq = seq
+        if frame.ts is not None and frame.imu_time is not None:
+            # 0 when aligned, > 0 when the IMU lags behind the GNSS epoch (newest attitude held)
+            frame.delta = frame.ts - frame.imu_time
+        try:
+            if frame.lat is not None and frame.lng is not None:
+                if not self.utm_zone["num"]:
+                    aux = utm.from_latlon(frame.lat, frame.lng)
+                    self.utm_zone["num"] = aux[2]
+                    self.utm_zone["letter"] = aux[3]
+                if tip is not None:
+                    # cutting edge from the IMU chain
+                    aux = get_offset_position(frame.lng, frame.lat, frame.alt, tip, self.utm_zone)
+                    frame._lng, frame._lat, frame._alt = frame.lng, frame.lat, frame.alt
+                    frame.lng, frame.lat, frame.alt = aux
+                    bucket_alt = frame.alt
+                elif frame.roll is not None and frame.pitch is not None and frame.yaw is not None:
+                    aux = get_new_position_rpy(frame.lng, frame.lat, frame.alt, self.antenna_height,
+                                               frame.roll, frame.pitch, frame.yaw, self.utm_zone)
+                    frame._lng, frame._lat, frame._alt = frame.lng, frame.lat, frame.alt
+                    frame.lng, frame.lat, frame.alt = aux
+                    bucket_alt = frame.alt
+                else:
+                    bucket_alt = (frame.alt or 0) - self.antenna_height
+                if self.design and frame.alt is not None:
+                    frame.update(self.design.evaluate(frame.lat, frame.lng, bucket_alt))
+                if self.surface and frame.alt is not None:
+                    frame.update(self.surface.evaluate(frame.lat, frame.lng, bucket_alt, self.utm_zone))
+        except (ValueError, IndexError) as exc:
+            logging.debug("cannot compute the bucket position: %s", exc)
+            return
+        frame.utm_num, frame.utm_letter = self.utm_zone["num"], self.utm_zone["letter"]
+        frame.fused = time.monotonic()
+        if "parsed" in gps_data:
+            metrics.FUSE_LATENCY.observe(frame.fused - gps_data["parsed"])
+        self.publish(frame)
+
+    def publish(self, frame):
+        """
+        Make a fused frame available to the web handlers and listeners (broadcaster)
+        :param frame: Frame, not modified afterwards
+        """
+        self.data_queue.append(frame)
+        for listener in self.listeners:
+            listener(frame)
+
+    def update_config(self, config):
+        """
+        Apply a new config without restarting: GPS/IMU sources (and the NTRIP client) are only
+        rebuilt if their parameters changed and keep publishing until their replacement has data
+        :param config: config dict
+        """
+        self.gps.update_config(config)
+        self.imu.update_config(config)
+        self.antenna_height = config.antenna_height
+        if any(config[key] != self.config[key] for key in ("path", "start_altitude", "stop_altitude")):
+            self.design = DesignPath.from_config(config)
+        if config.get("surface") != self.config.get("surface"):
+            self.surface = Surface.from_config(config)
+        self.config = config
 
     def stop(self):
         """Set property to stop thread"""
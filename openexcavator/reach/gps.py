@@ -6,6 +6,7 @@ Created on Jul 24, 2018
 
 import logging
 import datetime
+from gps.nmea import NMEAParser
 from reach.base import Reach
 
 
@@ -14,10 +15,11 @@ class ReachGPS(Reach):
     GPS client implementation for Reach
     """
 
-    def __init__(self, host, port, queue):
-        Reach.__init__(self, host, port, queue, message_delimiter="\n$GNRMC")
+    def __init__(self, host, port, queue, notify=None):
+        Reach.__init__(self, host, port, queue, message_delimiter="$GNRMC", notify=notify)
         self.conn_buf = 4096
         self.tcp_buf_len = 64000
+        self.parser = NMEAParser()
 
     @staticmethod
     def parse_coordinate(coord, hemi):
@@ -35,7 +37,35 @@ class ReachGPS(Reach):
             degrees = degrees * -1
         return degrees
 
+    def handle_sentence(self, sentence):
+        """
+        Parse a sentence at bytes level into the current epoch, a RMC (from any talker) opens a new one
+        :param sentence: sentence bytes (or memoryview) without the line terminator
+        """
+        if sentence[3:6] == b"RMC" and self.epoch:
+            self.publish(self.epoch)
+            self.epoch = {}
+        if self.parser.parse(sentence, self.epoch) == b"RMC" and "lat" not in self.epoch:
+            logging.warning("invalid RMC data: %s", bytes(sentence))
+
     def parse_data(self, data):
+        """
+        Parse NMEA sentences into a single epoch
+        :param data: NMEA sentences (str or bytes), one per line
+        :returns: data dict
+        """
+        if isinstance(data, str):
+            data = data.encode("ascii", "replace")
+        position = {}
+        for sentence in data.split(b"\n"):
+            self.parser.parse(sentence, position)
+        return position
+
+    def parse_data_reference(self, data):
+        """
+        Previous str/strptime based parser for $GN sentences (no checksum validation), kept as reference
+        for parse_data in benchmarks
+        """
         sentences = data.split("\n")
         position = {}
         for sentence in sentences:
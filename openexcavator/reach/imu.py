@@ -5,7 +5,9 @@ Created on Jul 24, 2018
 """
 
 import json
+import recorder
 from reach.base import Reach
+from rotate import rpy_to_quaternion
 
 
 class ReachIMU(Reach):
@@ -13,11 +15,21 @@ class ReachIMU(Reach):
     IMU client implementation for Reach
     """
 
-    def __init__(self, host, port, queue):
-        Reach.__init__(self, host, port, queue, message_delimiter="\n{")
+    def __init__(self, host, port, queue, notify=None, attitude=None):
+        Reach.__init__(self, host, port, queue, message_delimiter="{", notify=notify)
+        self.attitude = attitude
+        self.raw_source = recorder.SOURCE_IMU
+        self.source_name = "imu"
+        self.epoch_per_sentence = True
         self.conn_buf = 512
         self.tcp_buf_len = 16000
 
+    def store(self, data):
+        Reach.store(self, data)
+        if self.attitude is not None:
+            self.attitude.append(data["imu_time"], rpy_to_quaternion(data["roll"], data["pitch"], data["yaw"]),
+                                 data["seq"])
+
     @staticmethod
     def parse_data(data):
         sentences = data.split("\n")
@@ -0,0 +1,366 @@
+"""
+Append-only binary recorder for fused frames and raw sensor bytes.
+
+Every file starts with a header (magic, version, kind, record size, creation time) followed by
+fixed-size little-endian records, so a file can be memory-mapped as a NumPy structured array
+and searched by time. Records are packed and written in batches by a background thread,
+files are rotated by size and only fsync-ed every few minutes to spare the SD card.
+"""
+
+import glob
+import logging
+import math
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b"OEXR"
+VERSION = 2  # version 1 frame records end at imu_seq (no design surface fields), still readable
+HEADER = struct.Struct("<4sHHId")
+
+KIND_FRAME = 1
+KIND_RAW = 2
+
+# Raw byte sources
+SOURCE_GPS = 1
+SOURCE_IMU = 2
+SOURCE_RTCM = 3
+
+# Fused frame fields (name, struct format), missing values are stored as NaN (-1 for sequences)
+FRAME_FIELDS = (
+    ("time", "d"),  # time the frame was recorded
+    ("ts", "d"),  # GNSS epoch time
+    ("lat", "d"),
+    ("lng", "d"),
+    ("alt", "d"),
+    ("_lat", "d"),
+    ("_lng", "d"),
+    ("_alt", "d"),
+    ("imu_time", "d"),
+    ("roll", "f"),
+    ("pitch", "f"),
+    ("yaw", "f"),
+    ("delta", "f"),
+    ("speed", "f"),
+    ("acc", "f"),
+    ("fix", "f"),
+    ("distance", "f"),
+    ("slope", "f"),
+    ("alt_diff", "f"),
+    ("gps_seq", "q"),
+    ("imu_seq", "q"),
+    ("surface_alt", "d"),
+    ("cut_fill", "f"),
+)
+FRAME_RECORD = struct.Struct("<" + "".join(code for _, code in FRAME_FIELDS))
+FRAME_DTYPE = np.dtype([(name, "<" + code) for name, code in FRAME_FIELDS])
+FRAME_DTYPE_V1 = np.dtype([(name, "<" + code) for name, code in FRAME_FIELDS[:-2]])
+
+# Raw records hold up to RAW_PAYLOAD bytes, longer chunks are split over several records
+RAW_RECORD = struct.Struct("<dBxH244s")
+RAW_PAYLOAD = 244
+RAW_DTYPE = np.dtype([("time", "<f8"), ("source", "u1"), ("pad", "V1"), ("length", "<u2"),
+                      ("payload", "u1", (RAW_PAYLOAD,))])
+
+DTYPES = {KIND_FRAME: FRAME_DTYPE, KIND_RAW: RAW_DTYPE}
+# record types of the files written by former versions
+VERSION_DTYPES = {1: {KIND_FRAME: FRAME_DTYPE_V1, KIND_RAW: RAW_DTYPE}, VERSION: DTYPES}
+
+_frames = None
+_raw = None
+
+
+def pack_frame(item):
+    """
+    Pack a recorded frame
+    :param item: (record time, frame.Frame) tuple
+    :returns: record bytes
+    """
+    recorded, frame = item
+    values = [recorded]
+    for name, code in FRAME_FIELDS[1:]:
+        value = frame.get(name)
+        if value is None:
+            value = -1 if code == "q" else math.nan
+        values.append(value)
+    return FRAME_RECORD.pack(*values)
+
+
+def pack_raw(item):
+    """
+    Pack a raw chunk, split over as many records as needed
+    :param item: (record time, source, bytes) tuple
+    :returns: record bytes
+    """
+    recorded, source, data = item
+    return b"".join(RAW_RECORD.pack(recorded, source, len(data[offset:offset + RAW_PAYLOAD]),
+                                    data[offset:offset + RAW_PAYLOAD])
+                    for offset in range(0, len(data), RAW_PAYLOAD))
+
+
+class Recorder(threading.Thread):
+    """Write records queued from any thread to size-rotated files in a directory"""
+
+    def __init__(self, directory, prefix, kind, pack, record_size, max_file_size=32 * 1024 * 1024,
+                 max_files=20, queue_size=4096, flush_interval=5, fsync_interval=300):
+        """
+        :param directory: folder the files are written to (created if needed)
+        :param prefix: file name prefix, files are named prefix-YYYYmmdd-HHMMSS-mmm.oer (UTC)
+        :param kind: KIND_FRAME or KIND_RAW, stored in the header
+        :param pack: function packing a queued item to record bytes
+        :param record_size: size of one record in bytes
+        :param max_file_size: rotate when a file would grow larger than this
+        :param max_files: number of files kept, the oldest ones are deleted
+        :param queue_size: items waiting to be written, new items are dropped when full
+        :param flush_interval: seconds between flushes of the written batches to the OS
+        :param fsync_interval: seconds between fsyncs (also done on rotation and stop)
+        """
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.kind = kind
+        self.pack = pack
+        self.record_size = record_size
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.running = False
+        self._file = None
+        self._size = 0
+        self._last_fsync = 0
+
+    def record(self, *item):
+        """
+        Queue an item for writing without blocking, the item is dropped if the writer lags behind
+        :param item: values passed to the pack function as a tuple
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def record_frame(self, frame):
+        """DataManager listener recording fused frames"""
+        self.record(time.time(), frame)
+
+    def open(self):
+        """Start a new file and delete the oldest ones over max_files"""
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        path = os.path.join(self.directory, "%s-%s-%03d.oer" % (
+            self.prefix, time.strftime("%Y%m%d-%H%M%S", time.gmtime(now)), now * 1000 % 1000))
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, self.kind, self.record_size, now))
+        self._size = HEADER.size
+        self._last_fsync = time.monotonic()
+        for old_path in list_files(self.directory, self.prefix)[:-self.max_files]:
+            os.remove(old_path)
+        logging.info("recording to %s", path)
+
+    def close(self):
+        """Flush and fsync the current file"""
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def write(self, chunk):
+        """Write packed records, rotating the file whenever it would grow larger than max_file_size"""
+        view = memoryview(chunk)
+        while view:
+            space = (self.max_file_size - self._size) // self.record_size * self.record_size
+            if self._file is None or space <= 0:
+                self.close()
+                self.open()
+                space = max((self.max_file_size - self._size) // self.record_size, 1) * self.record_size
+            self._file.write(view[:space])
+            self._size += len(view[:space])
+            self.written += len(view[:space]) // self.record_size
+            view = view[space:]
+        self._file.flush()
+        if time.monotonic() - self._last_fsync > self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    def pack_item(self, item):
+        """Pack a queued item, an item that cannot be packed is counted as dropped"""
+        try:
+            return self.pack(item)
+        except (struct.error, TypeError, AttributeError) as exc:
+            self.dropped += 1
+            logging.debug("cannot pack %s record: %s", self.prefix, exc)
+            return b""
+
+    def run(self):
+        self.running = True
+        while self.running or not self.queue.empty():
+            batch = bytearray()
+            deadline = time.monotonic() + self.flush_interval
+            # collect records for flush_interval, a few writes per minute keep SD card wear low
+            while self.running and len(batch) < self.max_file_size // 4:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch += self.pack_item(item)
+            while len(batch) < self.max_file_size // 4:
+                try:
+                    batch += self.pack_item(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.write(batch)
+                except OSError as exc:
+                    logging.error("cannot write %s records: %s", self.prefix, exc)
+                    self.dropped += len(batch) // self.record_size
+                    if self._file is not None:  # a new file is opened for the next batch
+                        try:
+                            self._file.close()
+                        except OSError:
+                            pass
+                    self._file = None
+        self.close()
+
+    def stop(self):
+        """Set property to stop thread, pending records are written before it exits"""
+        self.running = False
+
+
+def list_files(directory, prefix):
+    """
+    List the recording files of a kind, oldest first
+    :param directory: recordings folder
+    :param prefix: file name prefix
+    :returns: list of paths
+    """
+    return sorted(glob.glob(os.path.join(directory, "%s-*.oer" % prefix)))
+
+
+class RecordReader:
+    """Memory-mapped access to the records of a file (a partially written last record is ignored)"""
+
+    def __init__(self, path):
+        """
+        :param path: recording file path
+        """
+        with open(path, "rb") as file:
+            magic, version, kind, record_size, created = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or kind not in VERSION_DTYPES.get(version, {}):
+            raise ValueError("%s is not a recording file (version %d at most)" % (path, VERSION))
+        dtype = VERSION_DTYPES[version][kind]
+        if record_size != dtype.itemsize:
+            raise ValueError("%s has %d byte records, expected %d" % (path, record_size, dtype.itemsize))
+        self.path = path
+        self.kind = kind
+        self.created = created
+        count = (os.path.getsize(path) - HEADER.size) // record_size
+        if count:
+            self.records = np.memmap(path, dtype=dtype, mode="r", offset=HEADER.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def index(self, timestamp):
+        """
+        Find the first record at or after a time (binary search on the record time)
+        :param timestamp: seconds since epoch
+        :returns: record index, len(self) if all records are older
+        """
+        return int(np.searchsorted(self.records["time"], timestamp))
+
+    def between(self, start, stop):
+        """
+        Records with start <= time < stop
+        :param start: seconds since epoch
+        :param stop: seconds since epoch
+        :returns: structured array (view on the file)
+        """
+        return self.records[self.index(start):self.index(stop)]
+
+    def nearest(self, timestamp):
+        """
+        Record closest in time
+        :param timestamp: seconds since epoch
+        :returns: record or None if the file is empty
+        """
+        if not len(self.records):
+            return None
+        index = self.index(timestamp)
+        if index == len(self.records) or (
+                index > 0 and timestamp - self.records["time"][index - 1] < self.records["time"][index] - timestamp):
+            index -= 1
+        return self.records[index]
+
+    def raw_bytes(self, start, stop, source=None):
+        """
+        Concatenated raw bytes recorded between two times
+        :param start: seconds since epoch
+        :param stop: seconds since epoch
+        :param source: SOURCE_GPS, SOURCE_IMU, SOURCE_RTCM or None for all of them
+        :returns: bytes
+        """
+        records = self.between(start, stop)
+        if source is not None:
+            records = records[records["source"] == source]
+        return b"".join(record["payload"][:record["length"]].tobytes() for record in records)
+
+
+def start_recording(directory, raw=False, **kwargs):
+    """
+    Start the frame recorder (and the raw bytes recorder if requested)
+    :param directory: recordings folder
+    :param raw: also record the raw NMEA/UBX/IMU/RTCM bytes
+    :param kwargs: Recorder rotation and flush parameters
+    :returns: frame Recorder, record_frame is meant to be a DataManager listener
+    """
+    global _frames, _raw
+    _frames = Recorder(directory, "frames", KIND_FRAME, pack_frame, FRAME_RECORD.size, **kwargs)
+    _frames.start()
+    if raw:
+        _raw = Recorder(directory, "raw", KIND_RAW, pack_raw, RAW_RECORD.size, **kwargs)
+        _raw.start()
+    return _frames
+
+
+def stop_recording():
+    """Write the pending records and close the files"""
+    for recorder in (_frames, _raw):
+        if recorder is not None:
+            recorder.stop()
+            recorder.join(10)
+
+
+def active_recorders():
+    """
+    :returns: list of the started Recorders (frames, then raw)
+    """
+    return [recorder for recorder in (_frames, _raw) if recorder is not None]
+
+
+def record_raw(source, data):
+    """
+    Record raw bytes received from a source, does nothing unless raw recording was started
+    :param source: SOURCE_GPS, SOURCE_IMU or SOURCE_RTCM
+    :param data: bytes (or memoryview, copied here as the source buffer is reused)
+    """
+    if _raw is not None:
+        _raw.record(time.time(), source, bytes(data))
@@ -0,0 +1,152 @@
+"""
+Fixed-size ring buffer of timestamped samples backed by NumPy arrays.
+"""
+
+import threading
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Keep the last capacity samples (time, values, sequence number) of a source,
+    written by the source thread and read by the fusion step
+    """
+
+    def __init__(self, capacity, width):
+        """
+        :param capacity: number of samples kept
+        :param width: number of values per sample
+        """
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros((capacity, width))
+        self.seqs = np.zeros(capacity, dtype=np.int64)
+        self.count = 0  # total number of samples appended
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, values, seq=0):
+        """
+        Store a sample, overwriting the oldest one when full
+        :param timestamp: sample time (seconds)
+        :param values: sequence of width values
+        :param seq: sample sequence number
+        """
+        with self.lock:
+            index = self.count % self.capacity
+            self.times[index] = timestamp
+            self.values[index] = values
+            self.seqs[index] = seq
+            self.count += 1
+
+    def latest(self):
+        """
+        Return the newest sample
+        :returns: time, values (copy), seq or None if empty
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            index = (self.count - 1) % self.capacity
+            return float(self.times[index]), self.values[index].copy(), int(self.seqs[index])
+
+    def bracket(self, timestamp):
+        """
+        Return the two consecutive samples around timestamp; when timestamp is outside the buffered
+        range both samples are the oldest (or newest) one
+        :param timestamp: time to look for
+        :returns: (time, values, seq) tuples before and after timestamp or None if empty
+        """
+        with self.lock:
+            size = min(self.count, self.capacity)
+            if not size:
+                return None
+            newest = (self.count - 1) % self.capacity
+            index = newest
+            # samples arrive in order and timestamp is usually close to the newest one
+            for _ in range(size):
+                if self.times[index] <= timestamp:
+                    break
+                index = (index - 1) % self.capacity
+            else:
+                index = (newest + 1) % self.capacity if self.count > self.capacity else 0
+                sample = float(self.times[index]), self.values[index].copy(), int(self.seqs[index])
+                return sample, sample
+            before = float(self.times[index]), self.values[index].copy(), int(self.seqs[index])
+            if index == newest:
+                return before, before
+            index = (index + 1) % self.capacity
+            return before, (float(self.times[index]), self.values[index].copy(), int(self.seqs[index]))
+
+
+class SPSCRingBuffer:
+    """
+    Single producer / single consumer ring of timestamped samples without locks: the producer
+    fills a slot before publishing it by incrementing count, the consumer keeps its own position
+    and only trusts the slots the producer cannot be writing to
+    """
+
+    def __init__(self, capacity, width):
+        """
+        :param capacity: number of samples kept
+        :param width: number of values per sample
+        """
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros((capacity, width))
+        self.count = 0  # total number of samples appended
+
+    def append(self, timestamp, values):
+        """
+        Store a sample, overwriting the oldest one when full (producer thread only)
+        :param timestamp: sample time (seconds)
+        :param values: sequence of width values
+        """
+        index = self.count % self.capacity
+        self.times[index] = timestamp
+        self.values[index] = values
+        self.count += 1
+
+    def read(self, position):
+        """
+        Copy the samples appended since a position (consumer thread only)
+        :param position: value returned by the previous read, 0 for the first one
+        :returns: times, values arrays, new position, number of samples overwritten before they were read
+        """
+        count = self.count
+        # the slot after the newest sample is the next one written
+        start = max(position, count - self.capacity + 1)
+        indexes = np.arange(start, count) % self.capacity
+        times = self.times[indexes]
+        values = self.values[indexes]
+        # samples overwritten while copying
+        overwritten = min(max(self.count - self.capacity + 1 - start, 0), count - start)
+        return times[overwritten:], values[overwritten:], count, start - position + overwritten
+
+    def read_into(self, position, times, values):
+        """
+        Copy the samples appended since a position into preallocated arrays (consumer thread only)
+        :param position: value returned by the previous read, 0 for the first one
+        :param times: array receiving the times (capacity)
+        :param values: array receiving the values (capacity x width)
+        :returns: number of samples copied to the start of times and values, new position,
+            number of samples overwritten before they were read
+        """
+        count = self.count
+        start = max(position, count - self.capacity + 1)
+        size = count - start
+        first = start % self.capacity
+        # at most two contiguous slices: up to the end of the ring and from its start
+        head = min(size, self.capacity - first)
+        times[:head] = self.times[first:first + head]
+        values[:head] = self.values[first:first + head]
+        times[head:size] = self.times[:size - head]
+        values[head:size] = self.values[:size - head]
+        overwritten = min(max(self.count - self.capacity + 1 - start, 0), size)
+        if overwritten:
+            times[:size - overwritten] = times[overwritten:size]
+            values[:size - overwritten] = values[overwritten:size]
+        return size - overwritten, count, start - position + overwritten
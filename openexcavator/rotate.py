@@ -5,6 +5,7 @@ Created on Apr 15, 2019
 """
 
 import math
+import numpy as np
 import utm
 from functools import reduce
 
@@ -83,8 +84,72 @@ def rotate_around(point, vec, angle):
     return vm_mult(point, rot_mat)
 
 
+def rod_offset(length, roll, pitch, yaw):
+    """
+    Closed-form offset of the end of the rod: [0, 0, -length] rotated by yaw around z, then
+    pitch around the new y axis and roll around the new x axis (same as rod_location_reference)
+    :param length: the length of the rod
+    :param roll: the roll in degrees
+    :param pitch: the pitch in degrees
+    :param yaw: the yaw (heading) in degrees
+    :returns: offset vector [x, y, z]
+    """
+    rroll = math.radians(roll)
+    rpitch = math.radians(pitch)
+    ryaw = math.radians(yaw)
+    cos_roll = math.cos(rroll)
+    sin_roll = math.sin(rroll)
+    sin_pitch = math.sin(rpitch)
+    cos_yaw = math.cos(ryaw)
+    sin_yaw = math.sin(ryaw)
+    # third column of Rz(yaw) * Ry(pitch) * Rx(roll)
+    return [
+        -length * (cos_yaw * sin_pitch * cos_roll + sin_yaw * sin_roll),
+        -length * (sin_yaw * sin_pitch * cos_roll - cos_yaw * sin_roll),
+        -length * math.cos(rpitch) * cos_roll
+    ]
+
+
+def rod_offset_batch(length, roll, pitch, yaw):
+    """
+    Vectorized rod_offset
+    :param length: the length of the rod (number or array)
+    :param roll: array of rolls in degrees
+    :param pitch: array of pitches in degrees
+    :param yaw: array of yaws in degrees
+    :returns: x, y, z offset arrays
+    """
+    rroll = np.radians(roll)
+    rpitch = np.radians(pitch)
+    ryaw = np.radians(yaw)
+    cos_roll = np.cos(rroll)
+    sin_roll = np.sin(rroll)
+    sin_pitch = np.sin(rpitch)
+    cos_yaw = np.cos(ryaw)
+    sin_yaw = np.sin(ryaw)
+    return (
+        -length * (cos_yaw * sin_pitch * cos_roll + sin_yaw * sin_roll),
+        -length * (sin_yaw * sin_pitch * cos_roll - cos_yaw * sin_roll),
+        -length * np.cos(rpitch) * cos_roll
+    )
+
+
 def rod_location(location, length, roll, pitch, yaw):
     """
+    :param location: the location (3 coordinates) of the "plane"
+    :param length: the length of the rod
+    :param roll: the roll in degrees
+    :param pitch: the pitch in degrees
+    :param yaw: the yaw (heading) in degrees
+    :returns: the location of the end of the rod
+    """
+    offset = rod_offset(length, roll, pitch, yaw)
+    return [location[0] + offset[0], location[1] + offset[1], location[2] + offset[2]]
+
+
+def rod_location_reference(location, length, roll, pitch, yaw):
+    """
+    Step by step axes rotation, kept as reference for the closed-form rod_location
     }
     /** @typedef {Array<number,number,number>} */ var Vector3D
     /** @typedef {Array<Vector3D,vector3D,Vector3D>} */ var Matrix3D
@@ -134,8 +199,130 @@ def rod_location(location, length, roll, pitch, yaw):
     return list(map(lambda n: location[n]+rot_end[n], arr))
 
 
+def rpy_to_quaternion(roll, pitch, yaw):
+    """
+    Convert roll, pitch, yaw (ZYX convention, as ahrs q2rpy) to a unit quaternion
+    :param roll: the roll in degrees
+    :param pitch: the pitch in degrees
+    :param yaw: the yaw (heading) in degrees
+    :returns: quaternion [w, x, y, z]
+    """
+    half_roll = math.radians(roll) / 2
+    half_pitch = math.radians(pitch) / 2
+    half_yaw = math.radians(yaw) / 2
+    cos_roll = math.cos(half_roll)
+    sin_roll = math.sin(half_roll)
+    cos_pitch = math.cos(half_pitch)
+    sin_pitch = math.sin(half_pitch)
+    cos_yaw = math.cos(half_yaw)
+    sin_yaw = math.sin(half_yaw)
+    return [
+        cos_roll * cos_pitch * cos_yaw + sin_roll * sin_pitch * sin_yaw,
+        sin_roll * cos_pitch * cos_yaw - cos_roll * sin_pitch * sin_yaw,
+        cos_roll * sin_pitch * cos_yaw + sin_roll * cos_pitch * sin_yaw,
+        cos_roll * cos_pitch * sin_yaw - sin_roll * sin_pitch * cos_yaw
+    ]
+
+
+def quaternion_to_rpy(q):
+    """
+    Convert a unit quaternion to roll, pitch, yaw (same as ahrs q2rpy with in_deg=True)
+    :param q: quaternion [w, x, y, z]
+    :returns: roll, pitch, yaw in degrees
+    """
+    w, x, y, z = q
+    roll = math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = math.asin(max(-1.0, min(1.0, 2 * (w * y - z * x))))
+    yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return math.degrees(roll), math.degrees(pitch), math.degrees(yaw)
+
+
+def slerp(q0, q1, ratio):
+    """
+    Spherical linear interpolation between two unit quaternions (along the shortest arc)
+    :param q0: quaternion [w, x, y, z] at ratio 0
+    :param q1: quaternion [w, x, y, z] at ratio 1
+    :param ratio: interpolation position, 0 to 1
+    :returns: interpolated unit quaternion [w, x, y, z]
+    """
+    dot = sum(a * b for a, b in zip(q0, q1))
+    if dot < 0:  # q and -q are the same rotation
+        q1 = [-value for value in q1]
+        dot = -dot
+    if dot > 0.9995:  # nearly identical, avoid dividing by sin(~0)
+        result = [a + ratio * (b - a) for a, b in zip(q0, q1)]
+        norm = math.sqrt(sum(value * value for value in result))
+        return [value / norm for value in result]
+    theta = math.acos(dot)
+    sin_theta = math.sin(theta)
+    weight0 = math.sin((1 - ratio) * theta) / sin_theta
+    weight1 = math.sin(ratio * theta) / sin_theta
+    return [weight0 * a + weight1 * b for a, b in zip(q0, q1)]
+
+
+def rotate_vector_batch(quaternions, vector, out=None):
+    """
+    Rotate a vector by each quaternion (v + 2w(u x v) + 2u x (u x v) with u the vector part)
+    :param quaternions: array of unit quaternions [w, x, y, z] (n x 4)
+    :param vector: vector [x, y, z] in the rotated (sensor) frame
+    :param out: array receiving the rotated vectors (n x 3), allocated if not supplied
+    :returns: array of rotated vectors (n x 3)
+    """
+    w, x, y, z = quaternions[:, 0], quaternions[:, 1], quaternions[:, 2], quaternions[:, 3]
+    vx, vy, vz = vector
+    # t = 2 (u x v)
+    tx = 2 * (y * vz - z * vy)
+    ty = 2 * (z * vx - x * vz)
+    tz = 2 * (x * vy - y * vx)
+    if out is None:
+        out = np.empty((len(quaternions), 3))
+    out[:, 0] = vx + w * tx + y * tz - z * ty
+    out[:, 1] = vy + w * ty + z * tx - x * tz
+    out[:, 2] = vz + w * tz + x * ty - y * tx
+    return out
+
+
+def get_offset_position(lng, lat, alt, offset, utm_zone):
+    """
+    Position at an offset from another one
+    :param lng: longitude
+    :param lat: latitude
+    :param alt: altitude
+    :param offset: east, north, up offset in meters
+    :param utm_zone: dict with the UTM zone num to compute in
+    :returns: lng, lat, alt
+    """
+    proj_coords = utm.from_latlon(lat, lng, utm_zone["num"])
+    lat_lng = utm.to_latlon(proj_coords[0] + offset[0], proj_coords[1] + offset[1], proj_coords[2], proj_coords[3])
+    return [lat_lng[1], lat_lng[0], alt + offset[2]]
+
+
 def get_new_position_rpy(lng, lat, alt, dist, roll, pitch, yaw, utm_zone):
     proj_coords = utm.from_latlon(lat, lng, utm_zone["num"])
     position = rod_location([proj_coords[0], proj_coords[1], alt], dist, pitch, roll, -yaw)
     proj_coords = utm.to_latlon(position[0], position[1], proj_coords[2], proj_coords[3])
     return [proj_coords[1], proj_coords[0], position[2]]
+
+
+def get_new_position_rpy_batch(lng, lat, alt, dist, roll, pitch, yaw, utm_zone):
+    """
+    Vectorized get_new_position_rpy for reprocessing logs, all points must be in the same UTM zone
+    :param lng: array of longitudes
+    :param lat: array of latitudes
+    :param alt: array of altitudes
+    :param dist: antenna height
+    :param roll: array of rolls in degrees
+    :param pitch: array of pitches in degrees
+    :param yaw: array of yaws in degrees
+    :param utm_zone: dict with the UTM zone num to project into (None to use the first point zone)
+    :returns: lng, lat, alt arrays
+    """
+    lng = np.asarray(lng, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    alt = np.asarray(alt, dtype=float)
+    proj_coords = utm.from_latlon(lat, lng, utm_zone["num"])
+    offset = rod_offset_batch(dist, np.asarray(pitch), np.asarray(roll), -np.asarray(yaw))
+    lat_lng = utm.to_latlon(proj_coords[0] + offset[0], proj_coords[1] + offset[1],
+                            proj_coords[2], proj_coords[3])
+    return lat_lng[1], lat_lng[0], alt + offset[2]
+
@@ -0,0 +1,127 @@
+"""
+Fixed-rate sensor sampling: a drift-free scheduler and a thread reading a sensor on it into a
+lock-free ring buffer, so the reads stay on time whatever the consumer (fusion filter) does.
+"""
+
+from collections import deque
+import logging
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+# Seconds between two logs of the achieved sampling rate and jitter
+REPORT_INTERVAL = 60
+
+
+class FixedRateScheduler:
+    """
+    Wake up at start + n * period: the deadlines do not drift with the time spent between
+    two waits, ticks that were missed entirely are skipped (and counted as overruns)
+    """
+
+    def __init__(self, rate, window=1000):
+        """
+        :param rate: ticks per second
+        :param window: number of ticks the statistics are computed on
+        """
+        self.period = 1.0 / rate
+        self.start = None
+        self.tick = 0
+        self.overruns = 0
+        self.wakeups = deque(maxlen=window)  # monotonic wake-up times
+        self.lateness = deque(maxlen=window)  # seconds between deadline and wake-up
+
+    def wait(self):
+        """
+        Sleep until the next deadline (the first call returns immediately)
+        :returns: monotonic wake-up time
+        """
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        else:
+            self.tick += 1
+            deadline = self.start + self.tick * self.period
+            if now >= deadline + self.period:
+                missed = int((now - deadline) / self.period)
+                self.overruns += missed
+                self.tick += missed
+                deadline += missed * self.period
+            delay = deadline - now
+            if delay > 0:
+                time.sleep(delay)
+            now = time.monotonic()
+            self.lateness.append(now - deadline)
+        self.wakeups.append(now)
+        return now
+
+    def stats(self):
+        """
+        Achieved rate and jitter over the last window ticks
+        :returns: dict with rate (Hz), jitter_ms (standard deviation of the intervals between
+            wake-ups), late_p99_ms (99th percentile of the wake-up delay) and overruns (skipped ticks)
+        """
+        wakeups = np.array(self.wakeups)
+        if len(wakeups) < 2:
+            return {"rate": 0.0, "jitter_ms": 0.0, "late_p99_ms": 0.0, "overruns": self.overruns}
+        return {
+            "rate": float((len(wakeups) - 1) / (wakeups[-1] - wakeups[0])),
+            "jitter_ms": float(np.diff(wakeups).std() * 1000),
+            "late_p99_ms": float(np.percentile(np.array(self.lateness), 99) * 1000),
+            "overruns": self.overruns,
+        }
+
+
+class Sampler(threading.Thread):
+    """Call a read function at a fixed rate and append its values to a SPSCRingBuffer"""
+
+    def __init__(self, name, read, samples, rate, notify=None):
+        """
+        :param name: sensor name used in logs
+        :param read: function returning a tuple of values, may raise OSError on bus errors
+        :param samples: SPSCRingBuffer receiving the (time, values) samples (this thread is its only producer)
+        :param rate: samples per second
+        :param notify: called (without arguments) after every sample
+        """
+        super().__init__(daemon=True)
+        self.sensor_name = name
+        self.read = read
+        self.samples = samples
+        self.scheduler = FixedRateScheduler(rate)
+        self.notify = notify
+        self.errors = 0
+        self.running = False
+
+    def run(self):
+        self.running = True
+        reads = metrics.LOOP_ITERATIONS.labels(self.sensor_name)
+        reported = time.monotonic()
+        while self.running:
+            now = self.scheduler.wait()
+            reads.inc()
+            try:
+                values = self.read()
+            except OSError as exc:
+                self.errors += 1
+                logging.debug("cannot read %s: %s", self.sensor_name, exc)
+                continue
+            self.samples.append(time.time(), values)
+            if self.notify:
+                self.notify()
+            if now - reported > REPORT_INTERVAL:
+                reported = now
+                logging.info("%s sampled at %.1f Hz, jitter %.2f ms, p99 lateness %.2f ms, %d overruns, %d errors",
+                             self.sensor_name, *self.stats().values())
+
+    def stats(self):
+        """
+        :returns: scheduler statistics and the number of read errors
+        """
+        return dict(self.scheduler.stats(), errors=self.errors)
+
+    def stop(self):
+        """Set property to stop thread"""
+        self.running = False
@@ -13,6 +13,53 @@ logging.basicConfig(level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M:%S",
                     format="[%(asctime)s] - %(levelname)s - %(message)s")
 logging.getLogger("tornado").setLevel(logging.WARNING)
 
+# Run the TCP sources (Reach GPS/IMU, NTRIP) and the data fusion as coroutines on the
+# Tornado IOLoop instead of separate threads
+ASYNCIO_SOURCES = False
+
+# Also enable UBX-NAV-COV when the UBX receiver is read in binary (UBX protocol) mode, the
+# position covariance then replaces the NAV-PVT accuracy estimate
+UBX_NAV_COV = False
+
+# FXOS8700+FXAS21001 sampling rate in Hz (100 to 200, the sensors run at 200 Hz above 100)
+IMU_RATE = 100
+
+# TCA9548A channels of the IMU boards by ExcavatorPart name for the "FXOS8700+FXAS21001 chain" IMU
+# type, the cutting edge is at the end of the last part with a board (CAB is required)
+IMU_CHAIN_CHANNELS = {"CAB": 2, "BOOM": 3, "STICK": 4, "BUCKET": 5}
+
+# Seconds between the GGA sentences sent to the NTRIP caster (required by VRS mountpoints), 0 to disable
+NTRIP_GGA_INTERVAL = 10
+
+# Uploaded design paths are simplified to this tolerance (meters) before being stored and served
+PATH_TOLERANCE = 0.01
+
+# Uploaded design surfaces (LandXML TIN, ESRI ASCII grid DEM) are converted to memory-mapped arrays in this folder
+SURFACE_PATH = "surfaces"
+
+# Designs whose bounding box is farther than this (meters) from the bucket are not proposed as the nearest one
+DESIGN_SEARCH_RADIUS = 1000
+
+# Fused frames (and optionally raw sensor bytes) recording, disabled if RECORD_PATH is empty (set it
+# to a folder, e.g. "recordings", to record)
+RECORD_PATH = ""
+RECORD_RAW = False
+RECORD_FILE_SIZE = 32 * 1024 * 1024  # bytes
+RECORD_FILES = 20  # files kept per kind, the oldest ones are deleted
+RECORD_FLUSH_INTERVAL = 5  # seconds
+RECORD_FSYNC_INTERVAL = 300  # seconds
+
+# "Simulator" GPS/IMU sources: logs to replay (raw recordings or text logs, synthetic data if
+# empty), playback speed (0 for as fast as possible), random delay per chunk in seconds and
+# probability of dropping a chunk; the GPS log goes through a pty and the UBX reader if
+# SIMULATOR_GPS_SERIAL is set, through a local TCP server and the Reach client otherwise
+SIMULATOR_GPS_LOG = ""
+SIMULATOR_IMU_LOG = ""
+SIMULATOR_SPEED = 1.0
+SIMULATOR_JITTER = 0.0
+SIMULATOR_LOSS = 0.0
+SIMULATOR_GPS_SERIAL = False
+
 # Tornado settings
 TEMPLATE_PATH = "templates"
 STATIC_PATH = "static"
@@ -0,0 +1,567 @@
+"""
+Replay recorded GPS/IMU streams through local stand-ins for the receivers: a TCP server in place
+of a Reach (NMEA or IMU JSON lines), a pseudo terminal in place of the UBX serial port or an
+NTRIP caster serving RTCM3 corrections. FakeI2C (FakeMuxI2C behind a TCA9548A) stands in for the
+I2C bus of the IMU sensors.
+
+Logs are either raw recordings (recorder.py .oer files, replayed with their original timing) or
+plain text logs (one sentence per line, timed by the RMC time / IMU "t" value); without a log a
+synthetic drive along a straight line is generated. Run standalone for load testing with:
+python3 simulator.py [--port 9001] [--speed 10] [--kind gps|ubx|imu|rtcm] [log]
+"""
+
+import argparse
+import errno
+import json
+import logging
+import math
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import tty
+
+import recorder
+from gps.nmea import format_coordinate, sentence
+from gps.rtcm import rtcm3_frame
+
+# Seconds between epochs of plain binary logs and of logs without usable times
+DEFAULT_INTERVAL = 0.2
+UBX_CHUNK = 1024
+
+
+def synthetic_chunks(kind, seconds=60, rate=None, lat=51.6995, lng=5.4155, alt=700.0):
+    """
+    Generate a drive north at 1 m/s with the excavator slewing back and forth
+    :param kind: gps (NMEA epochs), ubx (NAV-PVT + NAV-COV messages), imu (JSON lines) or rtcm
+        (RTCM3 frames with random payloads)
+    :param seconds: duration of the log
+    :param rate: epochs per second (5 for gps, 10 for ubx, 1 for rtcm, 50 for imu by default)
+    :returns: list of (time, bytes) chunks
+    """
+    rate = rate or {"gps": 5, "ubx": 10, "rtcm": 1}.get(kind, 50)
+    start = time.time()
+    chunks = []
+    rng = random.Random(1)
+    for index in range(int(seconds * rate)):
+        elapsed = index / rate
+        epoch = start + elapsed
+        if kind == "rtcm":
+            # station position (1005) and MSM7 observations of a few constellations
+            chunks.append((epoch, b"".join(rtcm3_frame(bytes((msg_type >> 4, (msg_type & 0xF) << 4)) +
+                                                       rng.randbytes(size))
+                                           for msg_type, size in ((1005, 17), (1077, 420), (1087, 300),
+                                                                  (1097, 350), (1127, 380)))))
+            continue
+        if kind == "imu":
+            line = {"r": 2 * math.sin(elapsed), "p": 3 * math.cos(elapsed / 2),
+                    "y": 90 * math.sin(elapsed / 4), "t": epoch}
+            chunks.append((epoch, (json.dumps(line) + "\n").encode()))
+            continue
+        if kind == "ubx":
+            chunks.append((epoch, ubx_epoch(epoch, lat + elapsed / 111111, lng, alt)))
+            continue
+        hundredths = round(epoch * 100)
+        moment = time.gmtime(hundredths // 100)
+        hms = time.strftime("%H%M%S", moment) + ".%02d" % (hundredths % 100)
+        position = (format_coordinate(lat + elapsed / 111111, "N", "S", 2) + "," +
+                    format_coordinate(lng, "E", "W", 3))
+        chunks.append((epoch, b"".join([
+            sentence("GNRMC,%s,A,%s,1.944,0.0,%s,,,R" % (hms, position, time.strftime("%d%m%y", moment))),
+            sentence("GNGGA,%s,%s,4,12,0.6,%.3f,M,%.3f,M,1.0,0000" % (hms, position, alt - 45, 45.0)),
+            sentence("GNGST,%s,0.01,0.012,0.010,45.0,0.012,0.010,0.020" % hms),
+            sentence("GNZDA,%s,%s,00,00" % (hms, time.strftime("%d,%m,%Y", moment))),
+        ])))
+    return chunks
+
+
+def ubx_epoch(epoch, lat, lng, alt):
+    """Build the NAV-PVT and NAV-COV messages of an RTK fixed epoch at time epoch"""
+    from pyubx2 import GET, UBXMessage
+
+    moment = time.gmtime(epoch)
+    itow = round(epoch * 1000) % (7 * 86400000)
+    pvt = UBXMessage("NAV", "NAV-PVT", GET, iTOW=itow, year=moment.tm_year, month=moment.tm_mon,
+                     day=moment.tm_mday, hour=moment.tm_hour, min=moment.tm_min, second=moment.tm_sec,
+                     validDate=1, validTime=1, nano=round(epoch % 1 * 1e9), fixType=3, gnssFixOk=1,
+                     diffSoln=1, carrSoln=2, numSV=18, lon=lng, lat=lat, height=round(alt * 1000) + 45000,
+                     hMSL=round(alt * 1000), hAcc=14, vAcc=20, gSpeed=1000, pDOP=1.2)
+    cov = UBXMessage("NAV", "NAV-COV", GET, iTOW=itow, posCovValid=1, posCovNN=0.0002, posCovEE=0.0002,
+                     posCovDD=0.0004)
+    return pvt.serialize() + cov.serialize()
+
+
+def load_log(path, kind, source=None):
+    """
+    Load a log as timed chunks
+    :param path: raw recording (.oer), text log (NMEA or IMU JSON lines) or binary UBX log
+    :param kind: gps, ubx or imu, selects the synthetic data and how text logs are split in epochs
+    :param source: recorder source to replay from a raw recording (by default the one matching kind)
+    :returns: list of (time, bytes) chunks sorted by time
+    """
+    if not path:
+        return synthetic_chunks(kind)
+    if path.endswith(".oer"):
+        reader = recorder.RecordReader(path)
+        if source is None:
+            source = {"imu": recorder.SOURCE_IMU, "rtcm": recorder.SOURCE_RTCM}.get(kind, recorder.SOURCE_GPS)
+        records = reader.records[reader.records["source"] == source]
+        return [(float(record["time"]), record["payload"][:record["length"]].tobytes()) for record in records]
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith((b"$", b"{")):  # binary UBX or RTCM log, no timing information
+        return [(index / UBX_CHUNK * DEFAULT_INTERVAL, data[index:index + UBX_CHUNK])
+                for index in range(0, len(data), UBX_CHUNK)]
+    chunks = []
+    for line in data.splitlines(keepends=True):
+        if kind == "imu":
+            try:
+                chunks.append((float(json.loads(line)["t"]), line))
+            except (ValueError, KeyError, TypeError):
+                continue
+        elif line[3:6] == b"RMC" or not chunks:
+            chunks.append((epoch_time(line, len(chunks)), line))
+        else:
+            chunks[-1] = (chunks[-1][0], chunks[-1][1] + line)
+    return chunks
+
+
+def epoch_time(line, index):
+    """Seconds of day of a RMC sentence, index * DEFAULT_INTERVAL if it has no valid time"""
+    try:
+        hms = line.split(b",")[1]
+        return int(hms[0:2]) * 3600 + int(hms[2:4]) * 60 + float(hms[4:])
+    except (IndexError, ValueError):
+        return index * DEFAULT_INTERVAL
+
+
+class Replay(threading.Thread):
+    """Write timed chunks to an output at 1x, Nx or maximum speed with optional jitter and loss"""
+
+    def __init__(self, chunks, speed=1.0, jitter=0.0, loss=0.0, loop=True):
+        """
+        :param chunks: list of (time, bytes) chunks
+        :param speed: playback speed multiplier, 0 to send as fast as the reader accepts
+        :param jitter: maximum random delay (seconds) added to every chunk, without accumulating
+        :param loss: probability (0 to 1) of dropping a chunk
+        :param loop: start over at the end of the log
+        """
+        super().__init__(daemon=True)
+        self.chunks = chunks
+        self.speed = speed
+        self.jitter = jitter
+        self.loss = loss
+        self.loop = loop
+        self.running = False
+        self.sent = 0
+        self.lost = 0
+        self.sent_bytes = 0
+
+    def play(self, write):
+        """
+        Replay the chunks (once, or forever if loop is set) until stopped
+        :param write: function sending bytes, raises OSError when the reader is gone
+        """
+        if not self.chunks:
+            logging.error("nothing to replay")
+            return
+        duration = self.chunks[-1][0] - self.chunks[0][0] + DEFAULT_INTERVAL
+        offset = 0
+        started = time.monotonic()
+        while self.running:
+            for chunk_time, data in self.chunks:
+                if not self.running:
+                    return
+                if self.speed:
+                    deadline = started + (offset + chunk_time - self.chunks[0][0]) / self.speed
+                    delay = deadline - time.monotonic() + (random.uniform(0, self.jitter) if self.jitter else 0)
+                    if delay > 0:
+                        time.sleep(delay)
+                if self.loss and random.random() < self.loss:
+                    self.lost += 1
+                    continue
+                write(data)
+                self.sent += 1
+                self.sent_bytes += len(data)
+            if not self.loop:
+                return
+            offset += duration
+
+    def stop(self):
+        """Set property to stop thread"""
+        self.running = False
+
+
+class ReplayServer(Replay):
+    """TCP server replaying the log to every client that connects (one at a time), like a Reach"""
+
+    def __init__(self, chunks, host="127.0.0.1", port=0, **kwargs):
+        """
+        :param chunks: list of (time, bytes) chunks
+        :param host: address to listen on
+        :param port: TCP port, 0 to pick a free one (see self.port)
+        :param kwargs: Replay speed, jitter, loss and loop parameters
+        """
+        super().__init__(chunks, **kwargs)
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.server.settimeout(1)
+        self.host = host
+        self.port = self.server.getsockname()[1]
+
+    def run(self):
+        self.running = True
+        logging.info("replaying %d chunks on %s:%s", len(self.chunks), self.host, self.port)
+        while self.running:
+            try:
+                connection, address = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            logging.info("replay client %s connected", address)
+            with connection:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    self.serve(connection)
+                except OSError as exc:
+                    logging.info("replay client %s disconnected: %s", address, exc)
+        self.server.close()
+
+    def serve(self, connection):
+        """Replay the log to a connected client"""
+        self.play(connection.sendall)
+
+
+class NTRIPCaster(ReplayServer):
+    """
+    NTRIP caster stand-in serving the log on a single mountpoint, as Ntrip 2 (chunked HTTP) or
+    Ntrip 1 (ICY) stream; GGA sentences sent by the client are kept in self.gga
+    """
+
+    def __init__(self, chunks, host="127.0.0.1", port=0, mountpoint="OEX", chunked=True, require_gga=False,
+                 **kwargs):
+        """
+        :param chunks: list of (time, bytes) chunks
+        :param host: address to listen on
+        :param port: TCP port, 0 to pick a free one (see self.port)
+        :param mountpoint: mountpoint name, other requests get the source table
+        :param chunked: answer as a Ntrip 2 caster with chunked transfer encoding
+        :param require_gga: wait for a GGA sentence before streaming (like a VRS mountpoint)
+        :param kwargs: Replay speed, jitter, loss and loop parameters
+        """
+        super().__init__(chunks, host, port, **kwargs)
+        self.mountpoint = mountpoint
+        self.chunked = chunked
+        self.require_gga = require_gga
+        self.gga = []
+        self.requests = 0
+
+    def serve(self, connection):
+        reader = connection.makefile("rb")
+        request = reader.readline().split()
+        while reader.readline().strip():  # headers
+            pass
+        self.requests += 1
+        if len(request) < 2 or request[1] != b"/" + self.mountpoint.encode():
+            connection.sendall(b"SOURCETABLE 200 OK\r\nContent-Type: text/plain\r\n\r\n"
+                               b"STR;%s;;RTCM 3.3;;2;GNSS;;;0;0;;;none;B;N;0;\r\nENDSOURCETABLE\r\n" %
+                               self.mountpoint.encode())
+            return
+        if self.chunked:
+            connection.sendall(b"HTTP/1.1 200 OK\r\nNtrip-Version: Ntrip/2.0\r\n"
+                               b"Content-Type: gnss/data\r\nTransfer-Encoding: chunked\r\n\r\n")
+        else:
+            connection.sendall(b"ICY 200 OK\r\n")
+        received_gga = threading.Event()
+
+        def read_gga():
+            try:
+                for line in reader:
+                    if line[3:6] == b"GGA":
+                        self.gga.append(line.strip())
+                        received_gga.set()
+            except OSError:
+                pass
+
+        threading.Thread(target=read_gga, daemon=True).start()
+        if self.require_gga and not received_gga.wait(10):
+            logging.info("no GGA received, closing the NTRIP stream")
+            return
+        if self.chunked:
+            self.play(lambda data: connection.sendall(b"%x\r\n%s\r\n" % (len(data), data)))
+        else:
+            self.play(connection.sendall)
+
+
+class PtyReplay(Replay):
+    """Pseudo terminal replaying the log, self.port is the device to open instead of the serial port"""
+
+    def __init__(self, chunks, **kwargs):
+        """
+        :param chunks: list of (time, bytes) chunks
+        :param kwargs: Replay speed, jitter, loss and loop parameters
+        """
+        super().__init__(chunks, **kwargs)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def write(self, data):
+        """Write all bytes to the pty master"""
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def run(self):
+        self.running = True
+        logging.info("replaying %d chunks on %s", len(self.chunks), self.port)
+        try:
+            self.play(self.write)
+        except OSError as exc:
+            logging.error("cannot replay on %s: %s", self.port, exc)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class FakeSensor:
+    """Register file of an I2C sensor, the output registers are refreshed on every read"""
+
+    def __init__(self, who_am_i):
+        """
+        :param who_am_i: (register, value) identifying the chip
+        """
+        self.registers = bytearray(256)
+        self.registers[who_am_i[0]] = who_am_i[1]
+
+    def write(self, data):
+        """Write data[1:] from register data[0] on"""
+        self.registers[data[0]:data[0] + len(data) - 1] = data[1:]
+
+    def read(self, register, size):
+        """Read size registers from register on"""
+        self.update(time.time())
+        return self.registers[register:register + size]
+
+    def update(self, now):
+        """Refresh the output registers"""
+
+
+def fake_counts(values, scale, offset, calibrated):
+    """
+    Raw counts of simulated values
+    :param values: values in the calibrated units (radians/s, g, uTesla)
+    :param scale: ideal counts to unit scale
+    :param offset: the driver calibration is inverted if calibrated (so it gives back values), ignored otherwise
+    :param calibrated: use the driver calibration (imu.fxos8700_fxas21001) instead of the ideal scale
+    :returns: tuple of int counts
+    """
+    if calibrated:
+        from imu.fxos8700_fxas21001 import CALIBRATION_OFFSET, CALIBRATION_SCALE
+
+        return tuple(round((value + CALIBRATION_OFFSET[offset + index]) / CALIBRATION_SCALE[offset + index])
+                     for index, value in enumerate(values))
+    return tuple(round(value / scale) for value in values)
+
+
+def tilted(vector, pitch, yaw=0.0):
+    """
+    Sensor frame coordinates of an earth frame vector (x north, z up) for a sensor turned by yaw
+    around z, then by pitch around its y axis (positive pitch tilts x down)
+    """
+    x, y, z = vector
+    x, y = x * math.cos(yaw) + y * math.sin(yaw), -x * math.sin(yaw) + y * math.cos(yaw)
+    return x * math.cos(pitch) - z * math.sin(pitch), y, x * math.sin(pitch) + z * math.cos(pitch)
+
+
+class FakeFXOS8700(FakeSensor):
+    """FXOS8700 accelerometer + magnetometer, turning at a constant yaw rate (level unless pitched)"""
+
+    def __init__(self, yaw_rate=0.2, field=(20.0, -40.0), pitch=0.0, calibrated=False):
+        """
+        :param yaw_rate: radians per second
+        :param field: horizontal (north) and vertical magnetic field (uTesla)
+        :param pitch: tilt around the sensor y axis in radians (positive tilts x down)
+        :param calibrated: output counts giving the simulated values after the driver calibration
+        """
+        super().__init__((0x0D, 0xC7))
+        self.yaw_rate = yaw_rate
+        self.field = field
+        self.pitch = pitch
+        self.calibrated = calibrated
+        self.start = time.time()
+
+    def read(self, register, size):
+        data = super().read(register, size)
+        if self.registers[0x5C] & 0x20 and register <= 0x06 < register + size - 1:
+            # hybrid auto-increment: jump from the last accelerometer register to the magnetometer ones
+            data = self.registers[register:0x07] + self.registers[0x33:0x33 + register + size - 0x07]
+        return data
+
+    def update(self, now):
+        yaw = (now - self.start) * self.yaw_rate
+        horizontal, vertical = self.field
+        # 14 bit left aligned accelerometer counts (4096 per g at +/- 2 g), 10 magnetometer counts per uTesla
+        struct.pack_into(">hhh", self.registers, 0x01,
+                         *fake_counts(tilted((0, 0, 1), self.pitch, yaw), 1 / 4096 / 4, 3, self.calibrated))
+        struct.pack_into(">hhh", self.registers, 0x33,
+                         *fake_counts(tilted((horizontal, 0, vertical), self.pitch, yaw), 0.1, 6, self.calibrated))
+
+
+class FakeFXAS21002C(FakeSensor):
+    """FXAS21002C gyroscope turning at a constant yaw rate"""
+
+    def __init__(self, yaw_rate=0.2, pitch=0.0, calibrated=False):
+        """
+        :param yaw_rate: radians per second
+        :param pitch: tilt around the sensor y axis in radians (positive tilts x down)
+        :param calibrated: output counts giving the simulated values after the driver calibration
+        """
+        super().__init__((0x0C, 0xD7))
+        self.yaw_rate = yaw_rate
+        self.pitch = pitch
+        self.calibrated = calibrated
+
+    def update(self, now):
+        # 128 counts per degree/s at +/- 250 dps
+        struct.pack_into(">hhh", self.registers, 0x01, *fake_counts(
+            tilted((0, 0, self.yaw_rate), self.pitch), math.radians(1 / 128), 0, self.calibrated))
+
+
+class FakeI2C:
+    """busio.I2C stand-in dispatching transactions to FakeSensor instances by address"""
+
+    def __init__(self, devices, delay=0.0):
+        """
+        :param devices: dict of address: FakeSensor
+        :param delay: seconds every transaction takes (bus time)
+        """
+        self.devices = devices
+        self.delay = delay
+        self.transactions = 0
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def device(self, address):
+        """Count a transaction to a device, OSError (as from the Linux driver) if nothing answers"""
+        self.transactions += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if address not in self.devices:
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        return self.devices[address]
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        self.device(address).write(bytes(buffer[start:end]))
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0,
+                              in_end=None):
+        in_end = len(buffer_in) if in_end is None else in_end
+        buffer_in[in_start:in_end] = self.device(address).read(buffer_out[out_start], in_end - in_start)
+
+
+class FakeTCA9548A:
+    """TCA9548A control register: the byte written connects the channels of its set bits"""
+
+    def __init__(self):
+        self.control = 0
+        self.writes = 0
+
+    def write(self, data):
+        self.control = data[-1]
+        self.writes += 1
+
+    def read(self, register, size):
+        return bytes((self.control,)) * size
+
+
+class FakeMuxI2C(FakeI2C):
+    """FakeI2C with a TCA9548A: transactions go to the devices of the selected channels"""
+
+    def __init__(self, channels, delay=0.0, address=0x70):
+        """
+        :param channels: dict of channel: dict of address: FakeSensor
+        :param delay: seconds every transaction takes (bus time)
+        :param address: multiplexer address
+        """
+        super().__init__({}, delay)
+        self.channels = channels
+        self.mux = FakeTCA9548A()
+        self.address = address
+
+    def device(self, address):
+        if address == self.address:
+            self.devices = {address: self.mux}
+        else:
+            self.devices = {}
+            for channel, devices in self.channels.items():
+                if self.mux.control & 1 << channel:
+                    if set(devices) & set(self.devices):
+                        raise OSError(errno.EIO, "I/O error")  # several devices answering
+                    self.devices.update(devices)
+        return super().device(address)
+
+
+def fake_imu_bus(yaw_rate=0.2, delay=0.0):
+    """
+    Build a fake I2C bus with the FXOS8700 and FXAS21002C of the IMU board
+    :param yaw_rate: radians per second the simulated IMU turns at
+    :param delay: seconds every transaction takes
+    :returns: FakeI2C instance
+    """
+    return FakeI2C({0x1F: FakeFXOS8700(yaw_rate), 0x21: FakeFXAS21002C(yaw_rate)}, delay)
+
+
+def fake_imu_chain_bus(pitches, yaw_rate=0.0, delay=0.0):
+    """
+    Build a fake I2C bus with a TCA9548A and an IMU board per channel, outputting calibrated values
+    :param pitches: dict of channel: pitch of the board (radians, positive tilts x down)
+    :param yaw_rate: radians per second the simulated IMUs turn at
+    :param delay: seconds every transaction takes
+    :returns: FakeMuxI2C instance
+    """
+    return FakeMuxI2C({channel: {0x1F: FakeFXOS8700(yaw_rate, pitch=pitch, calibrated=True),
+                                 0x21: FakeFXAS21002C(yaw_rate, pitch=pitch, calibrated=True)}
+                       for channel, pitch in pitches.items()}, delay)
+
+
+def main():
+    """Run a standalone replay server"""
+    parser = argparse.ArgumentParser(description="Replay a GPS/IMU log over TCP (RTCM as a NTRIP caster)")
+    parser.add_argument("log", nargs="?", default="", help="raw recording or text log (synthetic data if empty)")
+    parser.add_argument("--kind", choices=("gps", "ubx", "imu", "rtcm"), default="gps")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed, 0 for as fast as possible")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random delay per chunk (seconds)")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of dropping a chunk")
+    parser.add_argument("--mountpoint", default="OEX", help="NTRIP mountpoint (rtcm kind)")
+    parser.add_argument("--ntrip1", action="store_true", help="answer as a Ntrip 1 caster (rtcm kind)")
+    parser.add_argument("--vrs", action="store_true", help="wait for a GGA sentence before streaming (rtcm kind)")
+    args = parser.parse_args()
+    options = {"speed": args.speed, "jitter": args.jitter, "loss": args.loss}
+    if args.kind == "rtcm":
+        server = NTRIPCaster(load_log(args.log, args.kind), args.host, args.port, args.mountpoint,
+                             not args.ntrip1, args.vrs, **options)
+    else:
+        server = ReplayServer(load_log(args.log, args.kind), args.host, args.port, **options)
+    server.start()
+    try:
+        while server.is_alive():
+            time.sleep(5)
+            logging.info("sent %d chunks (%d bytes), lost %d", server.sent, server.sent_bytes, server.lost)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] - %(levelname)s - %(message)s")
+    main()
@@ -100,27 +100,97 @@ function getPolylineDistance(path, point, pointById) {
 	return [minDist, slope, altDiff];
 }
 
-function connectWS(callback) {
+const BINARY_SCHEMA_VERSION = 1;
+const BINARY_SIZES = {"d": 8, "f": 4, "q": 8, "B": 1, "c": 1};
+
+function frameDecoder(schema) {
+    // decode binary frames: version, flags (1: keyframe), 64 bit presence mask, then the present values
+    // slow fields (UTM zone, fix, accuracy) are only sent when they change, their last values are kept
+    if (schema.schema !== BINARY_SCHEMA_VERSION) {
+        throw new Error("unsupported binary frame schema " + schema.schema);
+    }
+    let slowNames = new Set(schema.slow);
+    let slow = {};
+    return function (buffer) {
+        let view = new DataView(buffer);
+        if (view.getUint8(0) !== BINARY_SCHEMA_VERSION) {
+            throw new Error("unexpected binary frame version " + view.getUint8(0));
+        }
+        if (view.getUint8(1) & 1) {
+            slow = {};
+        }
+        let maskLow = view.getUint32(2, true);
+        let maskHigh = view.getUint32(6, true);
+        let offset = 10;
+        let data = {};
+        for (let i = 0; i < schema.fields.length; i++) {
+            if (!((i < 32 ? maskLow >>> i : maskHigh >>> (i - 32)) & 1)) {
+                continue;
+            }
+            let name = schema.fields[i][0];
+            let code = schema.fields[i][1];
+            let value;
+            if (code === "d") {
+                value = view.getFloat64(offset, true);
+            } else if (code === "f") {
+                value = view.getFloat32(offset, true);
+            } else if (code === "q") {
+                value = view.getUint32(offset, true) + view.getInt32(offset + 4, true) * 4294967296;
+            } else if (code === "B") {
+                value = view.getUint8(offset);
+            } else {
+                value = String.fromCharCode(view.getUint8(offset));
+            }
+            offset += BINARY_SIZES[code];
+            if (slowNames.has(name)) {
+                slow[name] = value;
+            } else {
+                data[name] = value;
+            }
+        }
+        for (let name in slow) {
+            data[name] = slow[name];
+        }
+        if ("utm_num" in data) {
+            data.utm_zone = {"num": data.utm_num, "letter": data.utm_letter};
+        }
+        return data;
+    };
+}
+
+function connectWS(callback, subscription) {
+    // frames are pushed by the server, subscription: {"rate": <frames per second>, "fields": [<keys>]},
+    // with "binary": true frames are binary messages, decoded here, callback then receives objects
+    subscription = subscription || {"rate": 10};
     let ws_url = "ws:";
     if (window.location.protocol === "https:") {
         ws_url = "wss:";
     }
     ws_url += "//" + window.location.host + "/data";
     let client = new WebSocket(ws_url);
+    let decode = null;
+    client.binaryType = "arraybuffer";
 
     client.onopen = function () {
         console.log("connected to data ws");
-        client.send("!");
+        client.send(JSON.stringify(subscription));
     };
 
     client.onmessage = function (e) {
-        callback(e.data);
-        setTimeout(function() {client.send("!");}, 100);
+        if (typeof e.data !== "string") {
+            if (decode !== null) {
+                callback(decode(e.data));
+            }
+        } else if (subscription.binary && decode === null) {
+            decode = frameDecoder(JSON.parse(e.data));
+        } else {
+            callback(e.data);
+        }
     };
 
     client.onclose = function (e) {
         console.warn("socket is closed. reconnect will be attempted in 1 second.", e.reason);
-        setTimeout(connectWS, 1000);
+        setTimeout(function() {connectWS(callback, subscription);}, 1000);
     };
 
     client.onerror = function (err) {
@@ -132,7 +202,6 @@ function connectWS(callback) {
             console.error("error closing client", err.message);
         }
         $('#ptim').css('color', 'red');
-        setTimeout(connectWS, 3000);
     };
 }
 
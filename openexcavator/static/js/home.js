@@ -13,7 +13,7 @@ let path = null;
 
 
 function processData(raw_data) {
-    let data = JSON.parse(raw_data);
+    let data = typeof raw_data === "string" ? JSON.parse(raw_data) : raw_data;
     try {
         if (data.roll === undefined || data.pitch === undefined || data.yaw === undefined) {
             $('#rpy').html("not available");
@@ -49,12 +49,18 @@ function processData(raw_data) {
         if (data.imu_time !== undefined) {
             $('#ptim').html(new Date(data.ts * 1000).toISOString().substr(11, 8) + "/" + data.delta.toFixed(2));
         }
-        let result = getPolylineDistance(path, data, pointById);
+        let result = [data.distance, data.slope, data.alt_diff]; //computed by the server
+        if (data.distance === undefined && path !== null) {
+            result = getPolylineDistance(path, data, pointById);
+        }
+        if (data.cut_fill !== undefined) {
+            result[2] = data.cut_fill; //the design surface (if any) gives the height to grade
+        }
         let slope = result[1] * 100;
-        $('#pslo').html(slope.toFixed(2) + '%');
+        $('#pslo').html(result[1] !== undefined ? slope.toFixed(2) + '%' : "-");
         $('#palt').html(data.hasOwnProperty("_alt") ? data._alt.toFixed(2) : "-" + '/' + data.alt.toFixed(2));
         $('#height').html(formatDelta(result[2]));
-        $('#distance').html(formatDelta(result[0]));
+        $('#distance').html(result[0] !== undefined ? formatDelta(result[0]) : "-");
         $('#ptim').css('color', 'black');
         if (result[2] > 0) {
             $('.fa-arrow-circle-down').each(function () {this.style.setProperty('color' , '#5cb85c', 'important')});
@@ -105,25 +111,6 @@ function initMap() {
         accessToken: 'YOUR_MAPBOX_ACCESS_TOKEN'
     }).addTo(myMap);
     L.control.scale().addTo(myMap);
-    let latlngs = [];
-    let deltaAltitude = (stopAltitude-startAltitude) / (path.length - 1);
-    for (let i=0; i<path.length;i++) {
-        let coords = path[i].geometry.coordinates;
-        let circle = L.circle(new L.LatLng(coords[1], coords[0]), 1).addTo(myMap);
-        latlngs.push(new L.LatLng(coords[1], coords[0]));
-        if (utmZone.num === undefined) {
-            let aux = fromLatLon(coords[1], coords[0]);
-            utmZone.num = aux.zoneNum;
-            utmZone.letter = aux.zoneLetter;
-        }
-        pointById[i] = fromLatLon(coords[1], coords[0], utmZone.num);
-        pointById[i].altitude = coords[2];
-        pointById[i].desiredAlt = startAltitude + i * deltaAltitude;
-        pointById[i].circle = circle;
-    }
-    polyline = L.polyline(latlngs, {color: 'red'}).addTo(myMap);
-    bounds = polyline.getBounds();
-    myMap.fitBounds(bounds);
     let popup = L.popup();
     function onMapClick(e) {
         popup
@@ -135,15 +122,93 @@ function initMap() {
     myMap.invalidateSize();
 }
 
+function clearPath() {
+    if (polyline !== null) {
+        myMap.removeLayer(polyline);
+        polyline = null;
+    }
+    for (let id in pointById) {
+        myMap.removeLayer(pointById[id].circle);
+    }
+    pointById = {};
+    path = null;
+}
+
+function showDesign(active) {
+    // active design as returned by /designs: the guidance switches on the server, only the map follows
+    startAltitude = active.start_altitude;
+    stopAltitude = active.stop_altitude;
+    $('#start_altitude').val(active.start_altitude);
+    $('#stop_altitude').val(active.stop_altitude);
+    $('#design').val(active.active === null ? "" : String(active.active));
+    clearPath();
+    if (active.path_url) {
+        $.getJSON(active.path_url, loadPath);
+    }
+}
+
+function postDesign(action, designId) {
+    $.post('/designs', {"action": action, "id": designId, "_xsrf": getCookie("_xsrf")}, showDesign, 'json')
+        .fail(function (xhr) {
+            $('#design_status').html('cannot ' + action + ' design: ' + xhr.responseText);
+        });
+}
+
+function loadPath(artifact) {
+    // path artifact served by /path: points are [lng, lat, alt, easting, northing, fraction] in artifact.utm_zone
+    path = artifact.points;
+    utmZone.num = artifact.utm_zone.num;
+    utmZone.letter = artifact.utm_zone.letter;
+    let latlngs = [];
+    for (let i=0; i<path.length;i++) {
+        let point = path[i];
+        let desiredAlt = startAltitude + point[5] * (stopAltitude - startAltitude);
+        let circle = L.circle(new L.LatLng(point[1], point[0]), 1).addTo(myMap);
+        latlngs.push(new L.LatLng(point[1], point[0]));
+        pointById[i] = {"easting": point[3], "northing": point[4], "zoneNum": utmZone.num, "zoneLetter": utmZone.letter,
+            "altitude": point[2] !== null ? point[2] : desiredAlt, "desiredAlt": desiredAlt, "circle": circle};
+    }
+    polyline = L.polyline(latlngs, {color: 'red'}).addTo(myMap);
+    bounds = polyline.getBounds();
+    myMap.fitBounds(bounds);
+}
+
 $(document).ready(function() {
     startAltitude = parseFloat($('#start_altitude').val());
     stopAltitude = parseFloat($('#stop_altitude').val());
     antennaHeight = parseFloat($('#antenna_height').val());
     safetyHeight = parseFloat($('#safety_height').val());
     safetyDepth = parseFloat($('#safety_depth').val());
-    path = JSON.parse($('#path').attr('data-text'))['features'];
     initMap();
-    connectWS(processData);
+    let pathUrl = $('#mapid').attr('data-path-url');
+    if (pathUrl) {
+        $.getJSON(pathUrl, loadPath).fail(function (xhr) {
+            console.error('cannot load design path: ' + xhr.status);
+        });
+    }
+    $('#design').change(function () {
+        $('#design_status').html("");
+        postDesign("activate", $(this).val());
+    });
+    $('#nearest_design').click(function () {
+        $.getJSON('/designs', function (designs) {
+            if (designs.nearest === null) {
+                $('#design_status').html("no design within reach");
+            }
+            else {
+                $('#design_status').html(designs.nearest.distance.toFixed(1) + " M away");
+                postDesign("activate", designs.nearest.id);
+            }
+        });
+    });
+    $('#delete_design').click(function () {
+        let selected = $('#design option:selected');
+        if (selected.val() && confirm("Delete design " + selected.text() + "?")) {
+            postDesign("delete", selected.val());
+            selected.remove();
+        }
+    });
+    connectWS(processData, {"rate": 10, "binary": true});
 });
 
 $(window).on( "load", function() {
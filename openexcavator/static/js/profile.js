@@ -0,0 +1,93 @@
+const ROW_HEIGHT = 18;
+const MIN_WIDTH = 0.001; // frames narrower than this fraction of the zoomed frame are not drawn
+
+function parseCollapsed(text) {
+    // build the call tree from "thread;outer;...;inner count" lines
+    let root = {"name": "all", "value": 0, "children": {}, "parent": null};
+    text.split("\n").forEach(function (line) {
+        let separator = line.lastIndexOf(" ");
+        if (separator < 0) {
+            return;
+        }
+        let count = parseInt(line.substring(separator + 1));
+        let node = root;
+        root.value += count;
+        line.substring(0, separator).split(";").forEach(function (name) {
+            if (!node.children.hasOwnProperty(name)) {
+                node.children[name] = {"name": name, "value": 0, "children": {}, "parent": node};
+            }
+            node = node.children[name];
+            node.value += count;
+        });
+    });
+    return root;
+}
+
+function frameColor(name) {
+    // same file, same hue
+    let file = name.split(":")[0];
+    let hash = 0;
+    for (let i = 0; i < file.length; i++) {
+        hash = (hash * 31 + file.charCodeAt(i)) % 360;
+    }
+    return "hsl(" + hash + ", 70%, 75%)";
+}
+
+function renderFlamegraph(container, root, zoomed) {
+    // icicle layout: callers on top, a frame is as wide as its share of the zoomed frame samples
+    container.empty();
+    let total = root.value;
+    let rows = [];
+    for (let node = zoomed; node !== null; node = node.parent) {
+        rows.unshift(node); // ancestors of the zoomed frame take the full width
+    }
+    rows.forEach(function (node, depth) {
+        drawFrame(container, node, root, 0, 1, depth);
+    });
+    let depth = rows.length;
+    let maxLevel = depth - 1;
+    let draw = function (node, left, width, level) {
+        let offset = left;
+        Object.values(node.children).sort(function (a, b) {
+            return a.name < b.name ? -1 : 1;
+        }).forEach(function (child) {
+            let childWidth = width * child.value / node.value;
+            if (childWidth >= MIN_WIDTH) {
+                drawFrame(container, child, root, offset, childWidth, level);
+                maxLevel = Math.max(maxLevel, level);
+                draw(child, offset, childWidth, level + 1);
+            }
+            offset += childWidth;
+        });
+    };
+    draw(zoomed, 0, 1, depth);
+    container.css("min-height", (maxLevel + 2) * ROW_HEIGHT);
+    $("#details").text(zoomed.name + ": " + zoomed.value + " samples (" + (100 * zoomed.value / total).toFixed(1) + "%)");
+}
+
+function drawFrame(container, node, root, left, width, level) {
+    let percent = (100 * node.value / root.value).toFixed(2);
+    $("<div>")
+        .text(node.name)
+        .attr("title", node.name + ": " + node.value + " samples (" + percent + "%)")
+        .css({
+            "position": "absolute", "left": (100 * left) + "%", "width": (100 * width) + "%",
+            "top": level * ROW_HEIGHT, "height": ROW_HEIGHT - 1, "overflow": "hidden", "white-space": "nowrap",
+            "font-size": "11px", "line-height": (ROW_HEIGHT - 1) + "px", "padding-left": "2px", "cursor": "pointer",
+            "background": node.parent === null ? "#ddd" : frameColor(node.name), "border-right": "1px solid #fff"
+        })
+        .click(function () {
+            renderFlamegraph(container, root, node);
+        })
+        .appendTo(container);
+}
+
+$(document).ready(function () {
+    let container = $("#flamegraph");
+    let root = parseCollapsed($("#stacks").text());
+    renderFlamegraph(container, root, root);
+    $("#reset").click(function (event) {
+        event.preventDefault();
+        renderFlamegraph(container, root, root);
+    });
+});
@@ -64,7 +64,7 @@ function setValuesData(prefix, data) {
 }
 
 function processData(raw_data) {
-	let data = JSON.parse(raw_data);
+	let data = typeof raw_data === "string" ? JSON.parse(raw_data) : raw_data;
 	try {
 		setValuesData('current_', data);
 		if (startData !== null) {
@@ -0,0 +1,430 @@
+"""
+Design surfaces: TIN (LandXML) or gridded DEM (ESRI ASCII grid) converted once on upload into
+NumPy arrays stored in settings.SURFACE_PATH and memory-mapped when loaded, so a surface of
+millions of triangles opens instantly and only the pages around the machine stay in RAM.
+TIN triangles are registered in a uniform grid (sorted CSR arrays, like design.SegmentIndex) to
+find the triangle under the bucket, DEM cells are found directly; the cut/fill at the bucket
+position is computed for every frame.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import utm
+
+import settings
+import utils
+
+SURFACE_VERSION = 1
+KIND_TIN = "tin"
+KIND_GRID = "grid"
+TRIANGLES_PER_CELL = 2  # average size of the TIN grid index cells (in triangles)
+PARSE_CHUNK = 65536  # LandXML points / faces converted to arrays at once
+EPSILON = 1e-9  # barycentric tolerance, points on an edge belong to both triangles
+
+
+def local_name(tag):
+    """Element tag without its XML namespace"""
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_landxml(source):
+    """
+    Read the first TIN surface of a LandXML file, streamed so large surfaces never build an
+    element tree: points (P, "northing easting elevation") and visible faces (F, point ids)
+    :param source: file name or binary file object
+    :returns: vertices (n x 3 array of easting, northing, elevation), triangles (m x 3 array of
+        vertex indexes), UTM zone number from the WGS 84 / UTM EPSG code (None if not found)
+    """
+    ids, points, faces = [], [], []
+    id_chunks, point_chunks, face_chunks = [], [], []
+    zone_num = None
+    parents = []
+    try:
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                parents.append(elem)
+                continue
+            parents.pop()
+            name = local_name(elem.tag)
+            if name == "P":
+                ids.append(elem.get("id", ""))
+                points.append(elem.text or "")
+                if len(points) == PARSE_CHUNK:
+                    id_chunks.append(parse_numbers(ids, np.int64, 1, "point id"))
+                    point_chunks.append(parse_numbers(points, np.float64, 3, "point"))
+                    ids, points = [], []
+            elif name == "F":
+                if elem.get("i") != "1":  # invisible faces are not part of the surface
+                    faces.append(elem.text or "")
+                    if len(faces) == PARSE_CHUNK:
+                        face_chunks.append(parse_numbers(faces, np.int64, 3, "face"))
+                        faces = []
+            elif name == "CoordinateSystem":
+                epsg = elem.get("epsgCode", "")
+                if epsg.isdigit() and (32601 <= int(epsg) <= 32660 or 32701 <= int(epsg) <= 32760):
+                    zone_num = int(epsg) % 100
+            elif name == "Surface" and (point_chunks or points):
+                break
+            if parents:
+                del parents[-1][:]  # children are done with, keep memory flat
+    except ET.ParseError as exc:
+        raise ValueError("LandXML is not valid: %s" % exc)
+    if points:
+        id_chunks.append(parse_numbers(ids, np.int64, 1, "point id"))
+        point_chunks.append(parse_numbers(points, np.float64, 3, "point"))
+    if faces:
+        face_chunks.append(parse_numbers(faces, np.int64, 3, "face"))
+    if not point_chunks or not face_chunks:
+        raise ValueError("no TIN surface (Pnts and Faces) found in LandXML")
+    vertices = np.concatenate(point_chunks)[:, [1, 0, 2]]
+    point_ids = np.concatenate(id_chunks)
+    face_ids = np.concatenate(face_chunks)
+    if np.array_equal(point_ids, np.arange(1, len(point_ids) + 1)):  # usual numbering, no lookup needed
+        face_ids -= 1
+        valid = (face_ids >= 0) & (face_ids < len(point_ids))
+    else:
+        order = np.argsort(point_ids, kind="stable")
+        point_ids = point_ids[order]
+        np.searchsorted(point_ids, face_ids).clip(0, len(order) - 1, out=face_ids)
+        valid = point_ids[face_ids] == np.concatenate(face_chunks)
+        face_ids = order[face_ids]
+    if not valid.all():
+        raise ValueError("LandXML faces reference missing points")
+    return vertices, face_ids.astype(np.int32), zone_num
+
+
+def parse_numbers(texts, dtype, width, name):
+    """
+    Convert whitespace separated numbers to an array
+    :param texts: list of str, width numbers each
+    :param dtype: NumPy type of the numbers
+    :param width: numbers per text (row width of the result)
+    :param name: what the numbers are, for error messages
+    :returns: len(texts) x width array
+    """
+    values = np.fromstring(" ".join(texts), dtype=dtype, sep=" ")
+    if len(values) != len(texts) * width:
+        raise ValueError("invalid LandXML %s values" % name)
+    return values.reshape(len(texts), width) if width > 1 else values
+
+
+def parse_ascii_grid(data):
+    """
+    Read an ESRI ASCII grid (ncols, nrows, xllcorner or xllcenter, yllcorner or yllcenter, cellsize,
+    optional NODATA_value header lines followed by the rows from north to south)
+    :param data: file bytes
+    :returns: elevations (nrows x ncols float32 array, row 0 at the south, NaN for no data), easting
+        and northing of the center of the south-west cell, cell size
+    """
+    text = data.decode("ascii", errors="replace")
+    header = {}
+    offset = 0
+    for line in io.StringIO(text):
+        parts = line.split()
+        if len(parts) != 2 or not parts[0][0].isalpha():
+            break
+        header[parts[0].lower()] = float(parts[1])
+        offset += len(line)
+    try:
+        ncols, nrows, cell_size = int(header["ncols"]), int(header["nrows"]), header["cellsize"]
+        if "xllcenter" in header:
+            x0, y0 = header["xllcenter"], header["yllcenter"]
+        else:
+            x0, y0 = header["xllcorner"] + cell_size / 2, header["yllcorner"] + cell_size / 2
+    except KeyError as exc:
+        raise ValueError("missing %s from the ASCII grid header" % exc)
+    if ncols < 2 or nrows < 2 or cell_size <= 0:
+        raise ValueError("the ASCII grid needs at least 2 x 2 cells")
+    values = np.fromstring(text[offset:], dtype=np.float32, sep=" ")
+    if len(values) != ncols * nrows:
+        raise ValueError("the ASCII grid has %d values instead of %d" % (len(values), ncols * nrows))
+    elevations = values.reshape(nrows, ncols)[::-1]
+    if "nodata_value" in header:
+        elevations[elevations == np.float32(header["nodata_value"])] = np.nan
+    return np.ascontiguousarray(elevations), x0, y0, cell_size
+
+
+def doubled_areas(vertices, triangles):
+    """
+    Twice the signed areas of triangles, computed as the lookup does (float64 from the stored values)
+    :param vertices: n x 3 array of x, y, z
+    :param triangles: m x 3 array of vertex indexes
+    :returns: array of m areas, 0 for degenerate triangles
+    """
+    (x1, y1), (x2, y2), (x3, y3) = vertices[:, :2][triangles].astype(np.float64).transpose(1, 2, 0)
+    return (y2 - y3) * (x1 - x3) + (x3 - x2) * (y1 - y3)
+
+
+def index_triangles(vertices, triangles):
+    """
+    Register every triangle in the grid cells its bounding box overlaps, the cell size is chosen
+    for TRIANGLES_PER_CELL triangles per cell on average (at most one cell per triangle); done by
+    chunks of triangles to bound the memory needed by millions of triangles
+    :param vertices: n x 3 array of x, y, z (relative to the grid origin, all >= 0)
+    :param triangles: m x 3 array of vertex indexes
+    :returns: cell size, nx, ny, cell starts (nx * ny + 1 array), triangle indexes sorted by cell
+    """
+    chunks = range(0, len(triangles), PARSE_CHUNK)
+    area = sum(float(np.abs(doubled_areas(vertices, triangles[first:first + PARSE_CHUNK])).sum()) / 2
+               for first in chunks)
+    width, height = (float(value) for value in vertices[:, :2].max(axis=0))
+    cell_size = max(math.sqrt(area / len(triangles) * TRIANGLES_PER_CELL), 0.01)
+    # sparse surfaces (far apart patches) would need many empty cells, keep them to one per triangle
+    cell_size = max(cell_size, math.sqrt(width * height / len(triangles)))
+    nx = int(width // cell_size) + 1
+    ny = int(height // cell_size) + 1
+    key_chunks, id_chunks = [], []
+    for first in chunks:
+        corners = vertices[:, :2][triangles[first:first + PARSE_CHUNK]]  # chunk x 3 x 2
+        cx0, cy0 = (corners.min(axis=1) // cell_size).astype(np.int32).T
+        cx1, cy1 = (corners.max(axis=1) // cell_size).astype(np.int32).T
+        spans = cx1 - cx0 + 1
+        counts = spans * (cy1 - cy0 + 1)
+        chunk_ids = np.repeat(np.arange(len(corners), dtype=np.int32), counts)
+        steps = np.arange(len(chunk_ids), dtype=np.int32) - np.repeat(np.cumsum(counts, dtype=np.int32) - counts, counts)
+        spans = spans[chunk_ids]
+        key_chunks.append((cx0[chunk_ids] + steps % spans) * ny + cy0[chunk_ids] + steps // spans)
+        id_chunks.append(chunk_ids + first)
+    keys = np.concatenate(key_chunks)
+    del key_chunks
+    triangle_ids = np.concatenate(id_chunks)
+    del id_chunks
+    starts = np.zeros(nx * ny + 1, dtype=np.uint32)
+    starts[1:] = np.cumsum(np.bincount(keys, minlength=nx * ny))
+    return cell_size, nx, ny, starts, triangle_ids[np.argsort(keys, kind="stable")]
+
+
+def build_tin(vertices, triangles, directory, zone_num=None):
+    """
+    Store a TIN surface: vertices relative to the south-west corner (float32 keeps millimeters
+    over tens of kilometers), triangles and their grid index
+    :param vertices: n x 3 array of easting, northing, elevation
+    :param triangles: m x 3 array of vertex indexes
+    :param directory: folder the arrays are written to
+    :param zone_num: UTM zone number of the coordinates, None for the zone of the machine
+    :returns: metadata dict (also written to meta.json)
+    """
+    origin = vertices[:, :2].min(axis=0)
+    local = (vertices - [origin[0], origin[1], 0]).astype(np.float32)
+    triangles = triangles[np.concatenate([doubled_areas(local, triangles[first:first + PARSE_CHUNK]) != 0
+                                          for first in range(0, len(triangles), PARSE_CHUNK)])]
+    if not len(triangles):
+        raise ValueError("the TIN surface has no triangle")
+    cell_size, nx, ny, starts, cell_triangles = index_triangles(local, triangles)
+    np.save(os.path.join(directory, "vertices.npy"), local)
+    np.save(os.path.join(directory, "triangles.npy"), triangles.astype(np.int32))
+    np.save(os.path.join(directory, "cells.npy"), starts)
+    np.save(os.path.join(directory, "cell_triangles.npy"), cell_triangles)
+    return write_meta(directory, {"kind": KIND_TIN, "origin": [float(origin[0]), float(origin[1])],
+                                  "cell_size": cell_size, "nx": nx, "ny": ny, "vertices": len(local),
+                                  "triangles": len(triangles), "zone_num": zone_num})
+
+
+def build_grid(elevations, x0, y0, cell_size, directory):
+    """
+    Store a DEM surface
+    :param elevations: rows x cols array, row 0 at the south, NaN for no data
+    :param x0: easting of the center of the south-west cell
+    :param y0: northing of the center of the south-west cell
+    :param cell_size: cell size in meters
+    :param directory: folder the array is written to
+    :returns: metadata dict (also written to meta.json)
+    """
+    np.save(os.path.join(directory, "elevations.npy"), elevations.astype(np.float32))
+    return write_meta(directory, {"kind": KIND_GRID, "origin": [float(x0), float(y0)], "cell_size": float(cell_size),
+                                  "nx": elevations.shape[1], "ny": elevations.shape[0], "zone_num": None})
+
+
+def write_meta(directory, meta):
+    """
+    Write the metadata of a surface, last so a folder without meta.json is an incomplete surface
+    :param directory: folder of the surface arrays
+    :param meta: metadata dict, the version is added
+    :returns: meta
+    """
+    meta["version"] = SURFACE_VERSION
+    with open(os.path.join(directory, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+    return meta
+
+
+def import_surface(data, root=None):
+    """
+    Convert an uploaded surface (LandXML TIN or ESRI ASCII grid, zipped or not) and store it,
+    coordinates are UTM eastings / northings (in the zone of the machine if the file has no
+    WGS 84 / UTM EPSG code) and elevations in the units of the GNSS altitude
+    :param data: file bytes
+    :param root: folder of the surfaces, settings.SURFACE_PATH if not supplied
+    :returns: surface id (content hash), the folder name in root
+    """
+    root = root or settings.SURFACE_PATH
+    if data[:2] == b"PK":
+        data = utils.extract_zip(data)
+    surface_id = hashlib.sha1(data).hexdigest()[:16]
+    directory = os.path.join(root, surface_id)
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        return surface_id
+    os.makedirs(root, exist_ok=True)
+    building = tempfile.mkdtemp(prefix=".%s-" % surface_id, dir=root)
+    try:
+        if data.lstrip(b"\xef\xbb\xbf \t\r\n")[:1] == b"<":
+            vertices, triangles, zone_num = parse_landxml(io.BytesIO(data))
+            meta = build_tin(vertices, triangles, building, zone_num)
+        else:
+            meta = build_grid(*parse_ascii_grid(data), building)
+        os.replace(building, directory)
+    except Exception:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    logging.info("imported %s surface %s", meta["kind"], surface_id)
+    return surface_id
+
+
+class Surface:
+    """Design surface stored by import_surface, arrays memory-mapped read-only"""
+
+    def __init__(self, directory, meta):
+        """
+        :param directory: folder of the surface arrays
+        :param meta: metadata dict (meta.json)
+        """
+        self.directory = directory
+        self.surface_id = os.path.basename(directory)
+        self.origin_x, self.origin_y = meta["origin"]
+        self.cell_size = meta["cell_size"]
+        self.nx = meta["nx"]
+        self.ny = meta["ny"]
+        self.zone_num = meta.get("zone_num")
+
+    def load(self, name):
+        return np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r")
+
+    @classmethod
+    def from_id(cls, surface_id, root=None):
+        """
+        Load a stored surface
+        :param surface_id: id returned by import_surface
+        :param root: folder of the surfaces, settings.SURFACE_PATH if not supplied
+        :returns: TINSurface or GridSurface instance
+        """
+        directory = os.path.join(root or settings.SURFACE_PATH, surface_id)
+        with open(os.path.join(directory, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get("version") != SURFACE_VERSION:
+            raise ValueError("unsupported surface version")
+        return {KIND_TIN: TINSurface, KIND_GRID: GridSurface}[meta["kind"]](directory, meta)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Load the surface of the config, None if there is none or it cannot be loaded
+        :param config: config dict
+        :returns: Surface instance or None
+        """
+        surface_id = config.get("surface")
+        if not surface_id:
+            return None
+        try:
+            return cls.from_id(surface_id)
+        except (OSError, KeyError, ValueError) as exc:
+            logging.warning("cannot load design surface %s: %s", surface_id, exc)
+            return None
+
+    def bounds(self):
+        """
+        :returns: min easting, min northing, max easting, max northing of the surface
+        """
+        return (self.origin_x, self.origin_y, self.origin_x + self.nx * self.cell_size,
+                self.origin_y + self.ny * self.cell_size)
+
+    def elevation(self, easting, northing):
+        """
+        Design elevation at a point
+        :param easting: point easting
+        :param northing: point northing
+        :returns: elevation, None outside the surface
+        """
+        raise NotImplementedError
+
+    def evaluate(self, lat, lng, alt, utm_zone):
+        """
+        Compute the cut/fill at the bucket position
+        :param lat: bucket latitude
+        :param lng: bucket longitude
+        :param alt: bucket altitude
+        :param utm_zone: dict with the UTM zone num of the machine, used when the surface has none
+        :returns: dict with surface_alt and cut_fill (bucket above the surface when positive), empty
+            outside the surface
+        """
+        proj_coords = utm.from_latlon(lat, lng, self.zone_num or utm_zone["num"])
+        elevation = self.elevation(proj_coords[0], proj_coords[1])
+        if elevation is None:
+            return {}
+        return {"surface_alt": elevation, "cut_fill": alt - elevation}
+
+
+class TINSurface(Surface):
+    """Triangulated surface, the triangle under a point is found with the grid index"""
+
+    def __init__(self, directory, meta):
+        super().__init__(directory, meta)
+        self.vertices = self.load("vertices")
+        self.triangles = self.load("triangles")
+        self.cells = self.load("cells")
+        self.cell_triangles = self.load("cell_triangles")
+
+    def elevation(self, easting, northing):
+        x = easting - self.origin_x
+        y = northing - self.origin_y
+        cell_x = int(x // self.cell_size)
+        cell_y = int(y // self.cell_size)
+        if not (0 <= cell_x < self.nx and 0 <= cell_y < self.ny):
+            return None
+        key = cell_x * self.ny + cell_y
+        start, end = self.cells[key:key + 2].tolist()
+        for (x1, y1, z1), (x2, y2, z2), (x3, y3, z3) in \
+                self.vertices[self.triangles[self.cell_triangles[start:end]]].tolist():
+            det = (y2 - y3) * (x1 - x3) + (x3 - x2) * (y1 - y3)
+            weight1 = ((y2 - y3) * (x - x3) + (x3 - x2) * (y - y3)) / det
+            weight2 = ((y3 - y1) * (x - x3) + (x1 - x3) * (y - y3)) / det
+            weight3 = 1 - weight1 - weight2
+            if weight1 >= -EPSILON and weight2 >= -EPSILON and weight3 >= -EPSILON:
+                return weight1 * z1 + weight2 * z2 + weight3 * z3
+        return None
+
+
+class GridSurface(Surface):
+    """DEM, bilinear interpolation between the cell centers (nearest cell next to missing data)"""
+
+    def __init__(self, directory, meta):
+        super().__init__(directory, meta)
+        self.elevations = self.load("elevations")
+
+    def bounds(self):
+        half = self.cell_size / 2  # the origin is the center of the south-west cell
+        return (self.origin_x - half, self.origin_y - half, self.origin_x + self.nx * self.cell_size - half,
+                self.origin_y + self.ny * self.cell_size - half)
+
+    def elevation(self, easting, northing):
+        x = (easting - self.origin_x) / self.cell_size
+        y = (northing - self.origin_y) / self.cell_size
+        if not (-0.5 <= x <= self.nx - 0.5 and -0.5 <= y <= self.ny - 0.5):
+            return None
+        col = min(max(int(math.floor(x)), 0), self.nx - 2)
+        row = min(max(int(math.floor(y)), 0), self.ny - 2)
+        dx = min(max(x - col, 0.0), 1.0)
+        dy = min(max(y - row, 0.0), 1.0)
+        (z00, z01), (z10, z11) = self.elevations[row:row + 2, col:col + 2].tolist()
+        if math.isnan(z00 + z01 + z10 + z11):
+            value = (z00, z01, z10, z11)[2 * round(dy) + round(dx)]
+            return None if math.isnan(value) else value
+        return (z00 * (1 - dx) + z01 * dx) * (1 - dy) + (z10 * (1 - dx) + z11 * dx) * dy
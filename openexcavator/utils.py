@@ -6,8 +6,13 @@ Created on Oct 11, 2017
 
 import datetime
 import io
+import itertools
 import zipfile
 
+import tornado.ioloop
+
+import settings
+
 
 def json_encoder(obj):
     """
@@ -20,6 +25,18 @@ def json_encoder(obj):
     return obj
 
 
+_sequence = itertools.count(1)
+
+
+def next_sequence():
+    """
+    Return the next sample sequence number (shared by all sources, so it keeps increasing
+    when a source is replaced)
+    :returns: int
+    """
+    return next(_sequence)
+
+
 def format_frame(frame):
     """
     Return a nice representation of frame.f_locals
@@ -43,3 +60,41 @@ def extract_zip(data):
     for filename in zip_file.infolist():
         data = zip_file.read(filename)
         return data
+
+
+def handover(old_func, new_func, on_switch):
+    """
+    Build a data function serving the old source until the new one returns data,
+    used to swap sensor sources without a gap in the data
+    :param old_func: data function of the running source
+    :param new_func: data function of the new source
+    :param on_switch: called once (without arguments) when the new source returned data
+    :returns: data function
+    """
+    switched = []
+
+    def data_func():
+        try:
+            data = new_func()
+        except IndexError:
+            data = None
+        if data:
+            if not switched:
+                switched.append(True)
+                on_switch()
+            return data
+        return old_func()
+
+    return data_func
+
+
+def start_source(source):
+    """
+    Start a source thread, or run it as a coroutine on the IOLoop when ASYNCIO_SOURCES is set
+    and the source supports it (run_async method)
+    :param source: threading.Thread instance
+    """
+    if settings.ASYNCIO_SOURCES and hasattr(source, "run_async"):
+        tornado.ioloop.IOLoop.current().spawn_callback(source.run_async)
+    else:
+        source.start()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the application modules import each other as top level modules (run from the openexcavator folder)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "openexcavator"))
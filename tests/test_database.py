@@ -0,0 +1,34 @@
+import sqlite3
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def old_database(tmp_path, monkeypatch):
+    """Database created by a version without the UBX, NTRIP and IMU filter settings"""
+    path = str(tmp_path / "openexcavator.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE config(id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, value TEXT, "
+                     "CONSTRAINT config_unique_key UNIQUE(key))")
+        conn.executemany("INSERT INTO config(key, value) VALUES(?, ?)",
+                         [("gps_type", "Reach"), ("gps_host", "10.0.0.2"), ("imu_type", "Reach"),
+                          ("start_altitude", "650"), ("stop_altitude", "660"), ("path", "")])
+    monkeypatch.setattr(database, "DB_PATH", path)
+    monkeypatch.setattr(database, "_connection", None)
+    monkeypatch.setattr(database, "_config", None)
+    yield database
+    database.get_connection().close()
+
+
+def test_populate_adds_missing_keys_only(old_database):
+    old_database.create_structure()
+    added = old_database.populate_config()
+    assert "gps_serial_port" in added and "imu_filter" in added and "gps_host" not in added
+    config = old_database.get_config()
+    assert config["gps_host"] == "10.0.0.2"
+    assert config["start_altitude"] == "650"
+    assert config["imu_filter"] == "Madgwick"
+    assert config.gps_rate == 10
+    assert old_database.populate_config() == []
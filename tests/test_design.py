@@ -0,0 +1,36 @@
+import math
+import random
+import warnings
+
+import pytest
+
+from design import SegmentIndex
+
+
+def brute_force(xs, ys, x, y):
+    index = SegmentIndex(xs, ys)
+    return min(index.segment_distance(segment, x, y) for segment in range(len(xs) - 1))
+
+
+def test_nearest_matches_brute_force():
+    rng = random.Random(5)
+    xs = [500000.0 + 5 * step + rng.uniform(-2, 2) for step in range(200)]
+    ys = [5700000.0 + 20 * math.sin(step / 10) for step in range(200)]
+    index = SegmentIndex(xs, ys)
+    for _ in range(500):
+        x, y = rng.uniform(499950, 501050), rng.uniform(5699950, 5700050)
+        assert index.nearest(x, y)[1] == pytest.approx(brute_force(xs, ys, x, y))
+
+
+def test_repeated_vertices():
+    xs = [0.0, 0.0, 10.0, 10.0, 10.0, 20.0]
+    ys = [0.0, 0.0, 0.0, 0.0, 10.0, 10.0]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")  # no 0 / 0 RuntimeWarning
+        index = SegmentIndex([x + 1000 for x in xs], [y + 1000 for y in ys], cell_size=1)
+    for x, y in ((1005, 1001), (1010, 1005), (1020, 1010), (1010, 1000)):
+        assert index.nearest(x, y)[1] == pytest.approx(brute_force([v + 1000 for v in xs], [v + 1000 for v in ys],
+                                                                   x, y))
+    # the zero-length segment at (1010, 1000) is registered in its own cell only
+    cells = [key for key, (start, end) in index.cells.items() if 2 in index.segments[start:end]]
+    assert cells == [10 * index.ny + 0]
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+import broadcast
+from handlers import DataHandler
+
+
+class FakeBroadcaster:
+
+    def __init__(self):
+        self.clients = []
+
+    def add(self, client):
+        self.clients.append(client)
+
+
+class FakeApplication:
+
+    def __init__(self):
+        self.broadcaster = FakeBroadcaster()
+        self.data_queue = []
+
+
+def subscribe(message):
+    handler = DataHandler.__new__(DataHandler)
+    handler.application = FakeApplication()
+    handler.open()
+    handler.on_message(message)
+    return handler
+
+
+@pytest.mark.parametrize("rate", ["0", "-5", "NaN", "Infinity", "-Infinity", '"fast"', "null"])
+def test_invalid_rate_rejected(rate):
+    handler = subscribe('{"rate": %s}' % rate)
+    assert handler.application.broadcaster.clients == []
+    assert handler.min_interval == 1.0 / broadcast.DEFAULT_RATE
+
+
+@pytest.mark.parametrize("rate, expected", [(1000, broadcast.MAX_RATE), (1e-9, broadcast.MIN_RATE), (5, 5)])
+def test_rate_clamped(rate, expected):
+    handler = subscribe(json.dumps({"rate": rate}))
+    assert handler.application.broadcaster.clients == [handler]
+    assert handler.min_interval == pytest.approx(1.0 / expected)
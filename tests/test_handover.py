@@ -0,0 +1,114 @@
+from collections import deque
+
+import pytest
+
+from gps.gps import GPSHandler
+from imu.imu import ATTITUDE_HISTORY, IMUHandler
+from ringbuffer import RingBuffer
+from rotate import rpy_to_quaternion
+
+
+class FakeSource:
+    """Stand-in for a source thread publishing to a queue (and for IMUs to attitude and tip ring buffers)"""
+
+    def __init__(self):
+        self.queue = deque(maxlen=1)
+        self.attitude = RingBuffer(ATTITUDE_HISTORY, 4)
+        self.tip = RingBuffer(ATTITUDE_HISTORY, 3)
+        self.stopped = False
+
+    def publish(self, timestamp, yaw, seq):
+        """Publish an IMU sample as the Reach and FXOS8700 sources do: ring buffers, then the queue"""
+        self.attitude.append(timestamp, rpy_to_quaternion(0, 0, yaw), seq)
+        self.tip.append(timestamp, (0, yaw, 0), seq)
+        self.queue.append({"roll": 0, "pitch": 0, "yaw": yaw, "imu_time": timestamp, "seq": seq})
+
+    def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    """Replace the source factories of both handlers, the sources built are returned by name"""
+    built = {}
+
+    def build(handler, name):
+        source = FakeSource()
+        handler.threads.append(source)
+        built[name] = source
+        return lambda: source.queue[-1]
+
+    monkeypatch.setattr(GPSHandler, "_GPSHandler__parse_data_func",
+                        lambda self, config: build(self, config["gps_host"]))
+
+    def build_imu(handler, name):
+        data_func = build(handler, name)
+        return data_func, built[name].attitude, built[name].tip
+
+    monkeypatch.setattr(IMUHandler, "_parse_data_func", lambda self, config: build_imu(self, config["imu_host"]))
+    return built
+
+
+def gps_config(name):
+    return {"gps_type": "Reach", "gps_host": name, "gps_port": 9000}
+
+
+def imu_config(name):
+    return {"imu_type": "Reach", "imu_host": name, "imu_port": 9001, "imu_filter": "madgwick"}
+
+
+@pytest.mark.parametrize("handler_class, config", [(GPSHandler, gps_config), (IMUHandler, imu_config)])
+def test_old_source_serves_until_new_one_does(sources, handler_class, config):
+    handler = handler_class(config("A"))
+    sources["A"].queue.append({"seq": 1})
+    assert handler.update_config(config("B"))
+    assert not handler.update_config(config("B"))
+    assert handler.get_data() == {"seq": 1}
+    assert not sources["A"].stopped
+    sources["B"].queue.append({"seq": 2})
+    assert handler.get_data() == {"seq": 2}
+    assert sources["A"].stopped
+    assert handler.old_threads == []
+    assert handler.threads == [sources["B"]]
+
+
+@pytest.mark.parametrize("handler_class, config", [(GPSHandler, gps_config), (IMUHandler, imu_config)])
+def test_superseded_replacement_is_stopped(sources, handler_class, config):
+    handler = handler_class(config("A"))
+    sources["A"].queue.append({"seq": 1})
+    handler.update_config(config("B"))
+    handler.update_config(config("C"))
+    assert sources["B"].stopped  # never served, dropped as soon as C replaced it
+    sources["B"].queue.append({"seq": 2})
+    assert handler.get_data() == {"seq": 1}
+    sources["C"].queue.append({"seq": 3})
+    assert handler.get_data() == {"seq": 3}
+    assert sources["A"].stopped
+    handler.update_config(config("D"))
+    assert not sources["C"].stopped
+    handler.stop()
+    assert sources["C"].stopped and sources["D"].stopped
+
+
+@pytest.mark.parametrize("handler_class, config", [(GPSHandler, gps_config), (IMUHandler, imu_config)])
+def test_no_data_yet(sources, handler_class, config):
+    handler = handler_class(config("A"))
+    handler.update_config(config("B"))
+    assert handler.get_data() == {}
+
+
+def test_attitude_path_switches_to_new_source(sources):
+    handler = IMUHandler(imu_config("A"))
+    for index in range(10):
+        sources["A"].publish(100 + index * 0.1, 10.0, index)
+    assert handler.update_config(imu_config("B"))
+    assert handler.get_attitude(100.55)["yaw"] == pytest.approx(10.0)
+    assert handler.get_tip(100.55).tolist() == pytest.approx([0, 10.0, 0])
+    assert not sources["A"].stopped
+    # the data manager only reads the ring buffers while GNSS epochs have a time
+    sources["B"].publish(101.0, 20.0, 20)
+    attitude = handler.get_attitude(101.0)
+    assert attitude["yaw"] == pytest.approx(20.0) and attitude["seq"] == 20
+    assert handler.get_tip(101.0).tolist() == pytest.approx([0, 20.0, 0])
+    assert sources["A"].stopped and handler.old_threads == []
+    assert handler.attitude is sources["B"].attitude and handler.tip is sources["B"].tip
@@ -0,0 +1,127 @@
+import math
+import time
+
+import pytest
+
+from constants import ExcavatorPart
+from database import Config
+from imu.fxos8700_fxas21001 import FXAS21002C_ADDRESS, FXOS8700_FXAS21002C
+from imu.imu import IMUHandler
+from ringbuffer import RingBuffer
+from rotate import quaternion_to_rpy
+import settings
+from simulator import FakeFXAS21002C, FakeFXOS8700, FakeI2C, fake_imu_bus, fake_imu_chain_bus
+
+
+def wait_for(condition, timeout=5.0):
+    """Poll condition until it is true or timeout seconds elapsed"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_wrong_chip():
+    with pytest.raises(RuntimeError, match="FXOS8700 not found"):
+        FXOS8700_FXAS21002C(FakeI2C({0x1F: FakeFXAS21002C(), 0x21: FakeFXAS21002C()}))
+
+
+def test_burst_read_calibrated():
+    bus = FakeI2C({0x1F: FakeFXOS8700(yaw_rate=0.5, calibrated=True),
+                   0x21: FakeFXAS21002C(yaw_rate=0.5, calibrated=True)})
+    imu = FXOS8700_FXAS21002C(bus)
+    transactions = bus.transactions
+    gyr, acc, mag = imu.read_all()
+    assert bus.transactions == transactions + 2  # one burst read per chip
+    assert gyr.tolist() == pytest.approx([0, 0, 0.5], abs=0.01)
+    assert acc.tolist() == pytest.approx([0, 0, 1], abs=0.01)
+    assert math.hypot(mag[0], mag[1]) == pytest.approx(20, abs=0.1) and mag[2] == pytest.approx(-40, abs=0.1)
+
+
+@pytest.fixture
+def imu():
+    attitude = RingBuffer(512, 4)
+    imu = FXOS8700_FXAS21002C(fake_imu_bus(yaw_rate=0.5), attitude=attitude, rate=100)
+    imu.start()
+    yield imu
+    imu.stop()
+    imu.join(2)
+
+
+def test_sampling(imu):
+    assert wait_for(lambda: imu.get_data())
+    first = imu.get_data()
+    time.sleep(0.5)
+    data = imu.get_data()
+    assert data["seq"] > first["seq"] and data["imu_time"] > first["imu_time"]
+    yaw_rate = math.radians((data["yaw"] - first["yaw"] + 180) % 360 - 180) / (data["imu_time"] - first["imu_time"])
+    assert yaw_rate == pytest.approx(0.5, rel=0.3)
+    stats = imu.stats()
+    assert stats["rate"] == pytest.approx(100, rel=0.2)
+    assert stats["errors"] == 0 and stats["lost"] == 0
+    timestamp, _, seq = imu.attitude.latest()
+    assert len(imu.attitude) >= 40 and seq >= data["seq"] and timestamp >= data["imu_time"]
+
+
+@pytest.mark.parametrize("filter_name", ["Madgwick", "Mahony", "EKF"])
+def test_yaw_is_heading_from_north(filter_name):
+    bus = FakeI2C({0x1F: FakeFXOS8700(yaw_rate=0, calibrated=True), 0x21: FakeFXAS21002C(yaw_rate=0, calibrated=True)})
+    attitude = RingBuffer(512, 4)
+    imu = FXOS8700_FXAS21002C(bus, attitude=attitude, filter_name=filter_name)  # level, x pointing north
+    imu.start()
+    try:
+        assert wait_for(lambda: len(attitude) >= 10)
+        data = imu.get_data()
+    finally:
+        imu.stop()
+    # the EKF settles a few degrees off, a frame mix-up would be 90 degrees
+    assert (data["roll"], data["pitch"], data["yaw"]) == pytest.approx((0, 0, 0), abs=5)
+    assert quaternion_to_rpy(attitude.latest()[1])[2] == pytest.approx(0, abs=5)
+
+
+def test_bus_errors_and_filter_change(imu):
+    assert wait_for(lambda: imu.get_data())
+    gyroscope = imu._i2c.devices.pop(FXAS21002C_ADDRESS)
+    assert wait_for(lambda: imu.stats()["errors"] >= 5)
+    imu._i2c.devices[FXAS21002C_ADDRESS] = gyroscope
+    imu.set_filter("Mahony")
+    seq = imu.get_data()["seq"]
+    assert wait_for(lambda: imu.get_data()["seq"] > seq and imu.filter.name == "Mahony")
+    assert imu.is_alive() and imu.sampler.is_alive()
+
+
+def chain_config(bucket_length):
+    return Config({"imu_type": "FXOS8700+FXAS21001 chain", "imu_filter": "Madgwick", "antenna_height": "1.0",
+                   "boom_length": "5.0", "stick_length": "3.0", "bucket_length": str(bucket_length)})
+
+
+def test_chain_on_multiplexer():
+    pitches = {ExcavatorPart.BOOM: -30, ExcavatorPart.STICK: 20, ExcavatorPart.BUCKET: 60}
+    bus = fake_imu_chain_bus({settings.IMU_CHAIN_CHANNELS[part.name]: math.radians(pitches.get(part, 0))
+                              for part in ExcavatorPart})
+    handler = IMUHandler(chain_config(1.0), i2c=bus)
+    try:
+        assert wait_for(lambda: handler.get_data() and handler.get_tip() is not None)
+        data = handler.get_data()
+        for part, pitch in pitches.items():
+            assert data["%s_pitch" % part.name.lower()] == pytest.approx(pitch, abs=0.5)
+        # positive pitch tilts the link down
+        horizontal = sum(length * math.cos(math.radians(pitches[part])) for part, length in
+                         ((ExcavatorPart.BOOM, 5.0), (ExcavatorPart.STICK, 3.0), (ExcavatorPart.BUCKET, 1.0)))
+        up = -1.0 - sum(length * math.sin(math.radians(pitches[part])) for part, length in
+                        ((ExcavatorPart.BOOM, 5.0), (ExcavatorPart.STICK, 3.0), (ExcavatorPart.BUCKET, 1.0)))
+        assert data["yaw"] == pytest.approx(0, abs=0.5)  # cab and boom pointing north
+        assert handler.get_tip().tolist() == pytest.approx([0, horizontal, up], abs=0.05)
+
+        assert not handler.update_config(chain_config(2.0))  # link lengths are applied in place
+        assert wait_for(lambda: math.hypot(*handler.get_tip()[:2]) == pytest.approx(horizontal + 0.5, abs=0.05))
+        chain = handler.threads[0]
+        assert chain.stats()["errors"] == 0
+    finally:
+        handler.stop()
+    chain.join(2)
+    # one multiplexer switch per board to configure it, then boards read in channel order, reversed
+    # every other sample: 3 switches per sample
+    assert handler.mux.switches == bus.mux.writes <= 4 + 3 * chain.samples.count + 1
@@ -0,0 +1,62 @@
+from collections import deque
+from functools import reduce
+from operator import xor
+import random
+
+import pytest
+
+from gps.nmea import NMEAParser, checksum, gga_sentence, sentence
+from reach.gps import ReachGPS
+from simulator import synthetic_chunks
+
+GGA = b"$GNGGA,211324.39,5141.97000,N,00524.93000,E,4,12,0.6,655.000,M,45.000,M,1.0,0000*51"
+
+
+def test_checksum_matches_byte_loop():
+    rng = random.Random(4)
+    for size in range(300):
+        body = bytes(rng.randrange(256) for _ in range(size))
+        assert checksum(body) == reduce(xor, body, 0)
+
+
+def test_epochs_match_reference_parser():
+    reach = ReachGPS("127.0.0.1", 0, deque(maxlen=1))
+    for _, data in synthetic_chunks("gps", seconds=2):
+        parsed = reach.parse_data(data)
+        reference = reach.parse_data_reference(data.decode())
+        assert parsed["ts"] == pytest.approx(reference.pop("ts").timestamp(), abs=1e-6)
+        for name, value in reference.items():
+            assert parsed[name] == pytest.approx(value)
+
+
+@pytest.mark.parametrize("line", [GGA, GGA + b"\r", memoryview(bytearray(GGA + b"\r"))])
+def test_bytes_and_buffer_views(line):
+    epoch = {}
+    assert NMEAParser().parse(line, epoch) == b"GGA"
+    assert epoch == {"fix": 4.0, "alt": 700.0}
+
+
+def test_invalid_sentences():
+    parser = NMEAParser()
+    epoch = {}
+    assert parser.parse(GGA[:-1] + b"0", epoch) is None
+    assert parser.parse(GGA.replace(b"655.000", b"655.0x0")[:-2] + b"%02X" % checksum(
+        GGA.replace(b"655.000", b"655.0x0")[1:-3]), epoch) is None
+    assert parser.errors == 2
+    assert parser.parse(b"$GNZDA,211324.39,17,10,2026,00,00*74", epoch) is None
+    assert parser.errors == 2  # unsupported sentences are skipped without checking them
+    assert epoch == {}
+
+
+def test_rmc_without_fix():
+    epoch = {}
+    assert NMEAParser().parse(sentence("GNRMC,211324.39,V,,,,,,,171026,,,N").strip(), epoch) == b"RMC"
+    assert epoch == {}
+
+
+def test_gga_sentence_round_trip():
+    epoch = {}
+    data = {"lat": 51.69951, "lng": -5.4155, "alt": 700.25, "fix": 4, "ts": 1791234567.25}
+    assert NMEAParser().parse(gga_sentence(data).strip(), epoch) == b"GGA"
+    assert epoch == {"fix": 4.0, "alt": 700.25}
+    assert gga_sentence(data).startswith(b"$GPGGA,210927.25,5141.97060,N,00524.93000,W,4,")
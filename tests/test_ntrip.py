@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from gps import ntrip_client
+from gps.ntrip_client import ChunkedDecoder, NTRIPClient, check_response, reconnect_delay
+from gps.rtcm import CorrectionQueue, RTCM3Framer
+from simulator import NTRIPCaster, synthetic_chunks
+
+
+def wait_for(condition, timeout=5.0):
+    """Poll condition until it is true or timeout seconds elapsed"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_chunked_decoder_any_split():
+    body = b"5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\n\r\n"
+    for size in (1, 2, 3, 7, len(body)):
+        decoder = ChunkedDecoder()
+        output = b"".join(decoder.feed(body[start:start + size]) for start in range(0, len(body), size))
+        assert output == b"hello world"
+        assert decoder.finished
+
+
+def test_chunked_decoder_invalid_size_line():
+    with pytest.raises(ValueError):
+        ChunkedDecoder().feed(b"zz\r\n")
+    with pytest.raises(ValueError):
+        ChunkedDecoder().feed(b"1" * 100)
+
+
+def test_check_response():
+    assert check_response(b"HTTP/1.1 200 OK\r\n", [b"Transfer-Encoding: chunked"])
+    assert not check_response(b"ICY 200 OK\r\n", [])
+    with pytest.raises(ConnectionRefusedError, match="source table"):
+        check_response(b"SOURCETABLE 200 OK\r\n", [])
+    with pytest.raises(ConnectionRefusedError, match="401"):
+        check_response(b"HTTP/1.1 401 Unauthorized\r\n", [])
+
+
+def test_reconnect_delay(monkeypatch):
+    monkeypatch.setattr(ntrip_client.random, "uniform", lambda low, high: high)
+    assert [reconnect_delay(attempt) for attempt in range(1, 9)] == [1, 2, 4, 8, 16, 32, 60, 60]
+    monkeypatch.setattr(ntrip_client.random, "uniform", lambda low, high: low)
+    assert reconnect_delay(3) == 2
+
+
+GGA_DATA = {"lat": 51.6995, "lng": 5.4155, "alt": 700.0, "fix": 4, "ts": 1700000000.0}
+
+
+def client_config(caster, mountpoint=None):
+    return {"ntrip_host": caster.host, "ntrip_port": str(caster.port),
+            "ntrip_mountpoint": mountpoint or caster.mountpoint, "ntrip_user": "user", "ntrip_password": "secret"}
+
+
+@pytest.fixture(params=[True, False], ids=["ntrip2", "ntrip1"])
+def caster(request):
+    caster = NTRIPCaster(synthetic_chunks("rtcm", seconds=5), chunked=request.param, require_gga=True, speed=10)
+    caster.start()
+    yield caster
+    caster.stop()
+
+
+def test_stream_with_gga_upstream(caster):
+    queue = CorrectionQueue()
+    client = NTRIPClient(client_config(caster), queue, gga_source=lambda: GGA_DATA, gga_interval=10)
+    client.start()
+    try:
+        assert wait_for(lambda: len(queue) >= 3)
+        assert caster.gga and caster.gga[0].startswith(b"$GPGGA,221320.00,5141.97000,N,00524.93000,E,4,")
+        framer = RTCM3Framer()
+        frames = [frame for chunk in queue.get_all() for frame in framer.feed(chunk)]
+        assert frames and framer.errors == 0 and not framer.buffer  # only whole frames are queued
+        assert client.failures == 0
+    finally:
+        client.stop()
+
+
+def test_missing_mountpoint_backs_off(caster, monkeypatch):
+    delays = []
+
+    def reconnect_delay(attempt):
+        delays.append(attempt)
+        return 0.01
+
+    monkeypatch.setattr(ntrip_client, "reconnect_delay", reconnect_delay)
+    client = NTRIPClient(client_config(caster, "MISSING"), CorrectionQueue(), lambda: GGA_DATA, 10)
+    client.start()
+    try:
+        assert wait_for(lambda: len(delays) >= 3)
+        assert delays[:3] == [1, 2, 3] and not client.queue
+        client.update_config(client_config(caster))  # reconfiguring resets the backoff
+        assert wait_for(lambda: len(client.queue))
+        assert client.failures == 0
+    finally:
+        client.stop()
@@ -0,0 +1,62 @@
+import math
+import os
+
+import numpy as np
+import pytest
+
+import recorder
+from frame import Frame
+
+
+def frame_recorder(directory, **kwargs):
+    return recorder.Recorder(str(directory), "frames", recorder.KIND_FRAME, recorder.pack_frame,
+                             recorder.FRAME_RECORD.size, flush_interval=0.05, **kwargs)
+
+
+def test_frames_round_trip(tmp_path):
+    frames = frame_recorder(tmp_path)
+    frames.start()
+    for index in range(10):
+        frames.record_frame(Frame(ts=1e9 + index, lat=51.7, lng=5.4, alt=700.0, surface_alt=699.5, cut_fill=0.5,
+                                  gps_seq=index))
+    frames.record_frame(Frame(ts=1e9 + 10))
+    frames.stop()
+    frames.join(5)
+    (path,) = recorder.list_files(str(tmp_path), "frames")
+    records = recorder.RecordReader(path).records
+    assert len(records) == 11
+    assert records["surface_alt"][0] == 699.5 and records["cut_fill"][0] == pytest.approx(0.5)
+    assert list(records["gps_seq"]) == list(range(10)) + [-1]
+    assert math.isnan(records["cut_fill"][10])
+
+
+def test_version_1_files_are_readable(tmp_path):
+    path = str(tmp_path / "frames-old.oer")
+    records = np.zeros(3, dtype=recorder.FRAME_DTYPE_V1)
+    records["ts"] = [1.0, 2.0, 3.0]
+    with open(path, "wb") as file:
+        file.write(recorder.HEADER.pack(recorder.MAGIC, 1, recorder.KIND_FRAME, records.itemsize, 0.0))
+        file.write(records.tobytes())
+    reader = recorder.RecordReader(path)
+    assert list(reader.records["ts"]) == [1.0, 2.0, 3.0]
+    assert "surface_alt" not in reader.records.dtype.names
+
+
+def test_write_error_closes_the_file(tmp_path):
+    frames = frame_recorder(tmp_path)
+    frames.open()
+    failed = frames._file
+    descriptor = failed.fileno()
+
+    def write(_):
+        raise OSError("no space left on device")
+
+    failed.write = write
+    frames.start()
+    frames.record_frame(Frame(ts=1.0))
+    frames.stop()
+    frames.join(5)
+    assert frames.dropped == 1
+    assert failed.closed
+    with pytest.raises(OSError):
+        os.fstat(descriptor)
@@ -0,0 +1,58 @@
+import numpy as np
+
+from ringbuffer import RingBuffer, SPSCRingBuffer
+
+
+def test_ring_buffer_wraparound():
+    ring = RingBuffer(4, 2)
+    assert ring.latest() is None and ring.bracket(0) is None
+    for index in range(10):
+        ring.append(float(index), (index, -index), seq=100 + index)
+    assert len(ring) == 4
+    timestamp, values, seq = ring.latest()
+    assert (timestamp, values.tolist(), seq) == (9.0, [9, -9], 109)
+    before, after = ring.bracket(7.5)
+    assert (before[0], after[0], before[2], after[2]) == (7.0, 8.0, 107, 108)
+    assert [sample[0] for sample in ring.bracket(6.0)] == [6.0, 7.0]  # exactly the oldest sample
+    assert ring.bracket(1.0)[0][0] == ring.bracket(1.0)[1][0] == 6.0  # overwritten, oldest kept
+    assert ring.bracket(20.0)[0][0] == ring.bracket(20.0)[1][0] == 9.0
+
+
+def test_ring_buffer_before_wraparound():
+    ring = RingBuffer(4, 1)
+    ring.append(1.0, (1,))
+    ring.append(2.0, (2,))
+    assert ring.bracket(0.0)[0][0] == 1.0
+    assert [sample[0] for sample in ring.bracket(1.5)] == [1.0, 2.0]
+
+
+def test_spsc_read_wraparound():
+    ring = SPSCRingBuffer(4, 1)
+    for index in range(3):
+        ring.append(float(index), (index,))
+    times, values, position, lost = ring.read(0)
+    assert times.tolist() == [0, 1, 2] and values[:, 0].tolist() == [0, 1, 2] and lost == 0
+    for index in range(3, 10):
+        ring.append(float(index), (index,))
+    # the slot after the newest sample may be written by the producer, so capacity - 1 samples are read
+    times, values, position, lost = ring.read(position)
+    assert times.tolist() == [7, 8, 9] and position == 10 and lost == 4
+    assert ring.read(position)[0].size == 0
+
+
+def test_spsc_read_into_matches_read():
+    ring = SPSCRingBuffer(8, 3)
+    times = np.zeros(8)
+    values = np.zeros((8, 3))
+    read_position = read_into_position = 0
+    sample = 0
+    for burst in (1, 5, 7, 3, 12, 6, 9, 2):
+        for _ in range(burst):
+            ring.append(float(sample), (sample, 2 * sample, 3 * sample))
+            sample += 1
+        expected_times, expected_values, read_position, expected_lost = ring.read(read_position)
+        count, read_into_position, lost = ring.read_into(read_into_position, times, values)
+        assert read_into_position == read_position and lost == expected_lost
+        assert times[:count].tolist() == expected_times.tolist()
+        assert values[:count].tolist() == expected_values.tolist()
+        assert times[count - 1] == sample - 1
@@ -0,0 +1,38 @@
+import random
+
+import numpy as np
+import pytest
+
+from rotate import get_new_position_rpy, get_new_position_rpy_batch, rod_location, rod_location_reference
+
+SAMPLES = 1000
+TOLERANCE = 1e-9  # meters for offsets, degrees for coordinates
+
+
+@pytest.fixture
+def rpy():
+    rng = random.Random(2)
+    return [[rng.uniform(-180, 180) for _ in range(3)] for _ in range(SAMPLES)]
+
+
+def test_closed_form_matches_reference(rpy):
+    for roll, pitch, yaw in rpy:
+        expected = rod_location_reference([1, 2, 3], 2.5, roll, pitch, yaw)
+        result = rod_location([1, 2, 3], 2.5, roll, pitch, yaw)
+        assert result == pytest.approx(expected, abs=TOLERANCE), (roll, pitch, yaw)
+
+
+def test_batch_matches_single(rpy):
+    rng = random.Random(3)
+    lng = [5.4155 + rng.uniform(-0.001, 0.001) for _ in range(SAMPLES)]
+    lat = [51.6995 + rng.uniform(-0.001, 0.001) for _ in range(SAMPLES)]
+    alt = [rng.uniform(690, 810) for _ in range(SAMPLES)]
+    utm_zone = {"num": 31, "letter": "U"}
+    batch = np.array(get_new_position_rpy_batch(lng, lat, alt, 10, *zip(*rpy), utm_zone))
+    for index in range(SAMPLES):
+        expected = get_new_position_rpy(lng[index], lat[index], alt[index], 10, *rpy[index], utm_zone)
+        assert batch[:, index] == pytest.approx(expected, abs=TOLERANCE), rpy[index]
+
+
+def test_vertical_rod():
+    assert rod_location([500000, 5700000, 700], 2.5, 0, 0, 0) == pytest.approx([500000, 5700000, 697.5])
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import pytest
+
+from gps import rtcm
+from gps.rtcm import CorrectionQueue, RTCMWriter
+
+
+def wait_for(condition, timeout=5.0):
+    """Poll condition until it is true or timeout seconds elapsed"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class FakeSerial:
+
+    def __init__(self, error=None):
+        self.data = bytearray()
+        self.writes = 0
+        self.error = error
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        self.data += data
+        self.writes += 1
+        return len(data)
+
+
+def stop(writer):
+    writer.stop()
+    with writer.corrections.condition:  # wake up the writer waiting for corrections
+        writer.corrections.condition.notify()
+    writer.join(2)
+
+
+def test_queue_drops_oldest():
+    queue = CorrectionQueue(maxlen=3)
+    for index in range(5):
+        queue.put(bytes((index,)))
+    assert len(queue) == 3 and queue.dropped == 2
+    assert queue.get_all(timeout=0) == [b"\x02", b"\x03", b"\x04"]
+    assert queue.get_all(timeout=0.01) == []
+
+
+@pytest.fixture
+def writer():
+    serial_port = FakeSerial()
+    writer = RTCMWriter(serial_port, CorrectionQueue())
+    writer.start()
+    yield writer
+    stop(writer)
+
+
+def test_writer_writes_pending_chunks_at_once(writer):
+    assert writer.stats() == {"rtcm_age": None, "rtcm_bps": 0}
+    with writer.corrections.condition:  # chunks queued while the writer is busy go out together
+        writer.corrections.put(b"abc")
+        writer.corrections.put(b"de")
+    assert wait_for(lambda: writer.written == 5)
+    assert writer._serial.data == b"abcde" and writer._serial.writes == 1
+    stats = writer.stats()
+    assert 0 <= stats["rtcm_age"] < 1
+    assert stats["rtcm_bps"] == pytest.approx(5 / rtcm.RATE_WINDOW)
+
+
+def test_writer_prunes_history(writer, monkeypatch):
+    monkeypatch.setattr(rtcm, "RATE_WINDOW", 0.05)
+    writer.corrections.put(b"abc")
+    assert wait_for(lambda: writer.written == 3)
+    time.sleep(0.1)
+    assert writer.stats()["rtcm_bps"] == 0
+    writer.corrections.put(b"de")
+    assert wait_for(lambda: writer.written == 5)
+    assert [size for _, size in writer._history] == [2]
+
+
+def test_stats_from_other_threads(writer):
+    errors = []
+
+    def read_stats():
+        try:
+            for _ in range(2000):
+                writer.stats()
+        except Exception as exc:
+            errors.append(exc)
+
+    readers = [threading.Thread(target=read_stats) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    for _ in range(200):
+        writer.corrections.put(bytes(10))
+    for reader in readers:
+        reader.join()
+    assert wait_for(lambda: writer.written + 10 * writer.corrections.dropped == 2000)
+    assert errors == []
+
+
+def test_write_errors_are_skipped():
+    serial_port = FakeSerial(OSError("device disconnected"))
+    writer = RTCMWriter(serial_port, CorrectionQueue())
+    writer.start()
+    try:
+        writer.corrections.put(b"abc")
+        assert wait_for(lambda: not writer.corrections)
+        time.sleep(0.05)
+        assert writer.written == 0 and writer.last_write is None and writer.is_alive()
+    finally:
+        stop(writer)
+
+
+def test_crc24q():
+    assert rtcm.crc24q(b"") == 0
+    assert rtcm.crc24q(b"123456789") == 0xCDE703  # CRC-24Q check value
+
+
+def test_framing_split_and_noise():
+    frames = [rtcm.rtcm3_frame(bytes((msg_type >> 4, (msg_type & 0xF) << 4)) + bytes(size))
+              for msg_type, size in ((1005, 17), (1077, 420), (1230, 0))]
+    data = b"\xd3\xff noise " + b"".join(frames)
+    framer = rtcm.RTCM3Framer()
+    received = []
+    for start in range(0, len(data), 100):
+        received += framer.feed(data[start:start + 100])
+    assert received == frames
+    assert [rtcm.rtcm3_type(frame) for frame in received] == [1005, 1077, 1230]
+    assert framer.frames == 3 and not framer.buffer
+
+
+def test_framing_skips_bad_crc():
+    good = rtcm.rtcm3_frame(bytes(20))
+    bad = bytearray(good)
+    bad[-1] ^= 0x01
+    framer = rtcm.RTCM3Framer()
+    assert framer.feed(bytes(bad) + good) == [good]
+    assert framer.errors == 1
@@ -0,0 +1,160 @@
+from collections import deque
+import os
+import select
+import time
+
+import pytest
+from pyubx2 import SET, UBXReader
+
+from database import Config
+from gps.gps import GPSHandler
+from gps.ubx import (NAV_COV, NAV_PVT, NAV_PVT_PAYLOAD, PROTOCOL_NMEA, PROTOCOL_UBX, UBX, UBXFramer,
+                     decode_nav_cov, decode_nav_pvt, fix_quality, ubx_message)
+from simulator import NTRIPCaster, PtyReplay, synthetic_chunks, ubx_epoch
+
+
+def wait_for(condition, timeout=5.0):
+    """Poll condition until it is true or timeout seconds elapsed"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def written_config(replay, timeout=2.0):
+    """Read the CFG-VALSET messages the reader wrote to the pty, as a dict of config key to value"""
+    data = b""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if select.select([replay.master], [], [], 0.2)[0]:
+            data += os.read(replay.master, 4096)
+        elif data:  # nothing more written
+            break
+    values = {}
+    for _, message in UBXReader(_Stream(data), protfilter=2, msgmode=SET):
+        values.update({key: value for key, value in vars(message).items() if key.startswith("CFG_")})
+    return values
+
+
+def test_nav_pvt_and_cov_decoding():
+    epoch = 1700000000.25
+    data = b"$GNGGA,noise\r\n\xb5" + ubx_epoch(epoch, 51.6995, 5.4155, 700.0)
+    framer = UBXFramer()
+    messages = []
+    for start in range(0, len(data), 7):  # split anywhere, as read from the serial port
+        messages += framer.feed(data[start:start + 7])
+    assert [(msg_class, msg_id) for msg_class, msg_id, _ in messages] == [NAV_PVT, NAV_COV]
+    assert framer.errors == 0 and not framer.buffer
+    pvt = decode_nav_pvt(messages[0][2])
+    assert pvt["ts"] == pytest.approx(epoch, abs=1e-6)
+    assert pvt["lat"] == pytest.approx(51.6995) and pvt["lng"] == pytest.approx(5.4155)
+    assert pvt["alt"] == pytest.approx(700.0)
+    assert (pvt["fix"], pvt["sats"], pvt["hacc"], pvt["vacc"]) == (4, 18, 0.014, 0.02)
+    assert pvt["speed"] == pytest.approx(3.6) and pvt["pdop"] == pytest.approx(1.2)
+    itow, accuracy = decode_nav_cov(messages[1][2])
+    assert itow == pvt["itow"]
+    assert accuracy["acc"] == pytest.approx(0.0002 ** 0.5) and accuracy["vacc"] == pytest.approx(0.02)
+
+
+def test_nav_pvt_without_valid_time():
+    payload = bytearray(ubx_epoch(1700000000.0, 51.0, 5.0, 10.0)[6:6 + NAV_PVT_PAYLOAD.size])
+    payload[11] = 0  # valid flags
+    assert "ts" not in decode_nav_pvt(bytes(payload))
+
+
+def test_nav_cov_not_valid():
+    message = ubx_epoch(1700000000.0, 51.0, 5.0, 10.0)
+    payload = bytearray(UBXFramer().feed(message)[1][2])
+    payload[5] = 0  # posCovValid
+    assert decode_nav_cov(bytes(payload)) is None
+
+
+@pytest.mark.parametrize("fix_type, flags, expected", [
+    (3, 0x81, 4),  # carrier solution fixed
+    (3, 0x41, 5),  # carrier solution float
+    (3, 0x03, 2),  # differential
+    (2, 0x01, 1),
+    (3, 0x00, 0),  # gnssFixOK not set
+    (5, 0x81, 0),  # time only
+])
+def test_fix_quality(fix_type, flags, expected):
+    assert fix_quality(fix_type, flags) == expected
+
+
+def test_framer_skips_corrupt_messages():
+    good = ubx_message(0x01, 0x07, bytes(NAV_PVT_PAYLOAD.size))
+    corrupt = bytearray(good)
+    corrupt[10] ^= 0xFF
+    framer = UBXFramer()
+    assert len(framer.feed(bytes(corrupt) + good)) == 1
+    assert framer.errors == 1
+    assert framer.feed(b"\xb5\x62\x01\x07\xff\xff" + good) == [(0x01, 0x07, bytes(NAV_PVT_PAYLOAD.size))]
+    assert framer.errors == 2  # length over MAX_PAYLOAD
+
+
+class _Stream:
+    """Minimal byte stream for UBXReader"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=1):
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+@pytest.fixture
+def ubx_replay():
+    replay = PtyReplay(synthetic_chunks("ubx", seconds=5), speed=10)
+    replay.start()
+    yield replay
+    replay.stop()
+
+
+def test_rate_and_protocol_change_in_place(ubx_replay):
+    reader = UBX(deque(maxlen=1), ubx_replay.port, protocol=PROTOCOL_UBX, rate=10)
+    reader.start()
+    try:
+        assert written_config(ubx_replay)["CFG_RATE_MEAS"] == 100
+        assert wait_for(lambda: reader._gps_queue)
+        serial_port = reader._serial
+        reader.set_output(PROTOCOL_UBX, 5)
+        assert written_config(ubx_replay)["CFG_RATE_MEAS"] == 200
+        reader.set_output(PROTOCOL_NMEA, 5)
+        values = written_config(ubx_replay)
+        assert values["CFG_MSGOUT_UBX_NAV_PVT_USB"] == 0 and values["CFG_MSGOUT_NMEA_ID_GGA_USB"] == 1
+        assert reader._serial is serial_port and serial_port.is_open
+    finally:
+        reader.stop()
+    assert not reader.is_alive()
+    assert not reader._serial.is_open
+
+
+def ubx_config(port, baud_rate, rate, caster):
+    return Config({"gps_type": "UBX", "gps_serial_port": port, "gps_baud_rate": str(baud_rate),
+                   "gps_protocol": PROTOCOL_UBX, "gps_rate": str(rate), "ntrip_host": caster.host,
+                   "ntrip_port": str(caster.port), "ntrip_mountpoint": caster.mountpoint, "ntrip_user": "",
+                   "ntrip_password": ""})
+
+
+def test_ubx_rebuild_keeps_ntrip_session(ubx_replay):
+    caster = NTRIPCaster(synthetic_chunks("rtcm", seconds=5), speed=10)
+    caster.start()
+    handler = GPSHandler(ubx_config(ubx_replay.port, 115200, 10, caster))
+    try:
+        assert wait_for(lambda: handler.get_data().get("lat") and caster.requests == 1)
+        ntrip_client = handler.ntrip_client
+        first_reader = [thread for thread in handler.threads if isinstance(thread, UBX)][0]
+        assert not handler.update_config(ubx_config(ubx_replay.port, 115200, 5, caster))
+        assert handler.update_config(ubx_config(ubx_replay.port, 57600, 5, caster))
+        assert not first_reader.is_alive() and not first_reader._serial.is_open  # stopped before the new one opened
+        assert handler.ntrip_client is ntrip_client and ntrip_client in handler.threads
+        second_reader = [thread for thread in handler.threads if isinstance(thread, UBX)][0]
+        assert second_reader.ntrip_queue is ntrip_client.queue
+        assert wait_for(lambda: handler.get_data() and handler.old_threads == [])
+        assert ntrip_client.is_alive() and caster.requests == 1
+    finally:
+        handler.stop()
+        caster.stop()